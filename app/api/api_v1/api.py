@@ -4,7 +4,7 @@ import uvicorn
 
 from .endpoints import (module, attachment, user, company, group, role,
                         default_permission, sharing_rule, territory,
-                        profile, data, auth)
+                        profile, data, auth, search, job)
 
 app = FastAPI()
 
@@ -30,6 +30,8 @@ app.include_router(sharing_rule.router,
                    prefix='/sharing_rule', tags=['sharing rules'])
 app.include_router(data.router, prefix='/data', tags=['data'])
 app.include_router(auth.router, prefix='/auth', tags=['auth'])
+app.include_router(search.router, prefix='/search', tags=['search'])
+app.include_router(job.router, prefix='/job', tags=['jobs'])
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ from fastapi.security import OAuth2PasswordRequestForm
 from ....crud import user
 from ....core import security
 from ....core.config import logger
+from ... import deps
 
 router = APIRouter()
 
@@ -32,3 +33,8 @@ async def create_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     return {
         'access_token': security.create_access_token({'sub': userDoc['email']}),
         "token_type": "bearer"}
+
+
+@router.get('/password_hash_metrics')
+async def get_password_hash_metrics(current_user: dict = Depends(deps.get_current_active_user)):
+    return {'data': security.get_password_hash_metrics(), 'message': 'Password hash metrics retrieved successfully.'}
@@ -117,9 +117,11 @@ async def get_groups_list_for_datatable(request: Request, response: Response):
         sort: str = requestData['columns[' + sortingColumnNo + '][data]']
         order: str = requestData['order[0][dir]']
         search: str = requestData['search[value]']
+        approximateCount: bool = 'approximate_count' in requestData and \
+            requestData['approximate_count'] == 'true'
 
         result = await group.get_groups_list_for_datatable(
-            int(start), int(length), [sort], order, search)
+            int(start), int(length), [sort], order, search, approximateCount)
 
         returnResponse = {}
         returnResponse['message'] = result['message']
@@ -136,6 +138,7 @@ async def get_groups_list_for_datatable(request: Request, response: Response):
         returnResponse['data'] = result['records']
         returnResponse['recordsFiltered'] = result['recordsFiltered']
         returnResponse['recordsTotal'] = result['recordsTotal']
+        returnResponse['recordsApproximate'] = result['recordsApproximate']
         return returnResponse
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
@@ -0,0 +1,83 @@
+from fastapi import APIRouter, Response, Depends
+
+from ....crud import job_queue
+from ....core.config import jobWorkerConcurrency
+from ... import deps
+
+router = APIRouter()
+
+
+@router.on_event('startup')
+async def start_job_workers():
+    if jobWorkerConcurrency > 0:
+        job_queue.start_job_workers(jobWorkerConcurrency)
+
+
+@router.on_event('shutdown')
+async def stop_job_workers():
+    await job_queue.stop_job_workers()
+
+
+@router.get('', status_code=200)
+async def get_jobs_list(response: Response, start: int = 0, length: int = 10,
+                        status: str = None, type: str = None,
+                        current_user: dict = Depends(deps.get_current_active_user)):
+    result = await job_queue.get_jobs_list(start, length, status, type)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['jobs']
+    returnResponse['recordsTotal'] = result['recordsTotal']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.get('/{job_id}', status_code=200)
+async def get_job(job_id: str, response: Response, current_user: dict = Depends(deps.get_current_active_user)):
+    result = await job_queue.get_job(job_id)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['job']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.post('/{job_id}/cancel', status_code=200)
+async def cancel_job(job_id: str, response: Response, current_user: dict = Depends(deps.get_current_active_user)):
+    result = await job_queue.cancel_job(job_id, current_user)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['message'] = result['message']
+    return returnResponse
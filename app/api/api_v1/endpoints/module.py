@@ -1,18 +1,138 @@
-from fastapi import APIRouter, Request, Response, Depends, Form
+from fastapi import APIRouter, Request, Response, Depends, Form, File, UploadFile
+from fastapi.responses import StreamingResponse
 import json
 
-from ....crud import module, local_data
+from ....crud import (module, local_data, record_import, attachment, relationship, change_feed, recycle_bin,
+                      job_queue)
 from ....core.config import logger
 from ... import deps
 
 router = APIRouter()
 
 
+def split_fields(fields: str) -> list:
+    if not fields:
+        return None
+
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
 @router.on_event('startup')
 async def load_data():
     await local_data.load_logger()
     await module.create_module_collections()
     await local_data.load_local_data()
+    # Existing collections are reconciled once by a worker, not by every process
+    await job_queue.enqueue_job('module.reconcile_indexes', {}, singleton=True)
+    # Pick up attachment deletes left over from the last run
+    attachment.start_attachment_cleanup()
+    recycle_bin.start_recycle_bin_purge()
+
+
+@router.post('/schema/reload', status_code=200)
+async def reload_module_schemas(response: Response, current_user: dict = Depends(deps.verify_administrator)):
+    result = await module.reload_module_schemas()
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+# Runs on the job queue, the outcome is on GET /job/{job_id}
+@router.post('/schema/indexes', status_code=202)
+async def reconcile_module_indexes(response: Response, current_user: dict = Depends(deps.verify_administrator)):
+    result = await job_queue.enqueue_job('module.reconcile_indexes', {}, current_user['email'], singleton=True)
+
+    returnResponse = {}
+    returnResponse['message'] = result['message']
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        return returnResponse
+
+    returnResponse['job_id'] = result['id']
+    return returnResponse
+
+
+@router.get('/schema/migrations', status_code=200)
+async def diff_module_schemas(response: Response, modules: str = None,
+                              current_user: dict = Depends(deps.verify_administrator)):
+    result = await module.diff_module_schemas(split_fields(modules))
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['modules'] = result['modules']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.post('/schema/migrations', status_code=202)
+async def create_schema_migration(request_data: dict, response: Response,
+                                  current_user: dict = Depends(deps.verify_administrator)):
+    moduleNames: list = request_data['modules'] if 'modules' in request_data else None
+    result = await module.create_schema_migration(moduleNames, current_user['email'])
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['id'] = result['id']
+    returnResponse['job_id'] = result['job_id']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.get('/schema/migrations/{migration_id}', status_code=200)
+async def get_schema_migration(migration_id: str, response: Response,
+                               current_user: dict = Depends(deps.verify_administrator)):
+    result = await module.get_schema_migration(migration_id)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['migration'] = result['migration']
+    returnResponse['message'] = result['message']
+    return returnResponse
 
 
 @router.get('/{module_name}/field', status_code=200)
@@ -45,6 +165,109 @@ async def create_new_module_record(module_name: str, request_data: dict, respons
                 'message': 'An error has occured.'}
 
 
+@router.post('/{module_name}/bulk', status_code=201)
+async def create_module_records_in_bulk(module_name: str, request_data: dict, response: Response):
+    try:
+        chunkSize: int = request_data['chunk_size'] if 'chunk_size' in request_data else module.bulkInsertChunkSize
+
+        result = await module.create_module_records_in_bulk(
+            module_name, request_data['new_records'], int(chunkSize))
+
+        returnResponse = {}
+        if 'type' in result:
+            if result['type'] == 'error' or result['type'] == 'exception':
+                response.status_code = 400
+
+            if result['type'] == 'exception':
+                returnResponse['errorType'] = result['errorType']
+                returnResponse['errorMessage'] = result['errorMessage']
+
+            returnResponse['message'] = result['message']
+            return returnResponse
+
+        returnResponse['records'] = result['records']
+        returnResponse['insertedCount'] = result['insertedCount']
+        returnResponse['errorCount'] = result['errorCount']
+        returnResponse['message'] = result['message']
+        return returnResponse
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        response.status_code = 400
+        return {'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+@router.post('/{module_name}/import', status_code=202)
+async def import_records(module_name: str, response: Response,
+                         file: UploadFile = File(...), column_map: str = Form('{}'),
+                         current_user: dict = Depends(deps.verify_import_access_with_profile)):
+    try:
+        columnMap: dict = json.loads(column_map)
+        activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+
+        result = await record_import.create_import_job(module_name, file, columnMap, current_user)
+
+        # The file is removed after the first run, so the import is not retried
+        if 'type' not in result:
+            jobResult = await job_queue.enqueue_job('module.import', {
+                'import_job_id': result['id'],
+                'module_name': module_name,
+                'file_path': result['file_path'],
+                'column_map': columnMap,
+                'activity_types': activityTypes
+            }, current_user['email'], maxAttempts=1)
+            if 'type' in jobResult:
+                result = jobResult
+            else:
+                result['job_id'] = jobResult['id']
+
+        returnResponse = {}
+        if 'type' in result:
+            if result['type'] == 'error' or result['type'] == 'exception':
+                response.status_code = 400
+
+            if result['type'] == 'exception':
+                returnResponse['errorType'] = result['errorType']
+                returnResponse['errorMessage'] = result['errorMessage']
+
+            returnResponse['message'] = result['message']
+            return returnResponse
+
+        returnResponse['id'] = result['id']
+        returnResponse['job_id'] = result['job_id']
+        returnResponse['message'] = result['message']
+        return returnResponse
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        response.status_code = 400
+        return {'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+@router.get('/{module_name}/import/{job_id}', status_code=200)
+async def get_import_job(module_name: str, job_id: str, response: Response,
+                         current_user: dict = Depends(deps.verify_import_access_with_profile)):
+    result = await record_import.get_import_job(module_name, job_id)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['job'] = result['job']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
 @router.post('/{module_name}/records', status_code=200)
 async def get_records_list_for_datatables(module_name: str, request: Request,
                                           response: Response,
@@ -58,9 +281,18 @@ async def get_records_list_for_datatables(module_name: str, request: Request,
         sortOrder: str = requestData['order[0][dir]']
         search: str = requestData['search[value]']
         record_id = json.loads(requestData['record_id'])
+        pagination: str = requestData['pagination'] if 'pagination' in requestData else 'offset'
+        cursor: str = requestData['cursor'] if 'cursor' in requestData else None
+        approximateCount: bool = 'approximate_count' in requestData and \
+            requestData['approximate_count'] == 'true'
+        searchMode: str = requestData['search_mode'] if 'search_mode' in requestData else 'regex'
+        fields: list = split_fields(requestData['fields'] if 'fields' in requestData else None)
+        expand: bool = 'expand' in requestData and requestData['expand'] == 'true'
 
         result = await module.get_records_list_with_options(
-            module_name, int(start), int(length), [sortBy], sortOrder, search, record_id)
+            module_name, int(start), int(length), [sortBy], sortOrder, search, record_id,
+            paginationMode=pagination, cursor=cursor, approximateCount=approximateCount,
+            searchMode=searchMode, fields=fields, expand=expand, currentUser=current_user)
 
         returnResponse = {}
         if 'type' in result:
@@ -77,6 +309,9 @@ async def get_records_list_for_datatables(module_name: str, request: Request,
         returnResponse['data'] = result['records']
         returnResponse['recordsFiltered'] = result['recordsFiltered']
         returnResponse['recordsTotal'] = result['recordsTotal']
+        returnResponse['recordsApproximate'] = result['recordsApproximate']
+        if 'next_cursor' in result:
+            returnResponse['next_cursor'] = result['next_cursor']
         returnResponse['message'] = result['message']
         return returnResponse
     except Exception as e:
@@ -90,8 +325,13 @@ async def get_records_list_for_datatables(module_name: str, request: Request,
 @router.get('/{module_name}', status_code=200)
 async def get_records_list(module_name: str, response: Response, start: int = 0,
                            length: int = 10, search: str = '',
+                           pagination: str = 'offset', cursor: str = None,
+                           approximate_count: bool = False, search_mode: str = 'regex',
+                           fields: str = None, expand: bool = False,
                            current_user: dict = Depends(deps.verify_get_acess_with_profile)):
-    result = await module.get_records_list_with_less_options(module_name, start, length, search)
+    result = await module.get_records_list_with_less_options(
+        module_name, start, length, search, pagination, cursor, approximate_count, search_mode,
+        split_fields(fields), expand, current_user)
 
     returnResponse = {}
     if 'type' in result:
@@ -107,14 +347,222 @@ async def get_records_list(module_name: str, response: Response, start: int = 0,
 
     returnResponse['data'] = result['records']
     returnResponse['recordsTotal'] = result['recordsTotal']
+    returnResponse['recordsApproximate'] = result['recordsApproximate']
+    if 'next_cursor' in result:
+        returnResponse['next_cursor'] = result['next_cursor']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.patch('/{module_name}', status_code=200)
+async def mass_update_records(module_name: str, request_data: dict, response: Response, background: bool = False,
+                              current_user: dict = Depends(deps.verify_edit_access_with_profile)):
+    deps.verify_all_records_access(request_data, current_user)
+    activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+
+    if background:
+        result = await job_queue.enqueue_job(
+            'module.mass_update',
+            {'module_name': module_name, 'request_data': request_data, 'activity_types': activityTypes},
+            current_user['email'])
+    else:
+        result = await module.mass_update_records(module_name, request_data, activityTypes)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    if background:
+        response.status_code = 202
+        returnResponse['job_id'] = result['id']
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['matchedCount'] = result['matchedCount']
+    returnResponse['modifiedCount'] = result['modifiedCount']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.delete('/{module_name}', status_code=200)
+async def delete_records_in_bulk(module_name: str, request_data: dict, response: Response, background: bool = False,
+                                 current_user: dict = Depends(deps.verify_delete_access_with_profile)):
+    deps.verify_all_records_access(request_data, current_user)
+    activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+
+    if background:
+        result = await job_queue.enqueue_job(
+            'module.bulk_delete',
+            {'module_name': module_name, 'request_data': request_data, 'activity_types': activityTypes},
+            current_user['email'])
+    else:
+        result = await module.delete_records_in_bulk(module_name, request_data, activityTypes)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    if background:
+        response.status_code = 202
+        returnResponse['job_id'] = result['id']
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['deletedCount'] = result['deletedCount']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.get('/{module_name}/export', status_code=200)
+async def export_records(module_name: str, response: Response, format: str = 'csv',
+                         search: str = '', search_mode: str = 'regex', sort_by: str = None,
+                         sort_order: str = 'asc', record_id: str = '[]',
+                         current_user: dict = Depends(deps.verify_export_access_with_profile)):
+    try:
+        activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+
+        result = await module.export_records(
+            module_name, format, [sort_by] if sort_by else [], sort_order, search,
+            json.loads(record_id), search_mode, activityTypes)
+
+        returnResponse = {}
+        if 'type' in result:
+            if result['type'] == 'error' or result['type'] == 'exception':
+                response.status_code = 400
+
+            if result['type'] == 'exception':
+                returnResponse['errorType'] = result['errorType']
+                returnResponse['errorMessage'] = result['errorMessage']
+
+            returnResponse['message'] = result['message']
+            return returnResponse
+
+        return StreamingResponse(
+            result['content'], media_type=result['media_type'],
+            headers={'Content-Disposition': 'attachment; filename="' + result['file_name'] + '"'})
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        response.status_code = 400
+        return {'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+@router.get('/{module_name}/changes', status_code=200)
+async def get_changes(module_name: str, response: Response, since: str = None, resume_token: str = None,
+                      length: int = 100, current_user: dict = Depends(deps.verify_get_acess_with_profile)):
+    activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+    result = await change_feed.get_changes(module_name, since, resume_token, length, activityTypes)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['changes']
+    returnResponse['resumeToken'] = result['resumeToken']
+    returnResponse['hasMore'] = result['hasMore']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.get('/{module_name}/changes/stream', status_code=200)
+async def watch_changes(module_name: str, response: Response, resume_token: str = None,
+                        current_user: dict = Depends(deps.verify_get_acess_with_profile)):
+    activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+    result = await change_feed.watch_changes(module_name, resume_token, activityTypes)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    return StreamingResponse(result['content'], media_type=result['media_type'])
+
+
+@router.get('/{module_name}/recycle_bin', status_code=200)
+async def get_recycle_bin(module_name: str, response: Response, start: int = 0, length: int = 100,
+                          current_user: dict = Depends(deps.verify_get_acess_with_profile)):
+    activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+    result = await recycle_bin.get_recycle_bin(module_name, start, length, activityTypes)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['records']
+    returnResponse['recordsTotal'] = result['recordsTotal']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.post('/{module_name}/recycle_bin/restore', status_code=200)
+async def restore_records(module_name: str, request_data: dict, response: Response,
+                          current_user: dict = Depends(deps.verify_delete_access_with_profile)):
+    activityTypes = current_user['activity_modules'] if module_name == 'Activity' else None
+    result = await recycle_bin.restore_records(module_name, request_data, activityTypes)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['restoredCount'] = result['restoredCount']
+    returnResponse['conflictIds'] = result['conflictIds']
     returnResponse['message'] = result['message']
     return returnResponse
 
 
 @router.get('/{module_name}/{record_id}', status_code=200)
-async def get_record(module_name: str, record_id: str, response: Response,
+async def get_record(module_name: str, record_id: str, response: Response, fields: str = None,
+                     expand: bool = False,
                      current_user: dict = Depends(deps.verify_get_acess_with_profile)):
-    result = await module.get_record(module_name, record_id)
+    result = await module.get_record(module_name, record_id, split_fields(fields), expand, current_user)
 
     returnResponse = {}
     if 'type' in result:
@@ -142,6 +590,10 @@ async def update_record(module_name: str, record_id: str, request_data: dict, re
         if result['type'] == 'error' or result['type'] == 'exception':
             response.status_code = 400
 
+        if result['type'] == 'conflict':
+            response.status_code = 409
+            returnResponse['version'] = result['version']
+
         if result['type'] == 'exception':
             returnResponse['errorType'] = result['errorType']
             returnResponse['errorMessage'] = result['errorMessage']
@@ -149,13 +601,15 @@ async def update_record(module_name: str, record_id: str, request_data: dict, re
         returnResponse['message'] = result['message']
         return returnResponse
 
+    if 'version' in result:
+        returnResponse['version'] = result['version']
     returnResponse['message'] = result['message']
     return returnResponse
 
 
 @router.delete('/{module_name}/{record_id}', status_code=200)
-async def delete_record(module_name: str, record_id: str, response: Response):
-    result = await module.delete_record(module_name, record_id)
+async def delete_record(module_name: str, record_id: str, response: Response, mode: str = 'soft'):
+    result = await module.delete_record(module_name, record_id, mode)
 
     returnResponse = {}
     if 'type' in result:
@@ -189,6 +643,7 @@ async def create_relationship(module_name: str, record_id: str, request_data: di
         returnResponse['message'] = result['message']
         return returnResponse
 
+    returnResponse['addedCount'] = result['addedCount']
     returnResponse['message'] = result['message']
     return returnResponse
 
@@ -206,5 +661,81 @@ async def delete_relationship(module_name: str, record_id: str, request_data: di
             returnResponse['errorType'] = result['errorType']
             returnResponse['errorMessage'] = result['errorMessage']
 
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['removedCount'] = result['removedCount']
     returnResponse['message'] = result['message']
     return returnResponse
+
+
+@router.get('/{module_name}/{record_id}/relationship/{field_name}', status_code=200)
+async def get_related_records(module_name: str, record_id: str, field_name: str, response: Response,
+                              start: int = 0, length: int = 10,
+                              current_user: dict = Depends(deps.verify_get_acess_with_profile)):
+    result = await relationship.get_related_records(module_name, record_id, field_name, start, length)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['records']
+    returnResponse['recordsTotal'] = result['recordsTotal']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+@router.get('/{module_name}/{record_id}/referenced_by/{from_module}', status_code=200)
+async def get_referencing_records(module_name: str, record_id: str, from_module: str, response: Response,
+                                  field_name: str = None, start: int = 0, length: int = 10,
+                                  current_user: dict = Depends(deps.verify_get_acess_with_profile)):
+    # The ids returned are from_module records
+    deps.verify_module_view_access(from_module, current_user)
+    result = await relationship.get_referencing_records(from_module, record_id, field_name, start, length)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['records']
+    returnResponse['recordsTotal'] = result['recordsTotal']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
+# Runs on the job queue, the outcome is on GET /job/{job_id}
+@router.post('/{module_name}/relationship/{field_name}/migrate', status_code=202)
+async def migrate_embedded_relationships(module_name: str, field_name: str, response: Response,
+                                         current_user: dict = Depends(deps.verify_administrator)):
+    result = await relationship.queue_relationship_migration(module_name, field_name, current_user['email'])
+
+    returnResponse = {}
+    returnResponse['message'] = result['message']
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        return returnResponse
+
+    returnResponse['job_id'] = result['id']
+    return returnResponse
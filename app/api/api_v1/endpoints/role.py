@@ -94,6 +94,28 @@ async def get_roles_in_tree_structure(response: Response):
     return returnResponse
 
 
+@router.get('/subordinates', status_code=200)
+async def get_subordinates(response: Response, role_name: str):
+    result = await role.get_subordinates(role_name)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['roles'] = result['roles']
+    returnResponse['users'] = result['users']
+    returnResponse['message'] = result['message']
+    return returnResponse
+
+
 @router.get('/{record_id}', status_code=200)
 async def get_role(record_id: str, response: Response):
     result = await role.get_role(record_id)
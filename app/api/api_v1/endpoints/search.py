@@ -0,0 +1,31 @@
+from fastapi import APIRouter, Response, Depends
+
+from ....crud import search
+from ... import deps
+
+router = APIRouter()
+
+
+@router.get('', status_code=200)
+async def search_all_modules(q: str, response: Response, limit: int = search.searchModuleLimit,
+                             total: int = search.searchResultLimit, timeout_ms: int = search.searchTimeoutMs,
+                             search_mode: str = search.searchDefaultMode,
+                             current_user: dict = Depends(deps.get_current_active_user)):
+    result = await search.search_all_modules(q, current_user, limit, total, timeout_ms, search_mode)
+
+    returnResponse = {}
+    if 'type' in result:
+        if result['type'] == 'error' or result['type'] == 'exception':
+            response.status_code = 400
+
+        if result['type'] == 'exception':
+            returnResponse['errorType'] = result['errorType']
+            returnResponse['errorMessage'] = result['errorMessage']
+
+        returnResponse['message'] = result['message']
+        return returnResponse
+
+    returnResponse['data'] = result['records']
+    returnResponse['modules'] = result['modules']
+    returnResponse['message'] = result['message']
+    return returnResponse
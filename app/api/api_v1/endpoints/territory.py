@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request, Response, Depends
 
-from ....crud import territory
+from ....crud import territory, job_queue
 
 router = APIRouter()
 
@@ -92,9 +92,10 @@ async def get_territories_in_tree_structure(response: Response):
     return returnResponse
 
 
-@router.get('/run_rules', status_code=200)
+# Runs on the job queue, the outcome is on GET /job/{job_id}
+@router.get('/run_rules', status_code=202)
 async def run_rules(response: Response):
-    result = await territory.run_rules()
+    result = await job_queue.enqueue_job('territory.run_rules', {}, singleton=True)
 
     returnResponse = {}
     returnResponse['message'] = result['message']
@@ -106,6 +107,9 @@ async def run_rules(response: Response):
             returnResponse['errorType'] = result['errorType']
             returnResponse['errorMessage'] = result['errorMessage']
 
+        return returnResponse
+
+    returnResponse['job_id'] = result['id']
     return returnResponse
 
 
@@ -157,8 +157,11 @@ async def get_users_list_for_datatables(request: Request, response: Response,
         order: str = requestData['order[0][dir]']
         search: str = requestData['search[value]']
         status = json.loads(requestData['status'])
+        approximateCount: bool = 'approximate_count' in requestData and \
+            requestData['approximate_count'] == 'true'
 
-        result = await user.get_users_with_options(int(start), int(length), [sort], order, search, status)
+        result = await user.get_users_with_options(int(start), int(length), [sort], order, search, status,
+                                                   approximateCount)
 
         returnResponse = {}
         if 'type' in result:
@@ -175,6 +178,7 @@ async def get_users_list_for_datatables(request: Request, response: Response,
         returnResponse['data'] = result['records']
         returnResponse['recordsFiltered'] = result['recordsFiltered']
         returnResponse['recordsTotal'] = result['recordsTotal']
+        returnResponse['recordsApproximate'] = result['recordsApproximate']
         returnResponse['message'] = result['message']
         return returnResponse
     except Exception as e:
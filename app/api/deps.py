@@ -5,7 +5,7 @@ from jose import jwt
 
 from ..core.config import secretKey, logger
 from ..core.security import algorithm
-from ..crud import user, profile
+from ..crud import user, permission
 
 outh2Scheme = OAuth2PasswordBearer(tokenUrl='/auth/access_token')
 
@@ -22,12 +22,13 @@ async def get_current_user(token: str = Depends(outh2Scheme)) -> dict:
 
     # logger.debug(tokenPayload)
 
-    userDoc = await user.get_user_by_email(tokenPayload['sub'])
+    userDoc = await user.get_current_user_view(tokenPayload['sub'])
 
     if not userDoc:
         raise HTTPException(status_code=404, detail="User not found.")
 
-    return userDoc
+    # The cached view is shared, the access checks add request specific keys
+    return dict(userDoc)
 
 
 async def get_current_active_user(currentUser: dict = Depends(get_current_user)) -> dict:
@@ -41,13 +42,77 @@ async def verify_get_acess_with_profile(module_name: str, currentUser: dict = De
     logger.debug(module_name)
     logger.debug(currentUser['email'])
     logger.debug(currentUser['profile'])
-    activityList = []
-    if await profile.get_count_by_profile_module_operation(
-            currentUser['profile'], module_name, 'view', activityList) == 0:
+    if not permission.is_operation_allowed(currentUser['profile'], module_name, 'view'):
         raise HTTPException(
             status_code=400, detail='View access not allowed for ' + module_name + '.')
 
     if module_name == 'Activity':
-        currentUser['activity_modules'] = activityList
-        logger.debug(activityList)
+        currentUser['activity_modules'] = permission.get_allowed_activity_types(currentUser['profile'], 'view')
+        logger.debug(currentUser['activity_modules'])
+    return currentUser
+
+
+async def verify_edit_access_with_profile(module_name: str, currentUser: dict = Depends(get_current_active_user)) -> dict:
+    if not permission.is_operation_allowed(currentUser['profile'], module_name, 'edit'):
+        raise HTTPException(
+            status_code=400, detail='Edit access not allowed for ' + module_name + '.')
+
+    if module_name == 'Activity':
+        currentUser['activity_modules'] = permission.get_allowed_activity_types(currentUser['profile'], 'edit')
+    return currentUser
+
+
+async def verify_delete_access_with_profile(module_name: str, currentUser: dict = Depends(get_current_active_user)) -> dict:
+    if not permission.is_operation_allowed(currentUser['profile'], module_name, 'delete'):
+        raise HTTPException(
+            status_code=400, detail='Delete access not allowed for ' + module_name + '.')
+
+    if module_name == 'Activity':
+        currentUser['activity_modules'] = permission.get_allowed_activity_types(currentUser['profile'], 'delete')
+    return currentUser
+
+
+async def verify_administrator(currentUser: dict = Depends(get_current_active_user)) -> dict:
+    if not permission.is_administrator(currentUser['profile']):
+        raise HTTPException(
+            status_code=400, detail='Only the ' + permission.administratorProfileName + ' profile is allowed.')
+
+    return currentUser
+
+
+# Requests that act on every record of a module need the administrator profile
+def verify_all_records_access(requestData: dict, currentUser: dict):
+    if 'all_records' in requestData and requestData['all_records'] is True \
+            and not permission.is_administrator(currentUser['profile']):
+        raise HTTPException(
+            status_code=400, detail='Only the ' + permission.administratorProfileName +
+            ' profile is allowed to change all records.')
+
+
+# For routes that also read a module other than the one in the path
+def verify_module_view_access(moduleName: str, currentUser: dict):
+    if not permission.is_operation_allowed(currentUser['profile'], moduleName, 'view'):
+        raise HTTPException(
+            status_code=400, detail='View access not allowed for ' + moduleName + '.')
+
+
+async def verify_export_access_with_profile(module_name: str, currentUser: dict = Depends(get_current_active_user)) -> dict:
+    if not permission.is_data_records_allowed(currentUser['profile'], module_name, 'export_records'):
+        raise HTTPException(
+            status_code=400, detail='Export access not allowed for ' + module_name + '.')
+
+    if module_name == 'Activity':
+        currentUser['activity_modules'] = permission.get_data_records_activity_types(
+            currentUser['profile'], 'export_records')
+    return currentUser
+
+
+async def verify_import_access_with_profile(module_name: str, currentUser: dict = Depends(get_current_active_user)) -> dict:
+    if not permission.is_data_records_allowed(currentUser['profile'], module_name, 'import_records'):
+        raise HTTPException(
+            status_code=400, detail='Import access not allowed for ' + module_name + '.')
+
+    if module_name == 'Activity':
+        currentUser['activity_modules'] = permission.get_data_records_activity_types(
+            currentUser['profile'], 'import_records')
     return currentUser
@@ -22,10 +22,17 @@ collectionGroup = database.get_collection('group')
 collectionSharingRule = database.get_collection('sharing_rule')
 collectionDefaultPermission = database.get_collection('default_permission')
 collectionData = database.get_collection('data')
+collectionImportJob = database.get_collection('import_job')
+collectionAttachmentCleanup = database.get_collection('attachment_cleanup')
+collectionRelationship = database.get_collection('relationship')
+collectionSchemaMigration = database.get_collection('schema_migration')
+collectionTombstone = database.get_collection('record_tombstone')
+collectionJob = database.get_collection('job')
 
 logger = logging.getLogger('crmLogger')
 
 dictProfiles = dict()
+permissionMatrix = {'profiles': {}, 'compiled_at': 0, 'reloading': False}
 moduleFieldTypes = dict()
 moduleBsonFieldTypes = dict()
 moduleTypeFields = dict()
@@ -34,3 +41,11 @@ moduleUniqueFields = dict()
 activityFieldTypes = dict()
 activityTypeFields = dict()
 collectionBsonTypeFields = dict()
+moduleSchemas = dict()
+moduleSchemaVersion = {'version': 0, 'loaded_at': 0, 'reload_task': None, 'stored_version': None, 'checked_at': 0}
+countCache = dict()
+currentUserCache = dict()
+territoryTreeCache = {'version': 0, 'tree_version': -1, 'built_at': 0, 'tree': None}
+
+# Job workers started inside the API process, 0 when python -m app.worker runs them
+jobWorkerConcurrency = 2
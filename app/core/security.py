@@ -1,6 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import jwt
 from passlib.context import CryptContext
+import asyncio
+import os
+import time
 
 from ..core.config import secretKey
 
@@ -9,6 +13,20 @@ pwdContext = CryptContext(schemes=['bcrypt'], deprecated='auto')
 algorithm = 'HS256'
 tokenExpireMinutes = 60 * 12
 
+# bcrypt releases the GIL, so a few threads hash in parallel while the event
+# loop keeps serving other requests. Extra logins wait in the pool queue.
+passwordHashConcurrency = max(1, (os.cpu_count() or 2) // 2)
+passwordHashExecutor = ThreadPoolExecutor(max_workers=passwordHashConcurrency,
+                                          thread_name_prefix='password_hash')
+passwordHashMetrics = {
+    'pending': 0,
+    'completed': 0,
+    'failed': 0,
+    'wait_seconds_total': 0.0,
+    'hash_seconds_total': 0.0,
+    'max_wait_seconds': 0.0
+}
+
 
 def create_access_token(data: dict, expiresDelta: timedelta = None) -> str:
     toEncode = data.copy()
@@ -25,9 +43,49 @@ def create_access_token(data: dict, expiresDelta: timedelta = None) -> str:
     return jwtEncoded
 
 
-def verify_password(plainPassword: str, hashedPassword: str) -> bool:
-    return pwdContext.verify(plainPassword, hashedPassword)
+def run_timed(function, *arguments) -> tuple:
+    startedAt = time.monotonic()
+    result = function(*arguments)
+
+    return result, startedAt, time.monotonic()
+
+
+# Metrics are only touched on the event loop, the pool threads just time the call
+async def run_password_hash(function, *arguments) -> any:
+    submittedAt = time.monotonic()
+    passwordHashMetrics['pending'] += 1
+
+    try:
+        result, startedAt, finishedAt = await asyncio.get_event_loop().run_in_executor(
+            passwordHashExecutor, run_timed, function, *arguments)
+    except Exception:
+        passwordHashMetrics['failed'] += 1
+        raise
+    finally:
+        passwordHashMetrics['pending'] -= 1
+
+    passwordHashMetrics['completed'] += 1
+    passwordHashMetrics['wait_seconds_total'] += startedAt - submittedAt
+    passwordHashMetrics['hash_seconds_total'] += finishedAt - startedAt
+    passwordHashMetrics['max_wait_seconds'] = max(passwordHashMetrics['max_wait_seconds'], startedAt - submittedAt)
+
+    return result
+
+
+async def verify_password(plainPassword: str, hashedPassword: str) -> bool:
+    return await run_password_hash(pwdContext.verify, plainPassword, hashedPassword)
+
+
+async def get_password_hash(password: str) -> str:
+    return await run_password_hash(pwdContext.hash, password)
+
+
+def get_password_hash_metrics() -> dict:
+    metrics = dict(passwordHashMetrics)
+    metrics['concurrency'] = passwordHashConcurrency
 
+    completedCount = metrics['completed']
+    metrics['average_wait_seconds'] = metrics['wait_seconds_total'] / completedCount if completedCount else 0.0
+    metrics['average_hash_seconds'] = metrics['hash_seconds_total'] / completedCount if completedCount else 0.0
 
-def get_password_hash(password: str) -> str:
-    return pwdContext.hash(password)
+    return metrics
@@ -1,10 +1,16 @@
+import asyncio
 import base64
 import datetime
 from bson.objectid import ObjectId
 
-from ..core.config import logger, gridFs
+from ..core.config import logger, gridFs, database, collectionAttachmentCleanup
 from . import module
 
+attachmentCleanupBatchSize = 500
+attachmentCleanupState = {'running': False, 'pending': False}
+collectionFsFiles = database.get_collection('fs.files')
+collectionFsChunks = database.get_collection('fs.chunks')
+
 
 async def post_attachment_new(moduleName: str, requestData: dict) -> dict:
     fileId = None
@@ -47,6 +53,57 @@ async def delete_attachment(fileId: str):
     await gridFs.delete(ObjectId(fileId))
 
 
+# File ids are parked in a collection first, so a restart does not lose them
+async def queue_attachment_cleanup(fileIds: list):
+    if len(fileIds) == 0:
+        return
+
+    queuedAt = datetime.datetime.now()
+    await collectionAttachmentCleanup.insert_many(
+        [{'file_id': ObjectId(fileId), 'queued_at': queuedAt} for fileId in fileIds])
+
+    start_attachment_cleanup()
+
+
+def start_attachment_cleanup():
+    attachmentCleanupState['pending'] = True
+
+    if not attachmentCleanupState['running']:
+        attachmentCleanupState['running'] = True
+        asyncio.ensure_future(run_attachment_cleanup())
+
+
+async def delete_attachment_batch(fileIds: list):
+    # Same as gridFs.delete, but two round trips for the whole batch
+    await collectionFsChunks.delete_many({'files_id': {'$in': fileIds}})
+    await collectionFsFiles.delete_many({'_id': {'$in': fileIds}})
+
+
+async def run_attachment_cleanup():
+    try:
+        while attachmentCleanupState['pending']:
+            attachmentCleanupState['pending'] = False
+
+            queuedFiles = await collectionAttachmentCleanup.find(
+                {}, limit=attachmentCleanupBatchSize).to_list(attachmentCleanupBatchSize)
+
+            while len(queuedFiles) > 0:
+                await delete_attachment_batch([queuedFile['file_id'] for queuedFile in queuedFiles])
+                await collectionAttachmentCleanup.delete_many(
+                    {'_id': {'$in': [queuedFile['_id'] for queuedFile in queuedFiles]}})
+
+                logger.debug(str(len(queuedFiles)) + ' attachments removed.')
+
+                queuedFiles = await collectionAttachmentCleanup.find(
+                    {}, limit=attachmentCleanupBatchSize).to_list(attachmentCleanupBatchSize)
+
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+
+    finally:
+        attachmentCleanupState['running'] = False
+
+
 async def delete_attchment_from_api(moduleName: str, fileId: str):
     try:
         cursor = gridFs.find({'_id': ObjectId(fileId)})
@@ -0,0 +1,258 @@
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+import datetime
+
+from ..core.config import logger, database, mongoClient, collectionTombstone
+from ..db import setup_collection
+from . import module, field_codec, pagination, record_export
+
+changeFeedPageLimit = 1000
+# Writers stamp modified_at before the write lands, so the newest second is
+# held back until slower writes with an earlier stamp are visible
+changeFeedSettleSeconds = 2
+changeSortFields = [('changed_at', 1), ('_id', 1)]
+replicaSetState = {'checked': False, 'replica_set': False}
+
+
+async def record_tombstones(moduleName: str, records: list):
+    if len(records) == 0:
+        return
+
+    deletedAt = datetime.datetime.now()
+    tombstones = []
+    for record in records:
+        # Purged recycle bin records keep the time they were soft deleted, the
+        # feed already reported them as deleted then
+        tombstone = {
+            'module_name': moduleName,
+            'record_id': str(record['_id']),
+            'deleted_at': record['deleted_at'] if 'deleted_at' in record else deletedAt
+        }
+        if 'activity_type' in record:
+            tombstone['activity_type'] = record['activity_type']
+        tombstones.append(tombstone)
+
+    await collectionTombstone.insert_many(tombstones, ordered=False)
+
+
+def decode_change_position(since: str, resumeToken: str) -> list:
+    if resumeToken:
+        return pagination.decode_cursor(resumeToken, changeSortFields)
+
+    try:
+        sinceTime = datetime.datetime.fromisoformat(since)
+    except (TypeError, ValueError):
+        raise ValueError('since has to be an ISO 8601 date time.')
+
+    # Stored dates are naive local times
+    if sinceTime.tzinfo is not None:
+        sinceTime = sinceTime.astimezone().replace(tzinfo=None)
+
+    # The lowest ObjectId makes since inclusive
+    return [sinceTime, ObjectId('0' * 24)]
+
+
+def encode_resume_token(changedAt: datetime.datetime, changeId: ObjectId) -> str:
+    return pagination.encode_cursor(changeSortFields, {'changed_at': changedAt, '_id': changeId})
+
+
+async def get_changes(moduleName: str, since: str, resumeToken: str, length: int,
+                      activityTypes: list = None) -> dict:
+    try:
+        moduleSchema = await module.get_module_schema(moduleName)
+
+        if moduleSchema is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        if length < 1 or length > changeFeedPageLimit:
+            return {
+                'type': 'error',
+                'message': 'Length has to be between 1 and ' + str(changeFeedPageLimit) + '.'
+            }
+
+        try:
+            position = decode_change_position(since, resumeToken)
+        except ValueError as e:
+            return {'type': 'error', 'message': str(e)}
+
+        now = datetime.datetime.now()
+        # Tombstones expire, clients that fell further behind resync in full
+        retentionDays = setup_collection.tombstoneRetentionDays
+        if position[0] < now - datetime.timedelta(days=retentionDays):
+            return {
+                'type': 'error',
+                'message': 'Changes older than ' + str(retentionDays) + ' days are not kept, a full resync is needed.'
+            }
+
+        settledAt = now - datetime.timedelta(seconds=changeFeedSettleSeconds)
+        collection = database.get_collection('module_' + moduleName)
+
+        recordsQuery = {'$and': [
+            pagination.build_keyset_query([('modified_at', 1), ('_id', 1)], position),
+            {'modified_at': {'$lte': settledAt}}
+        ]}
+        tombstonesQuery = {'$and': [
+            pagination.build_keyset_query([('deleted_at', 1), ('_id', 1)], position),
+            {'module_name': moduleName, 'deleted_at': {'$lte': settledAt}}
+        ]}
+        if moduleName == 'Activity' and activityTypes is not None:
+            recordsQuery['$and'].append({'activity_type': {'$in': activityTypes}})
+            tombstonesQuery['$and'].append({'activity_type': {'$in': activityTypes}})
+
+        # One extra of each tells whether another page follows
+        records = await collection.find(recordsQuery) \
+            .sort([('modified_at', 1), ('_id', 1)]).limit(length + 1).to_list(length + 1)
+        tombstones = await collectionTombstone.find(tombstonesQuery) \
+            .sort([('deleted_at', 1), ('_id', 1)]).limit(length + 1).to_list(length + 1)
+
+        changes = [(record['modified_at'], record['_id'], record) for record in records]
+        changes.extend([(tombstone['deleted_at'], tombstone['_id'], None) for tombstone in tombstones])
+        changes.sort(key=lambda change: (change[0], change[1]))
+
+        hasMore = len(changes) > length
+        changes = changes[:length]
+
+        tombstonesById = {tombstone['_id']: tombstone for tombstone in tombstones}
+        changeList = []
+        for changedAt, changeId, record in changes:
+            if record is None or 'deleted_at' in record:
+                changeList.append({
+                    'operation': 'delete',
+                    'record_id': tombstonesById[changeId]['record_id'] if record is None else str(record['_id']),
+                    'changed_at': changedAt.isoformat()
+                })
+                continue
+
+            activityType = record['activity_type'] if moduleName == 'Activity' else None
+            field_codec.decode_record(module.get_module_codec(moduleSchema, activityType), record)
+            changeList.append({
+                'operation': 'upsert',
+                'record_id': record['_id'],
+                'changed_at': changedAt.isoformat(),
+                'record': record
+            })
+
+        if len(changes) > 0:
+            resumeToken = encode_resume_token(changes[-1][0], changes[-1][1])
+
+        # Nothing changed up to the settle point, so the client moves up to it.
+        # A quiet module never pushes its clients past the tombstone retention.
+        elif settledAt > position[0]:
+            resumeToken = encode_resume_token(settledAt, ObjectId('f' * 24))
+
+        else:
+            resumeToken = encode_resume_token(position[0], position[1])
+
+        return {
+            'changes': changeList,
+            'resumeToken': resumeToken,
+            'hasMore': hasMore,
+            'message': str(len(changeList)) + ' ' + moduleName + ' changes retrieved.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def is_replica_set() -> bool:
+    if not replicaSetState['checked']:
+        serverState = await mongoClient.admin.command('ismaster')
+        replicaSetState['replica_set'] = 'setName' in serverState
+        replicaSetState['checked'] = True
+
+    return replicaSetState['replica_set']
+
+
+def build_stream_change(moduleName: str, moduleSchema: dict, change: dict) -> dict:
+    isDeleted = change['operationType'] == 'delete' or \
+        ('fullDocument' in change and change['fullDocument'] is not None and 'deleted_at' in change['fullDocument'])
+
+    streamChange = {
+        'operation': 'delete' if isDeleted else 'upsert',
+        'record_id': str(change['documentKey']['_id']),
+        'resume_token': change['_id']['_data']
+    }
+
+    if not isDeleted and 'fullDocument' in change and change['fullDocument'] is not None:
+        record = change['fullDocument']
+        activityType = record['activity_type'] if moduleName == 'Activity' else None
+        streamChange['record'] = field_codec.decode_record(
+            module.get_module_codec(moduleSchema, activityType), record)
+
+    return streamChange
+
+
+def format_stream_change(moduleName: str, moduleSchema: dict, change: dict, activityTypes: list) -> str:
+    # Deletes carry no document, so they pass the activity type filter
+    if moduleName == 'Activity' and activityTypes is not None and change['operationType'] != 'delete' \
+            and change['fullDocument'] is not None \
+            and change['fullDocument']['activity_type'] not in activityTypes:
+        return None
+
+    return record_export.format_ndjson_rows([build_stream_change(moduleName, moduleSchema, change)])
+
+
+async def stream_change_events(moduleName: str, moduleSchema: dict, changeStream, activityTypes: list,
+                               firstChange: dict = None):
+    async with changeStream:
+        if firstChange is not None:
+            row = format_stream_change(moduleName, moduleSchema, firstChange, activityTypes)
+            if row is not None:
+                yield row
+
+        async for change in changeStream:
+            row = format_stream_change(moduleName, moduleSchema, change, activityTypes)
+            if row is not None:
+                yield row
+
+
+async def watch_changes(moduleName: str, resumeToken: str, activityTypes: list = None) -> dict:
+    try:
+        moduleSchema = await module.get_module_schema(moduleName)
+
+        if moduleSchema is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        if not await is_replica_set():
+            return {
+                'type': 'error',
+                'message': 'Change streams need a replica set, use the changes endpoint instead.'
+            }
+
+        collection = database.get_collection('module_' + moduleName)
+        changeStream = collection.watch(
+            [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}],
+            full_document='updateLookup',
+            resume_after={'_data': resumeToken} if resumeToken else None)
+
+        # Opened here rather than on the first read of the response, so a bad
+        # resume token is an error before the 200 has gone out
+        try:
+            firstChange = await changeStream.try_next()
+        except OperationFailure as e:
+            await changeStream.close()
+            return {'type': 'error', 'message': 'The resume token cannot be used: ' + str(e)}
+
+        return {
+            'content': stream_change_events(moduleName, moduleSchema, changeStream, activityTypes, firstChange),
+            'media_type': 'application/x-ndjson'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
@@ -4,7 +4,8 @@ from bson.binary import Binary
 
 from ..db import setup_collection
 from ..core.config import collectionCompany, logger, mongoClient, collectionTerritory
-from .territory import create_root_territory
+from .territory import create_root_territory, bump_territory_tree_version
+from . import count_cache
 
 
 async def create_one_company_record():
@@ -123,6 +124,9 @@ async def update_company_record(requestData: dict) -> dict:
                                                                                    'parent_territory': requestData['company_name']}},
                                                                                session=transactionSession)
 
+        count_cache.invalidate_filtered_counts(collectionTerritory.name)
+        bump_territory_tree_version()
+
         return {'message': str(result.modified_count) + ' company record updated. ' +
                 str(resultTerritory.modified_count) + ' root territory updated. ' +
                 str(resultChildTerritories.modified_count) + ' child territories of root updated.'}
@@ -0,0 +1,97 @@
+import time
+from bson import json_util
+
+from ..core.config import countCache
+from . import recycle_bin
+
+countCacheTtlSeconds = 60
+# Query shapes kept per collection, every search term is a shape of its own
+countCacheSize = 256
+approximateCountLimit = 10000
+
+
+def get_query_shape(query: dict) -> str:
+    return json_util.dumps(query, sort_keys=True)
+
+
+async def get_count(collection, query: dict, approximate: bool = False) -> dict:
+    collectionCounts = countCache.setdefault(collection.name, {})
+    queryShape = get_query_shape(query)
+
+    if queryShape in collectionCounts:
+        # Taken out and put back last, the dict order is the LRU order
+        cachedCount = collectionCounts.pop(queryShape)
+        if time.monotonic() - cachedCount['cached_at'] < countCacheTtlSeconds \
+                and (approximate or not cachedCount['approximate']):
+            collectionCounts[queryShape] = cachedCount
+            return cachedCount
+
+    isApproximate = False
+
+    # No filter: the collection metadata already knows the size
+    if not query:
+        count = await collection.estimated_document_count()
+
+    # Live records: the size minus the recycle bin, counted on its partial index
+    elif query == recycle_bin.liveRecordQuery:
+        count = await collection.estimated_document_count() - \
+            await collection.count_documents(recycle_bin.deletedRecordQuery)
+
+    # Stop counting once the limit is reached, the grid only needs "more than N"
+    elif approximate:
+        count = await collection.count_documents(query, limit=approximateCountLimit)
+        isApproximate = count >= approximateCountLimit
+
+    else:
+        count = await collection.count_documents(query)
+
+    cachedCount = {'count': count, 'approximate': isApproximate,
+                   'cached_at': time.monotonic()}
+    store_count(collectionCounts, queryShape, cachedCount)
+
+    return cachedCount
+
+
+def store_count(collectionCounts: dict, queryShape: str, cachedCount: dict):
+    now = time.monotonic()
+    for expiredShape in [cachedShape for cachedShape, cachedEntry in collectionCounts.items()
+                         if now - cachedEntry['cached_at'] >= countCacheTtlSeconds]:
+        collectionCounts.pop(expiredShape)
+
+    collectionCounts.pop(queryShape, None)
+    while len(collectionCounts) >= countCacheSize:
+        collectionCounts.pop(next(iter(collectionCounts)))
+
+    collectionCounts[queryShape] = cachedCount
+
+
+def invalidate_filtered_counts(collectionName: str):
+    if collectionName not in countCache:
+        return
+
+    # Every list reads live records, so that count is the one kept up to date
+    unfilteredShape = get_query_shape(recycle_bin.liveRecordQuery)
+    collectionCounts = countCache[collectionName]
+    for queryShape in list(collectionCounts):
+        if queryShape != unfilteredShape:
+            collectionCounts.pop(queryShape)
+
+
+def adjust_unfiltered_count(collectionName: str, change: int):
+    invalidate_filtered_counts(collectionName)
+
+    if collectionName not in countCache:
+        return
+
+    unfilteredShape = get_query_shape(recycle_bin.liveRecordQuery)
+    if unfilteredShape in countCache[collectionName]:
+        cachedCount = countCache[collectionName][unfilteredShape]
+        cachedCount['count'] = max(cachedCount['count'] + change, 0)
+
+
+def record_inserted(collectionName: str, count: int = 1):
+    adjust_unfiltered_count(collectionName, count)
+
+
+def record_deleted(collectionName: str, count: int = 1):
+    adjust_unfiltered_count(collectionName, -count)
@@ -0,0 +1,292 @@
+from bson.decimal128 import Decimal128
+from bson.binary import Binary
+import datetime
+import decimal
+import base64
+import struct
+
+# Decimal128 keeps its value as two 64 bit words, low word first in bid
+decimal128Words = struct.Struct('<QQ')
+decimal128SignMask = 1 << 63
+decimal128SpecialMask = 3 << 61
+decimal128ExponentBias = 6176
+decimal128MaxCoefficient = 10 ** 34 - 1
+
+
+def compile_object_encoder(fieldName: str, attributeEncoders: list):
+    def encode(requestData: dict) -> dict:
+        objectRequestData = requestData[fieldName] if fieldName in requestData else {}
+        fieldValue = {}
+        for attributeName, attributeEncoder in attributeEncoders:
+            fieldValue[attributeName] = attributeEncoder(objectRequestData)
+        return fieldValue
+
+    return encode
+
+
+def compile_required_object_encoder(moduleField: dict, attributeEncoders: list):
+    fieldName = moduleField['field_name']
+    requiredEncoders = {}
+
+    for requiredKey, requiredFields in moduleField['module_fields_required'].items():
+        requiredFields = set(requiredFields)
+        requiredEncoders[requiredKey] = compile_object_encoder(fieldName, [
+            (attributeName, attributeEncoder)
+            for attributeName, attributeEncoder in attributeEncoders
+            if attributeName in requiredFields])
+
+    # Special case to handle in Activity Module
+    if fieldName == 'record':
+        def encode(requestData: dict) -> dict:
+            relatedModule = requestData['related_to']['module_name']
+            if relatedModule not in requiredEncoders:
+                raise ValueError(
+                    'Related To Module (' + relatedModule + ') is not valid for Record.')
+
+            return requiredEncoders[relatedModule](requestData)
+
+    elif fieldName == 'contact_lead':
+        def encode(requestData: dict) -> dict:
+            contactLeadType = requestData['contact_lead_type']
+            if contactLeadType not in requiredEncoders:
+                raise ValueError(
+                    'Contact Type (' + contactLeadType + ') is not valid for Contact.')
+
+            return requiredEncoders[contactLeadType](requestData)
+
+    else:
+        def encode(requestData: dict) -> dict:
+            return {}
+
+    return encode
+
+
+def compile_encoder(moduleField: dict):
+    fieldName = moduleField['field_name']
+    bsonType = moduleField['bson_type']
+
+    if bsonType == 'int':
+        def encode(requestData: dict) -> any:
+            return requestData[fieldName] if fieldName in requestData else 0
+
+    elif bsonType == 'bool':
+        def encode(requestData: dict) -> any:
+            return requestData[fieldName] if fieldName in requestData else False
+
+    elif bsonType == 'decimal':
+        def encode(requestData: dict) -> any:
+            if fieldName in requestData:
+                return Decimal128(requestData[fieldName])
+            return Decimal128('0')
+
+    elif bsonType == 'date':
+        def encode(requestData: dict) -> any:
+            if fieldName in requestData:
+                return datetime.datetime.fromisoformat(requestData[fieldName])
+            return datetime.datetime(1, 1, 1)
+
+    elif bsonType == 'binData':
+        def encode(requestData: dict) -> any:
+            if fieldName in requestData:
+                return Binary(base64.b64decode(requestData[fieldName]))
+            return None
+
+    elif bsonType == 'object':
+        attributeEncoders = [
+            (objectField['field_name'], compile_encoder(objectField))
+            for objectField in moduleField['field_object_attribute']]
+
+        if 'module_fields_required' in moduleField:
+            encode = compile_required_object_encoder(
+                moduleField, attributeEncoders)
+        else:
+            encode = compile_object_encoder(fieldName, attributeEncoders)
+
+    elif bsonType == 'array':
+        elementEncoders = [
+            (objectField['field_name'], compile_encoder(objectField))
+            for objectField in moduleField['field_array_element']]
+
+        if len(elementEncoders) > 1:
+            def encode(requestData: dict) -> any:
+                arrayRequestData = requestData[fieldName] if fieldName in requestData else []
+                fieldValue = []
+                for elementData in arrayRequestData:
+                    objectData = {}
+                    for elementName, elementEncoder in elementEncoders:
+                        objectData[elementName] = elementEncoder(elementData)
+                    fieldValue.append(objectData)
+                return fieldValue
+        else:
+            def encode(requestData: dict) -> any:
+                return requestData[fieldName] if fieldName in requestData else []
+
+    else:
+        def encode(requestData: dict) -> any:
+            return requestData[fieldName] if fieldName in requestData else ''
+
+    return encode
+
+
+def compile_object_decoder(attributeDecoders: list, attributeRecordDecoders: list):
+    def decode(fieldValue: dict) -> dict:
+        for attributeName, attributeDecoder in attributeDecoders:
+            fieldValue[attributeName] = attributeDecoder(fieldValue[attributeName])
+        for attributeName, attributeDecoder in attributeRecordDecoders:
+            fieldValue[attributeName] = attributeDecoder(fieldValue)
+        return fieldValue
+
+    return decode
+
+
+def compile_required_object_decoder(moduleField: dict, attributeDecoders: list, attributeRecordDecoders: list):
+    fieldName = moduleField['field_name']
+    requiredDecoders = {}
+
+    for requiredKey, requiredFields in moduleField['module_fields_required'].items():
+        requiredFields = set(requiredFields)
+        requiredDecoders[requiredKey] = compile_object_decoder(
+            [(attributeName, attributeDecoder)
+             for attributeName, attributeDecoder in attributeDecoders
+             if attributeName in requiredFields],
+            [(attributeName, attributeDecoder)
+             for attributeName, attributeDecoder in attributeRecordDecoders
+             if attributeName in requiredFields])
+
+    # Special case to handle in Activity Module, the attributes depend on a
+    # sibling field so these decoders get the whole record
+    if fieldName == 'record':
+        def decode(record: dict) -> dict:
+            return requiredDecoders[record['related_to']['module_name']](record[fieldName])
+
+    elif fieldName == 'contact_lead':
+        def decode(record: dict) -> dict:
+            return requiredDecoders[record['contact_lead_type']](record[fieldName])
+
+    else:
+        return None
+
+    return decode
+
+
+# str(Decimal128) rebuilds the digits in pure Python, most of the time of a
+# list page went there. Plain finite values are read off the words here and
+# parsed by the C decimal module, the rest keep the bson conversion.
+def decode_decimal(fieldValue: Decimal128) -> str:
+    low, high = decimal128Words.unpack(fieldValue.bid)
+    if high & decimal128SpecialMask == decimal128SpecialMask:
+        return str(fieldValue)
+
+    coefficient = ((high & 0x1FFFFFFFFFFFF) << 64) | low
+    if coefficient > decimal128MaxCoefficient:
+        return str(fieldValue)
+
+    exponent = ((high & 0x7FFF800000000000) >> 49) - decimal128ExponentBias
+    return str(decimal.Decimal(('-' if high & decimal128SignMask else '') +
+                               str(coefficient) + 'E' + str(exponent)))
+
+
+def decode_bin_data(fieldValue: Binary) -> any:
+    if fieldValue is None:
+        return None
+    return base64.b64encode(fieldValue)
+
+
+# Decoders map a stored value to its output form, dates map straight to the
+# C isoformat so the common fields cost no Python frame.
+# A decoder of None means the stored value is already in its output form.
+def compile_decoder(moduleField: dict):
+    bsonType = moduleField['bson_type']
+
+    if bsonType == 'decimal':
+        return decode_decimal
+
+    elif bsonType == 'date':
+        return datetime.datetime.isoformat
+
+    elif bsonType == 'binData':
+        return decode_bin_data
+
+    elif bsonType == 'object':
+        attributeDecoders, attributeRecordDecoders = compile_decoders(moduleField['field_object_attribute'])
+
+        if len(attributeDecoders) == 0 and len(attributeRecordDecoders) == 0:
+            return None
+
+        return compile_object_decoder(attributeDecoders, attributeRecordDecoders)
+
+    elif bsonType == 'array':
+        if len(moduleField['field_array_element']) <= 1:
+            return None
+
+        elementDecoders, elementRecordDecoders = compile_decoders(moduleField['field_array_element'])
+
+        if len(elementDecoders) == 0 and len(elementRecordDecoders) == 0:
+            return None
+
+        decodeElement = compile_object_decoder(elementDecoders, elementRecordDecoders)
+
+        def decode(fieldValue: list) -> any:
+            for element in fieldValue:
+                decodeElement(element)
+            return fieldValue
+
+        return decode
+
+    return None
+
+
+# Objects whose attributes depend on a sibling field decode from the
+# containing record, they are kept apart from the value decoders
+def compile_decoders(moduleFields: list) -> tuple:
+    decoders = []
+    recordDecoders = []
+
+    for moduleField in moduleFields:
+        if moduleField['bson_type'] == 'object' and 'module_fields_required' in moduleField:
+            attributeDecoders, attributeRecordDecoders = compile_decoders(moduleField['field_object_attribute'])
+            if len(attributeDecoders) == 0 and len(attributeRecordDecoders) == 0:
+                continue
+
+            decoder = compile_required_object_decoder(moduleField, attributeDecoders, attributeRecordDecoders)
+            if decoder is not None:
+                recordDecoders.append((moduleField['field_name'], decoder))
+            continue
+
+        decoder = compile_decoder(moduleField)
+        if decoder is not None:
+            decoders.append((moduleField['field_name'], decoder))
+
+    return decoders, recordDecoders
+
+
+def compile_module_codec(moduleFields: list) -> dict:
+    codec = {}
+    codec['encoders'] = [(moduleField, compile_encoder(moduleField))
+                         for moduleField in moduleFields]
+    codec['decoders'], codec['record_decoders'] = compile_decoders(moduleFields)
+
+    return codec
+
+
+# Decoders for fields left out by a projection would fail on the missing keys
+def restrict_codec(codec: dict, fieldNames: dict) -> dict:
+    restrictedCodec = {}
+    restrictedCodec['encoders'] = codec['encoders']
+    restrictedCodec['decoders'] = [(fieldName, decoder) for fieldName, decoder in codec['decoders']
+                                   if fieldName in fieldNames]
+    restrictedCodec['record_decoders'] = [(fieldName, decoder) for fieldName, decoder in codec['record_decoders']
+                                          if fieldName in fieldNames]
+
+    return restrictedCodec
+
+
+def decode_record(codec: dict, record: dict) -> dict:
+    for fieldName, decoder in codec['decoders']:
+        record[fieldName] = decoder(record[fieldName])
+    for fieldName, decoder in codec['record_decoders']:
+        record[fieldName] = decoder(record)
+
+    record['_id'] = str(record['_id'])
+
+    return record
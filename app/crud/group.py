@@ -5,6 +5,7 @@ from ..core.config import (collectionGroup,
                            logger, mongoClient,
                            collectionSharingRule,
                            collectionBsonTypeFields)
+from . import count_cache
 
 groupSources = {'Users',
                 'Roles',
@@ -79,6 +80,7 @@ async def create_group(requestData: dict) -> dict:
         logger.debug(groupData)
 
         result = await collectionGroup.insert_one(groupData)
+        count_cache.record_inserted(collectionGroup.name)
 
         return {'message': 'New group record created.', 'id': str(result.inserted_id)}
     except Exception as e:
@@ -98,7 +100,7 @@ async def get_groups_list_with_options(start: int, length: int, search: str) ->
         if len(search) > 0:
             query['group_name'] = {'$regex': '^' + search, '$options': 'i'}
 
-        recordCount = await collectionGroup.count_documents(query)
+        recordCount = (await count_cache.get_count(collectionGroup, query))['count']
         groups = collectionGroup.find(query, projection={'group_name': 1, '_id': 0}).skip(
             start).limit(length).sort(sortFields)
 
@@ -114,7 +116,8 @@ async def get_groups_list_with_options(start: int, length: int, search: str) ->
                 'message': 'An error has occured.'}
 
 
-async def get_groups_list_for_datatable(start: int, length: int, sortBy: list, sortOrder: str, search: str) -> dict:
+async def get_groups_list_for_datatable(start: int, length: int, sortBy: list, sortOrder: str, search: str,
+                                        approximateCount: bool = False) -> dict:
     try:
         query = {}
         results = {'records': []}
@@ -141,7 +144,7 @@ async def get_groups_list_for_datatable(start: int, length: int, sortBy: list, s
                 i += 1
 
         # logger.debug(query)
-        recordCount = await collectionGroup.count_documents(query)
+        recordCount = await count_cache.get_count(collectionGroup, query, approximateCount)
         records = collectionGroup.find(
             query,
             projection={
@@ -165,8 +168,9 @@ async def get_groups_list_for_datatable(start: int, length: int, sortBy: list, s
         else:
             results['message'] = 'No record found.'
 
-        results['recordsFiltered'] = recordCount
-        results['recordsTotal'] = recordCount
+        results['recordsFiltered'] = recordCount['count']
+        results['recordsTotal'] = recordCount['count']
+        results['recordsApproximate'] = recordCount['approximate']
 
         return results
     except Exception as e:
@@ -254,6 +258,8 @@ async def update_group(recordId: str, requestData: dict) -> dict:
 
                     sharingRuleUpdateCount += resultSharingRuleUpdate.modified_count
 
+        count_cache.invalidate_filtered_counts(collectionGroup.name)
+
         selectedUpdateClause = ''
         sharingRuleUpdateClause = ''
         if resultSelectedUpdate is not None:
@@ -325,6 +331,8 @@ async def delete_group(recordId: str) -> dict:
 
                 sharingRuleUpdateCount += resultSharingRuleUpdate.modified_count
 
+        count_cache.record_deleted(collectionGroup.name)
+
         return {'message': '1 group deleted. This group deleted from ' +
                 str(resultSelectedDelete.modified_count) +
                 ' group records. This group is also deleted from ' +
@@ -0,0 +1,351 @@
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import asyncio
+import datetime
+import os
+import socket
+
+from ..core.config import logger, collectionJob
+from . import module, record_import, territory, relationship, recycle_bin, permission
+
+jobStatuses = {'queued', 'running', 'completed', 'failed', 'cancelled'}
+jobLeaseSeconds = 60
+jobPollIntervalSeconds = 2
+jobRetryDelaySeconds = 30
+jobDefaultMaxAttempts = 3
+jobPageLimit = 100
+jobWorkerState = {'tasks': [], 'stopping': False}
+
+
+async def run_territory_rules(payload: dict, reportProgress) -> dict:
+    return await territory.run_rules()
+
+
+async def run_module_import(payload: dict, reportProgress) -> dict:
+    await record_import.run_import_job(payload['import_job_id'], payload['module_name'],
+                                       payload['file_path'], payload['column_map'], payload['activity_types'],
+                                       reportProgress)
+    return {'message': payload['module_name'] + ' import ' + payload['import_job_id'] + ' finished.'}
+
+
+async def run_module_schema_migration(payload: dict, reportProgress) -> dict:
+    await module.run_schema_migration(payload['migration_id'], payload['module_names'], reportProgress)
+    return {'message': 'Schema migration ' + payload['migration_id'] + ' finished.'}
+
+
+async def run_module_reconcile_indexes(payload: dict, reportProgress) -> dict:
+    return await module.reconcile_module_indexes()
+
+
+async def run_module_relationship_migration(payload: dict, reportProgress) -> dict:
+    return await relationship.migrate_embedded_relationships(
+        payload['module_name'], payload['field_name'], reportProgress)
+
+
+async def run_module_mass_update(payload: dict, reportProgress) -> dict:
+    return await module.mass_update_records(
+        payload['module_name'], payload['request_data'],
+        payload['activity_types'] if 'activity_types' in payload else None, reportProgress)
+
+
+async def run_module_bulk_delete(payload: dict, reportProgress) -> dict:
+    return await module.delete_records_in_bulk(
+        payload['module_name'], payload['request_data'],
+        payload['activity_types'] if 'activity_types' in payload else None, reportProgress)
+
+
+async def run_module_recycle_bin_purge(payload: dict, reportProgress) -> dict:
+    return await recycle_bin.purge_recycle_bin()
+
+
+# Every job type a worker can run. A handler gets the job payload and a
+# coroutine to report progress with, and returns the usual result dict.
+jobHandlers = {
+    'territory.run_rules': run_territory_rules,
+    'module.import': run_module_import,
+    'module.schema_migration': run_module_schema_migration,
+    'module.reconcile_indexes': run_module_reconcile_indexes,
+    'module.relationship_migration': run_module_relationship_migration,
+    'module.mass_update': run_module_mass_update,
+    'module.bulk_delete': run_module_bulk_delete,
+    'module.recycle_bin_purge': run_module_recycle_bin_purge
+}
+
+
+def format_job(jobDoc: dict) -> dict:
+    jobDoc['_id'] = str(jobDoc['_id'])
+    for dateField in ['created_at', 'run_at', 'started_at', 'finished_at', 'lease_until']:
+        if dateField in jobDoc and jobDoc[dateField] is not None:
+            jobDoc[dateField] = jobDoc[dateField].isoformat()
+
+    return jobDoc
+
+
+# A singleton job type is queued at most once, asking again returns the
+# job that is already waiting or running. The job holds singleton_key until
+# it finishes, and the unique index on it settles concurrent enqueues.
+async def enqueue_job(jobType: str, payload: dict, createdBy: str = 'system_default',
+                      maxAttempts: int = jobDefaultMaxAttempts, singleton: bool = False,
+                      runAt: datetime.datetime = None) -> dict:
+    try:
+        if jobType not in jobHandlers:
+            return {'type': 'error', 'message': 'Job type ' + jobType + ' is not known.'}
+
+        createdAt = datetime.datetime.now()
+        jobDoc = {
+            'type': jobType,
+            'payload': payload,
+            'status': 'queued',
+            'attempts': 0,
+            'max_attempts': maxAttempts,
+            'progress': {},
+            'run_at': runAt if runAt is not None else createdAt,
+            'lease_until': None,
+            'created_by': createdBy,
+            'created_at': createdAt
+        }
+        if singleton:
+            jobDoc['singleton_key'] = jobType
+
+        try:
+            result = await collectionJob.insert_one(jobDoc)
+        except DuplicateKeyError:
+            activeJob = await collectionJob.find_one({'singleton_key': jobType}, projection={'status': 1})
+
+            # The active job may have finished in between, the next ask queues a new one
+            if activeJob is None:
+                return {'type': 'error', 'message': jobType + ' job could not be queued, try again.'}
+
+            return {
+                'id': str(activeJob['_id']),
+                'message': jobType + ' job is already ' + activeJob['status'] + '.'
+            }
+
+        return {'id': str(result.inserted_id), 'message': jobType + ' job has been queued.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+# Queued jobs that are due, and running jobs whose worker stopped renewing
+# the lease, are both up for grabs. find_one_and_update hands each to one worker.
+async def lease_job(workerId: str) -> dict:
+    now = datetime.datetime.now()
+
+    return await collectionJob.find_one_and_update(
+        {'$or': [
+            {'status': 'queued', 'run_at': {'$lte': now}},
+            {'status': 'running', 'lease_until': {'$lt': now}}
+        ]},
+        {
+            '$set': {
+                'status': 'running',
+                'worker_id': workerId,
+                'lease_until': now + datetime.timedelta(seconds=jobLeaseSeconds),
+                'started_at': now
+            },
+            '$inc': {'attempts': 1}
+        },
+        sort=[('run_at', 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def renew_job_lease(jobId: ObjectId, workerId: str):
+    while True:
+        await asyncio.sleep(jobLeaseSeconds / 3)
+        await collectionJob.update_one(
+            {'_id': jobId, 'worker_id': workerId, 'status': 'running'},
+            {'$set': {'lease_until': datetime.datetime.now() + datetime.timedelta(seconds=jobLeaseSeconds)}})
+
+
+async def finish_job(job: dict, workerId: str, updateData: dict):
+    updateData['finished_at'] = datetime.datetime.now()
+    updateData['lease_until'] = None
+
+    # A worker that lost its lease leaves the job to the one that took it over
+    await collectionJob.update_one(
+        {'_id': job['_id'], 'worker_id': workerId, 'status': 'running'},
+        {'$set': updateData, '$unset': {'singleton_key': ''}})
+
+
+async def fail_job_attempt(job: dict, workerId: str, message: str, retry: bool):
+    if retry and job['attempts'] < job['max_attempts']:
+        # Back off a little longer after every failed attempt
+        retryDelay = jobRetryDelaySeconds * 2 ** (job['attempts'] - 1)
+        await collectionJob.update_one(
+            {'_id': job['_id'], 'worker_id': workerId, 'status': 'running'},
+            {'$set': {
+                'status': 'queued',
+                'message': message,
+                'lease_until': None,
+                'run_at': datetime.datetime.now() + datetime.timedelta(seconds=retryDelay)
+            }})
+        return
+
+    await finish_job(job, workerId, {'status': 'failed', 'message': message})
+
+
+async def run_job(job: dict, workerId: str):
+    if job['attempts'] > job['max_attempts']:
+        await finish_job(job, workerId, {'status': 'failed', 'message': 'The job lease expired too often.'})
+        return
+
+    async def reportProgress(progress: dict):
+        await collectionJob.update_one(
+            {'_id': job['_id'], 'worker_id': workerId}, {'$set': {'progress': progress}})
+
+    leaseRenewal = asyncio.ensure_future(renew_job_lease(job['_id'], workerId))
+    try:
+        result = await jobHandlers[job['type']](job['payload'], reportProgress)
+
+        # Errors come from the request data and fail the same way every time,
+        # exceptions may be passing (a lost connection) and are retried
+        if 'type' in result and result['type'] in {'error', 'exception'}:
+            await fail_job_attempt(job, workerId, result['message'] if result['type'] == 'error'
+                                   else result['errorType'] + ': ' + result['errorMessage'],
+                                   result['type'] == 'exception')
+        else:
+            await finish_job(job, workerId, {'status': 'completed', 'result': result})
+
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        await fail_job_attempt(job, workerId, str(type(e).__name__) + ': ' + str(e), True)
+
+    finally:
+        leaseRenewal.cancel()
+
+
+async def run_job_worker(workerId: str):
+    while not jobWorkerState['stopping']:
+        try:
+            job = await lease_job(workerId)
+        except Exception as e:
+            logger.error(str(type(e).__name__) + ': ' + str(e))
+            job = None
+
+        if job is None:
+            await asyncio.sleep(jobPollIntervalSeconds)
+            continue
+
+        logger.debug(workerId + ' running ' + job['type'] + ' job ' + str(job['_id']) + '.')
+        await run_job(job, workerId)
+
+
+# Concurrency bounds how many jobs this process runs at the same time
+def start_job_workers(concurrency: int) -> list:
+    jobWorkerState['stopping'] = False
+    workerPrefix = socket.gethostname() + ':' + str(os.getpid()) + ':'
+
+    for workerNumber in range(concurrency):
+        jobWorkerState['tasks'].append(
+            asyncio.ensure_future(run_job_worker(workerPrefix + str(workerNumber))))
+
+    return jobWorkerState['tasks']
+
+
+# Running jobs are cancelled, their lease runs out and another worker retries them
+async def stop_job_workers():
+    jobWorkerState['stopping'] = True
+
+    for task in jobWorkerState['tasks']:
+        task.cancel()
+    await asyncio.gather(*jobWorkerState['tasks'], return_exceptions=True)
+
+    jobWorkerState['tasks'] = []
+
+
+async def get_job(jobId: str) -> dict:
+    try:
+        if not ObjectId.is_valid(jobId):
+            return {'type': 'error', 'message': 'Job id is not valid.'}
+
+        jobDoc = await collectionJob.find_one({'_id': ObjectId(jobId)}, projection={'payload': 0})
+
+        if jobDoc is None:
+            return {'type': 'error', 'message': 'No job found for the provided job Id.'}
+
+        return {'job': format_job(jobDoc), 'message': 'Job retrieved successfully.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def get_jobs_list(start: int, length: int, status: str = None, jobType: str = None) -> dict:
+    try:
+        if length < 1 or length > jobPageLimit:
+            return {
+                'type': 'error',
+                'message': 'Length has to be between 1 and ' + str(jobPageLimit) + '.'
+            }
+
+        query = {}
+        if status:
+            if status not in jobStatuses:
+                return {
+                    'type': 'error',
+                    'message': 'Status has to be one of ' + str(sorted(jobStatuses)) + '.'
+                }
+            query['status'] = status
+
+        if jobType:
+            query['type'] = jobType
+
+        jobs = await collectionJob.find(query, projection={'payload': 0}) \
+            .sort([('created_at', -1)]).skip(start).limit(length).to_list(length)
+        recordsTotal = await collectionJob.count_documents(query)
+
+        return {
+            'jobs': [format_job(jobDoc) for jobDoc in jobs],
+            'recordsTotal': recordsTotal,
+            'message': 'Jobs retrieved successfully.' if len(jobs) > 0 else 'No job found.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def cancel_job(jobId: str, currentUser: dict) -> dict:
+    try:
+        if not ObjectId.is_valid(jobId):
+            return {'type': 'error', 'message': 'Job id is not valid.'}
+
+        # Only jobs no worker has picked up yet can be cancelled, by the user
+        # who queued them or an administrator
+        jobFilter = {'_id': ObjectId(jobId), 'status': 'queued'}
+        if not permission.is_administrator(currentUser['profile']):
+            jobFilter['created_by'] = currentUser['email']
+
+        result = await collectionJob.update_one(
+            jobFilter,
+            {'$set': {'status': 'cancelled', 'finished_at': datetime.datetime.now()},
+             '$unset': {'singleton_key': ''}})
+
+        if result.modified_count == 0:
+            return {'type': 'error', 'message': 'No queued job of yours found for the provided job Id.'}
+
+        return {'message': 'Job cancelled.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
@@ -1,12 +1,28 @@
+import asyncio
+import time
+
 from ..core.config import (logging, logger, collectionProfile,
                            collectionModuleFields, dictProfiles,
                            moduleFieldTypes, moduleBsonFieldTypes,
                            moduleTypeFields, moduleUniqueFields,
-                           moduleBsonTypeFields, collectionBsonTypeFields)
+                           moduleBsonTypeFields, collectionBsonTypeFields,
+                           moduleSchemas, moduleSchemaVersion)
+from .field_codec import compile_module_codec
+from . import permission
+from ..db.setup_collection import get_text_index_fields, regexSearchPolicy
+from ..db import schema_migration
 
 # from ..database import crmDB
 
 
+# Readers hold references to the shared dicts, so they are refilled rather
+# than rebound. Callers build everything first and swap without an await
+# in between, readers never see them half filled.
+def swap_dict(target: dict, source: dict):
+    target.clear()
+    target.update(source)
+
+
 async def load_logger():
     logger.setLevel(logging.DEBUG)
 
@@ -22,19 +38,22 @@ async def load_logger():
 
 
 async def load_profiles():
-    dictProfiles.clear()
+    profiles = {}
 
     async for profile in collectionProfile.find():
         profile['_id'] = str(profile['_id'])
         # logger.debug(profile['_id'])
-        dictProfiles[profile['profile_name']] = profile
+        profiles[profile['profile_name']] = profile
+
+    swap_dict(dictProfiles, profiles)
+    permission.compile_permission_matrix()
 
     logger.debug('Profiles loaded.')
     # logger.debug(dictProfiles)
 
 
-async def load_module_field_types():
-    moduleFieldTypes.clear()
+async def build_module_field_types() -> dict:
+    result = {}
 
     async for module in collectionModuleFields.find({'type': 'module', 'module_name': {'$ne': 'Activity'}}, projection={
         'module_name': 1, 'module_fields.field_name': 1,
@@ -43,14 +62,20 @@ async def load_module_field_types():
 
         for moduleField in module['module_fields']:
             fieldTypes[moduleField['field_name']] = moduleField['field_type']
-        moduleFieldTypes[module['module_name']] = fieldTypes
+        result[module['module_name']] = fieldTypes
 
     logger.debug('Field->Types loaded.')
     # logger.debug(moduleFieldTypes)
 
+    return result
+
+
+async def load_module_field_types():
+    swap_dict(moduleFieldTypes, await build_module_field_types())
 
-async def load_module_bson_field_types():
-    moduleBsonFieldTypes.clear()
+
+async def build_module_bson_field_types() -> dict:
+    result = {}
 
     async for module in collectionModuleFields.find({'type': 'module', 'module_name': {'$ne': 'Activity'}}, projection={
         'module_name': 1, 'module_fields.field_name': 1,
@@ -59,14 +84,20 @@ async def load_module_bson_field_types():
 
         for moduleField in module['module_fields']:
             fieldTypes[moduleField['field_name']] = moduleField['bson_type']
-        moduleBsonFieldTypes[module['module_name']] = fieldTypes
+        result[module['module_name']] = fieldTypes
 
     logger.debug('Field->BsonTypes loaded.')
     # logger.debug(moduleBsonFieldTypes)
 
+    return result
 
-async def load_module_type_fields():
-    moduleTypeFields.clear()
+
+async def load_module_bson_field_types():
+    swap_dict(moduleBsonFieldTypes, await build_module_bson_field_types())
+
+
+async def build_module_type_fields() -> dict:
+    result = {}
 
     async for module in collectionModuleFields.find({'type': 'module', 'module_name': {'$ne': 'Activity'}}, projection={
         'module_name': 1, 'module_fields.field_name': 1,
@@ -80,25 +111,37 @@ async def load_module_type_fields():
             else:
                 typeFields[moduleField['field_type']] = [
                     moduleField['field_name']]
-        moduleTypeFields[module['module_name']] = typeFields
+        result[module['module_name']] = typeFields
 
     logger.debug('Type->Fields loaded.')
     # logger.debug(moduleTypeFields)
 
+    return result
 
-async def load_module_unique_fields():
-    moduleUniqueFields.clear()
+
+async def load_module_type_fields():
+    swap_dict(moduleTypeFields, await build_module_type_fields())
+
+
+async def build_module_unique_fields() -> dict:
+    result = {}
 
     async for module in collectionModuleFields.find(
             {'type': 'module'}, projection={'module_name': 1, 'unique_fields': 1, '_id': 0}):
-        moduleUniqueFields[module['module_name']] = module['unique_fields']
+        result[module['module_name']] = module['unique_fields']
 
     logger.debug('Module->Unique Fields loaded.')
     # logger.debug(moduleUniqueFields)
 
+    return result
 
-async def load_module_bson_type_fields():
-    moduleBsonTypeFields.clear()
+
+async def load_module_unique_fields():
+    swap_dict(moduleUniqueFields, await build_module_unique_fields())
+
+
+async def build_module_bson_type_fields() -> dict:
+    result = {}
 
     async for module in collectionModuleFields.find({'type': 'module', 'module_name': {'$ne': 'Activity'}}, projection={
             '_id': 0}):
@@ -134,12 +177,18 @@ async def load_module_bson_type_fields():
 
         # logger.debug(module['module_name'] + ': ' + str(typeFields))
 
-        moduleBsonTypeFields[module['module_name']] = typeFields
+        result[module['module_name']] = typeFields
     logger.debug('BsonType->Fields for modules loaded.')
 
+    return result
 
-async def load_collection_bson_type_fields():
-    collectionBsonTypeFields.clear()
+
+async def load_module_bson_type_fields():
+    swap_dict(moduleBsonTypeFields, await build_module_bson_type_fields())
+
+
+async def build_collection_bson_type_fields() -> dict:
+    result = {}
 
     async for collection in collectionModuleFields.find({'type': 'collection'}, projection={
             '_id': 0}):
@@ -175,17 +224,103 @@ async def load_collection_bson_type_fields():
 
         # logger.debug(collection['collection_name'] + ': ' + str(typeFields))
 
-        collectionBsonTypeFields[collection['collection_name']] = typeFields
+        result[collection['collection_name']] = typeFields
     logger.debug('BsonType->Fields for collections loaded.')
 
+    return result
+
+
+async def load_collection_bson_type_fields():
+    swap_dict(collectionBsonTypeFields, await build_collection_bson_type_fields())
+
+
+async def build_module_schemas() -> dict:
+    schemas = {}
+
+    async for module in collectionModuleFields.find({'type': 'module'}, projection={
+            'module_name': 1, 'module_fields': 1, 'module_sections': 1,
+            'unique_fields': 1, '_id': 0}):
+        schema = {}
+        schema['module_fields'] = module['module_fields']
+        schema['module_sections'] = module['module_sections'] if 'module_sections' in module else []
+        schema['unique_fields'] = module['unique_fields']
+
+        if module['module_name'] == 'Activity':
+            activityFields = module['module_fields'][1]['activity_fields']
+            schema['activity_fields'] = {
+                'Task': activityFields['task_fields'],
+                'Event': activityFields['event_fields'],
+                'Call': activityFields['call_fields']
+            }
+            schema['activity_codecs'] = {}
+            searchFields = []
+            for activityType in schema['activity_fields']:
+                schema['activity_codecs'][activityType] = compile_module_codec(
+                    schema['activity_fields'][activityType])
+                searchFields.extend(schema['activity_fields'][activityType])
+        else:
+            schema['codec'] = compile_module_codec(module['module_fields'])
+            searchFields = module['module_fields']
+
+        # String fields searched with regex, undeclared ones included, and the
+        # fields the text index is built on, only those declared searchable
+        schema['search_fields'] = get_text_index_fields(searchFields, regexSearchPolicy)
+        schema['text_search_fields'] = get_text_index_fields(searchFields)
+
+        schemas[module['module_name']] = schema
+
+    return schemas
+
+
+async def load_module_data():
+    # Read first, a migration finishing during the build shows up on the next check
+    storedVersion = await schema_migration.get_schema_version()
+    fieldTypes = await build_module_field_types()
+    bsonFieldTypes = await build_module_bson_field_types()
+    typeFields = await build_module_type_fields()
+    uniqueFields = await build_module_unique_fields()
+    bsonTypeFields = await build_module_bson_type_fields()
+    schemas = await build_module_schemas()
+
+    # Swap in one step so readers never see a partially loaded registry
+    swap_dict(moduleFieldTypes, fieldTypes)
+    swap_dict(moduleBsonFieldTypes, bsonFieldTypes)
+    swap_dict(moduleTypeFields, typeFields)
+    swap_dict(moduleUniqueFields, uniqueFields)
+    swap_dict(moduleBsonTypeFields, bsonTypeFields)
+    swap_dict(moduleSchemas, schemas)
+    moduleSchemaVersion['version'] += 1
+    moduleSchemaVersion['stored_version'] = storedVersion
+    moduleSchemaVersion['loaded_at'] = time.monotonic()
+    moduleSchemaVersion['checked_at'] = moduleSchemaVersion['loaded_at']
+
+    logger.debug('Module schemas loaded (version ' +
+                 str(moduleSchemaVersion['version']) + ').')
+
+
+# Lookups of unknown module names share one reload
+async def reload_module_data():
+    reloadTask = moduleSchemaVersion['reload_task']
+    if reloadTask is None or reloadTask.done():
+        reloadTask = asyncio.ensure_future(load_module_data())
+        moduleSchemaVersion['reload_task'] = reloadTask
+
+    await asyncio.shield(reloadTask)
+
+
+# Migrations and reloads in other processes bump the stored version
+async def check_module_data_version():
+    moduleSchemaVersion['checked_at'] = time.monotonic()
+    try:
+        if await schema_migration.get_schema_version() != moduleSchemaVersion['stored_version']:
+            await reload_module_data()
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+
 
 async def load_local_data():
     # await load_logger()
     await load_profiles()
-    await load_module_field_types()
-    await load_module_bson_field_types()
-    await load_module_type_fields()
-    await load_module_unique_fields()
-    await load_module_bson_type_fields()
+    await load_module_data()
     await load_collection_bson_type_fields()
     return
@@ -0,0 +1,179 @@
+from bson.objectid import ObjectId
+import asyncio
+
+from ..core.config import logger, database, moduleSchemas
+from . import module, field_codec, recycle_bin, permission
+
+# Required object fields of Activity name their target module in another field
+moduleFieldTargets = {
+    'record': lambda record: record['related_to']['module_name'],
+    'contact_lead': lambda record: record['contact_lead_type']
+}
+
+
+def get_id_paths(moduleFields: list) -> list:
+    idPaths = []
+
+    for moduleField in moduleFields:
+        fieldName = moduleField['field_name']
+
+        if moduleField['bson_type'] == 'object' or moduleField['bson_type'] == 'array':
+            objectFields = moduleField['field_object_attribute'] if moduleField['bson_type'] == 'object' \
+                else moduleField['field_array_element']
+
+            for objectField in objectFields:
+                if objectField['field_name'][-3:] == '_id' and (fieldName, objectField['field_name']) not in idPaths:
+                    idPaths.append((fieldName, objectField['field_name']))
+
+        elif fieldName[-3:] == '_id' and (fieldName, None) not in idPaths:
+            idPaths.append((fieldName, None))
+
+    return idPaths
+
+
+def get_module_id_paths(moduleName: str, moduleSchema: dict) -> list:
+    # Cached on the schema, a schema reload swaps in fresh dicts
+    if 'id_paths' not in moduleSchema:
+        if moduleName == 'Activity':
+            moduleFields = []
+            for activityFields in moduleSchema['activity_fields'].values():
+                moduleFields.extend(activityFields)
+        else:
+            moduleFields = moduleSchema['module_fields']
+
+        moduleSchema['id_paths'] = get_id_paths(moduleFields)
+
+    return moduleSchema['id_paths']
+
+
+def get_module_name_for_id(idName: str) -> str:
+    # account_id -> Account, sales_order_id -> Sales Order / SalesOrder
+    normalizedName = idName[:-3].replace('_', '').lower()
+
+    for moduleName in moduleSchemas:
+        if moduleName.replace(' ', '').replace('_', '').lower() == normalizedName:
+            return moduleName
+
+    return None
+
+
+def get_path_ids(record: dict, fieldName: str, attributeName: str) -> list:
+    if fieldName not in record or record[fieldName] is None:
+        return []
+
+    fieldValue = record[fieldName]
+
+    if attributeName is None:
+        return [fieldValue]
+
+    if isinstance(fieldValue, dict):
+        return [fieldValue[attributeName]] if attributeName in fieldValue else []
+
+    ids = []
+    for element in fieldValue:
+        if isinstance(element, dict):
+            if attributeName in element:
+                ids.append(element[attributeName])
+        else:
+            ids.append(element)
+
+    return ids
+
+
+def get_path_target(record: dict, fieldName: str, attributeName: str) -> str:
+    if fieldName in moduleFieldTargets:
+        try:
+            return moduleFieldTargets[fieldName](record)
+        except (KeyError, TypeError):
+            return None
+
+    return get_module_name_for_id(attributeName if attributeName is not None else fieldName)
+
+
+async def get_display_records(targetModuleName: str, recordIds: set, activityTypes: list = None) -> dict:
+    targetSchema = await module.get_module_schema(targetModuleName)
+    displayFields = targetSchema['unique_fields']
+
+    projection = {fieldName: 1 for fieldName in displayFields}
+    if targetModuleName == 'Activity':
+        projection['activity_type'] = 1
+
+    objectIds = [ObjectId(recordId) for recordId in recordIds if ObjectId.is_valid(recordId)]
+    collection = database.get_collection('module_' + targetModuleName)
+
+    query = recycle_bin.get_live_record_query()
+    query['_id'] = {'$in': objectIds}
+    if activityTypes is not None:
+        query['activity_type'] = {'$in': activityTypes}
+
+    displayRecords = {}
+    async for displayRecord in collection.find(query, projection=projection):
+        activityType = displayRecord['activity_type'] if targetModuleName == 'Activity' else None
+        moduleCodec = module.get_module_codec(targetSchema, activityType, projection)
+        field_codec.decode_record(moduleCodec, displayRecord)
+        displayRecords[displayRecord['_id']] = displayRecord
+
+    return displayRecords
+
+
+# One $in query per referenced module for the whole page, the display
+# fields end up under record['expanded'] keyed by the id path. References
+# into modules the profile cannot view resolve to None.
+async def expand_records(moduleName: str, records: list, profileName: str):
+    moduleSchema = await module.get_module_schema(moduleName)
+    idPaths = get_module_id_paths(moduleName, moduleSchema)
+
+    if len(idPaths) == 0 or len(records) == 0:
+        return
+
+    targetIds = {}
+    recordTargets = []
+    for record in records:
+        pathTargets = []
+        for fieldName, attributeName in idPaths:
+            ids = get_path_ids(record, fieldName, attributeName)
+            if len(ids) == 0:
+                continue
+
+            targetModuleName = get_path_target(record, fieldName, attributeName)
+            if targetModuleName is None or targetModuleName not in moduleSchemas:
+                continue
+
+            if targetModuleName not in targetIds:
+                targetIds[targetModuleName] = set()
+            targetIds[targetModuleName].update([str(recordId) for recordId in ids])
+            pathTargets.append((fieldName, attributeName, targetModuleName, ids))
+
+        recordTargets.append(pathTargets)
+
+    displayRecords = {targetModuleName: {} for targetModuleName in targetIds}
+    targetModuleNames = [targetModuleName for targetModuleName in targetIds
+                         if permission.is_operation_allowed(profileName, targetModuleName, 'view')]
+    results = await asyncio.gather(
+        *[get_display_records(targetModuleName, targetIds[targetModuleName],
+                              permission.get_allowed_activity_types(profileName, 'view')
+                              if targetModuleName == 'Activity' else None)
+          for targetModuleName in targetModuleNames],
+        return_exceptions=True)
+
+    for targetModuleName, result in zip(targetModuleNames, results):
+        if isinstance(result, Exception):
+            logger.error(str(type(result).__name__) + ': ' + str(result))
+            result = {}
+        displayRecords[targetModuleName] = result
+
+    for record, pathTargets in zip(records, recordTargets):
+        expanded = {}
+        for fieldName, attributeName, targetModuleName, ids in pathTargets:
+            path = fieldName if attributeName is None else fieldName + '.' + attributeName
+            displays = [displayRecords[targetModuleName][str(recordId)]
+                        if str(recordId) in displayRecords[targetModuleName] else None
+                        for recordId in ids]
+
+            # Lists stay lists, single references resolve to a single record
+            if isinstance(record[fieldName], list):
+                expanded[path] = displays
+            else:
+                expanded[path] = displays[0]
+
+        record['expanded'] = expanded
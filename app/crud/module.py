@@ -1,16 +1,29 @@
 from bson.decimal128 import Decimal128
-from bson.binary import Binary
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
 import bson
 import datetime
-import base64
+import time
 
 from ..core.config import (logger, database, collectionModuleFields,
-                           moduleTypeFields, moduleFieldTypes,
-                           moduleUniqueFields, moduleBsonTypeFields,
-                           mongoClient)
-from ..db import setup_collection
-from . import attachment
+                           moduleTypeFields,
+                           moduleBsonTypeFields,
+                           moduleSchemas, moduleSchemaVersion, mongoClient)
+from ..db import setup_collection, schema_migration
+from . import (attachment, local_data, field_codec, pagination, count_cache,
+               record_export, relationship, lookup, change_feed, recycle_bin, job_queue)
+
+searchModes = {'text', 'regex'}
+bulkInsertChunkSize = 1000
+bulkInsertMaxChunkSize = 10000
+updateModes = {'transaction', 'single'}
+bulkDeleteChunkSize = 1000
+deleteModes = {'soft', 'permanent'}
+# Unknown module names reload the registry at most this often
+moduleSchemaMissReloadSeconds = 30
+# How often the stored schema version is compared with the loaded one
+moduleSchemaVersionTtlSeconds = 30
 
 
 async def create_module_collections():
@@ -29,154 +42,224 @@ async def get_module_list():
     return result
 
 
-async def get_module_fields_list(moduleName: str) -> dict:
-    moduleFieldsDoc = await collectionModuleFields.find_one(
-        {'type': 'module', 'module_name': moduleName},
-        projection={'module_fields': 1, 'module_sections': 1, '_id': 0})
+async def get_module_schema(moduleName: str) -> dict:
+    if time.monotonic() - moduleSchemaVersion['checked_at'] > moduleSchemaVersionTtlSeconds:
+        await local_data.check_module_data_version()
+
+    if moduleName not in moduleSchemas \
+            and time.monotonic() - moduleSchemaVersion['loaded_at'] > moduleSchemaMissReloadSeconds:
+        await local_data.reload_module_data()
+
+    if moduleName not in moduleSchemas:
+        return None
+
+    return moduleSchemas[moduleName]
+
+
+async def reload_module_schemas() -> dict:
+    try:
+        # Other processes reload on their next version check
+        await schema_migration.bump_schema_version()
+        await local_data.load_module_data()
 
-    if moduleFieldsDoc is None:
+        return {'message': str(len(moduleSchemas)) + ' module schemas reloaded.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
         return {
-            'type': 'error',
-            'message': 'Module ' + moduleName + ' is not present in the system.'
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
         }
 
-    result = {}
-    result['module_fields'] = []
-    result['module_sections'] = []
-    if moduleFieldsDoc is not None:
-        if 'module_fields' in moduleFieldsDoc:
-            result['module_fields'] = moduleFieldsDoc['module_fields']
 
-        if 'module_sections' in moduleFieldsDoc:
-            result['module_sections'] = moduleFieldsDoc['module_sections']
+async def reconcile_module_indexes() -> dict:
+    try:
+        results = await setup_collection.reconcile_module_indexes()
+        await local_data.load_module_data()
 
-    return result
+        return {'modules': results, 'message': 'Indexes of ' + str(len(results)) + ' modules reconciled.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
 
 
-async def get_field_value(moduleField: dict, requestData: dict) -> any:
-    fieldValue = None
-
-    if moduleField['bson_type'] == 'int':
-        fieldValue = 0
-        if moduleField['field_name'] in requestData:
-            fieldValue = requestData[moduleField['field_name']]
-
-    elif moduleField['bson_type'] == 'bool':
-        fieldValue = False
-        if moduleField['field_name'] in requestData:
-            fieldValue = requestData[moduleField['field_name']]
-
-    elif moduleField['bson_type'] == 'decimal':
-        fieldValue = Decimal128('0')
-        if moduleField['field_name'] in requestData:
-            fieldValue = Decimal128(
-                requestData[moduleField['field_name']])
-
-    elif moduleField['bson_type'] == 'date':
-        fieldValue = datetime.datetime(1, 1, 1)
-        if moduleField['field_name'] in requestData:
-            fieldValue = datetime.datetime.fromisoformat(
-                requestData[moduleField['field_name']])
-
-    elif moduleField['bson_type'] == 'binData':
-        if moduleField['field_name'] in requestData:
-            fieldValue = Binary(base64.b64decode(
-                requestData[moduleField['field_name']]))
-
-    elif moduleField['bson_type'] == 'object':
-        fieldValue = {}
-        objectRequestData = {}
-
-        if moduleField['field_name'] in requestData:
-            objectRequestData = requestData[moduleField['field_name']]
-
-        # Special case to handle in Activity Module
-        if 'module_fields_required' in moduleField:
-            if moduleField['field_name'] == 'record':
-                if requestData['related_to']['module_name'] not in moduleField['module_fields_required']:
-                    raise ValueError(
-                        'Related To Module (' + requestData['related_to']['module_name'] + ') is not valid for Record.')
-
-                for objectField in moduleField['field_object_attribute']:
-                    if objectField['field_name'] not in moduleField['module_fields_required'][requestData['related_to']['module_name']]:
-                        continue
-                    fieldValue[objectField['field_name']] = await get_field_value(
-                        objectField, objectRequestData)
-
-            elif moduleField['field_name'] == 'contact_lead':
-                if requestData['contact_lead_type'] not in moduleField['module_fields_required']:
-                    raise ValueError(
-                        'Contact Type (' + requestData['contact_lead_type'] + ') is not valid for Contact.')
-
-                for objectField in moduleField['field_object_attribute']:
-                    if objectField['field_name'] not in moduleField['module_fields_required'][requestData['contact_lead_type']]:
-                        continue
-                    fieldValue[objectField['field_name']] = await get_field_value(
-                        objectField, objectRequestData)
-        # Normal case
-        else:
-            for objectField in moduleField['field_object_attribute']:
-                fieldValue[objectField['field_name']] = await get_field_value(
-                    objectField, objectRequestData)
-
-    elif moduleField['bson_type'] == 'array':
-        fieldValue = []
-        arrayRequestData = []
-        if moduleField['field_name'] in requestData:
-            arrayRequestData = requestData[moduleField['field_name']]
-        if len(moduleField['field_array_element']) > 1 and len(arrayRequestData) > 0:
-            for elementData in arrayRequestData:
-                objectData = {}
-                for objectField in moduleField['field_array_element']:
-                    objectData[objectField['field_name']] = await get_field_value(objectField, elementData)
-
-                fieldValue.append(objectData)
-        else:
-            fieldValue = arrayRequestData
+async def diff_module_schemas(moduleNames: list = None) -> dict:
+    try:
+        modules = await schema_migration.diff_modules(moduleNames)
+
+        return {'modules': modules, 'message': str(len([module for module in modules if module['changed']])) +
+                ' of ' + str(len(modules)) + ' modules differ from their definition.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def create_schema_migration(moduleNames: list = None, createdBy: str = 'system_default') -> dict:
+    try:
+        activeMigration = await schema_migration.get_active_migration()
+
+        if activeMigration is not None:
+            return {
+                'type': 'error',
+                'message': 'Schema migration ' + str(activeMigration['_id']) + ' is still ' + activeMigration['status'] + '.'
+            }
+
+        migrationId = await schema_migration.create_migration(moduleNames, createdBy)
+        if migrationId is None:
+            return {'type': 'error', 'message': 'Another schema migration has just been queued.'}
+
+        jobResult = await job_queue.enqueue_job(
+            'module.schema_migration', {'migration_id': str(migrationId), 'module_names': moduleNames},
+            createdBy, maxAttempts=1)
+        if 'type' in jobResult:
+            # Without a job nothing would ever run it or let it go
+            await schema_migration.fail_stale_migration(
+                {'_id': migrationId, 'status': 'queued'}, 'The schema migration job could not be queued.')
+            return jobResult
+
+        # A migration whose job is gone no longer blocks new ones
+        await schema_migration.set_migration_job(migrationId, jobResult['id'])
+
+        return {'id': str(migrationId), 'job_id': jobResult['id'], 'message': 'Schema migration has been queued.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+# Runs on the job queue, the registry is reloaded once the collections match
+async def run_schema_migration(migrationId: str, moduleNames: list = None, reportProgress=None):
+    async def report_module_progress(moduleName: str, progress: dict):
+        await reportProgress({'module_name': moduleName, 'steps_done': progress['steps_done'],
+                              'steps_total': progress['steps_total'] if 'steps_total' in progress else 0,
+                              'current_step': progress['current_step']})
+
+    await schema_migration.run_migration(ObjectId(migrationId), moduleNames,
+                                         report_module_progress if reportProgress is not None else None)
+    await local_data.load_module_data()
+
+
+async def get_schema_migration(migrationId: str) -> dict:
+    try:
+        migrationDoc = await schema_migration.get_migration(migrationId)
+
+        if migrationDoc is None:
+            return {'type': 'error', 'message': 'No schema migration found for the provided Id.'}
+
+        return {'migration': migrationDoc, 'message': 'Schema migration status retrieved successfully.'}
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+def get_module_codec(moduleSchema: dict, activityType: str = None, fieldProjection: dict = None) -> dict:
+    if activityType is None:
+        moduleCodec = moduleSchema['codec']
+
+    elif activityType in moduleSchema['activity_codecs']:
+        moduleCodec = moduleSchema['activity_codecs'][activityType]
 
     else:
-        fieldValue = ''
-        if moduleField['field_name'] in requestData:
-            fieldValue = requestData[moduleField['field_name']]
+        moduleCodec = moduleSchema['activity_codecs']['Call']
 
-    return fieldValue
+    if fieldProjection is None:
+        return moduleCodec
 
+    return field_codec.restrict_codec(moduleCodec, fieldProjection)
+
+
+def get_module_field_names(moduleName: str, moduleSchema: dict) -> set:
+    if moduleName == 'Activity':
+        fieldNames = {'activity_type'}
+        for activityFields in moduleSchema['activity_fields'].values():
+            for activityField in activityFields:
+                fieldNames.add(activityField['field_name'])
+        return fieldNames
+
+    return {moduleField['field_name'] for moduleField in moduleSchema['module_fields']}
+
+
+def build_field_projection(moduleName: str, moduleSchema: dict, fields: list, sortFields: list = []) -> dict:
+    fieldNames = get_module_field_names(moduleName, moduleSchema)
+    projection = {}
+
+    for fieldName in fields:
+        if fieldName not in fieldNames:
+            return {
+                'type': 'error',
+                'message': fieldName + ' is not a field of ' + moduleName + '.'
+            }
+        projection[fieldName] = 1
+
+    # Fields the codecs and the keyset cursor read besides the requested ones
+    if moduleName == 'Activity':
+        projection['activity_type'] = 1
+    if 'record' in projection:
+        projection['related_to'] = 1
+    if 'contact_lead' in projection:
+        projection['contact_lead_type'] = 1
+
+    for sortField, _ in sortFields:
+        if sortField != '_id':
+            projection[sortField.split('.')[0]] = 1
+
+    return projection
 
-async def create_new_module_record(moduleName: str, requestData: dict) -> dict:
-    logger.debug('in post.')
-    insertDocument = {}
-    moduleFieldsDoc = await collectionModuleFields.find_one(
-        {'type': 'module', 'module_name': moduleName},
-        projection={'module_fields': 1, '_id': 0}
-    )
 
-    if moduleFieldsDoc is None:
+async def get_module_fields_list(moduleName: str) -> dict:
+    moduleSchema = await get_module_schema(moduleName)
+
+    if moduleSchema is None:
         return {
             'type': 'error',
             'message': 'Module ' + moduleName + ' is not present in the system.'
         }
 
-    moduleFields = moduleFieldsDoc['module_fields']
+    result = {}
+    result['module_fields'] = moduleSchema['module_fields']
+    result['module_sections'] = moduleSchema['module_sections']
 
-    if moduleName == 'Activity':
-        insertDocument['activity_type'] = requestData['activity_type']
+    return result
 
-        if insertDocument['activity_type'] == 'Task':
-            moduleFields = moduleFields[1]['activity_fields']['task_fields']
 
-        elif insertDocument['activity_type'] == 'Event':
-            moduleFields = moduleFields[1]['activity_fields']['event_fields']
+def prepare_module_record(moduleName: str, moduleSchema: dict, requestData: dict) -> dict:
+    insertDocument = {}
 
-        elif insertDocument['activity_type'] == 'Call':
-            moduleFields = moduleFields[1]['activity_fields']['call_fields']
+    if moduleName == 'Activity':
+        insertDocument['activity_type'] = requestData['activity_type']
 
-        else:
+        if insertDocument['activity_type'] not in moduleSchema['activity_codecs']:
             return {
                 'type': 'error',
                 'message': 'Activity type is not valid.'
             }
 
-    for moduleField in moduleFields:
+        moduleCodec = get_module_codec(
+            moduleSchema, insertDocument['activity_type'])
+    else:
+        moduleCodec = get_module_codec(moduleSchema)
+
+    for moduleField, fieldEncoder in moduleCodec['encoders']:
         if moduleField['field_name'] == 'created_by':
             insertDocument['created_by'] = 'system_default'
             continue
@@ -194,110 +277,172 @@ async def create_new_module_record(moduleName: str, requestData: dict) -> dict:
                 and moduleField['field_name'] not in requestData:
             return {'type': 'error', 'message': moduleField['field_name'] + ' is required.'}
 
-        insertDocument[moduleField['field_name']
-                       ] = await get_field_value(moduleField, requestData)
+        insertDocument[moduleField['field_name']] = fieldEncoder(requestData)
+
+    return {'document': insertDocument}
+
+
+async def create_new_module_record(moduleName: str, requestData: dict) -> dict:
+    logger.debug('in post.')
+    moduleSchema = await get_module_schema(moduleName)
+
+    if moduleSchema is None:
+        return {
+            'type': 'error',
+            'message': 'Module ' + moduleName + ' is not present in the system.'
+        }
+
+    prepared = prepare_module_record(moduleName, moduleSchema, requestData)
+    if 'type' in prepared:
+        return prepared
+
+    insertDocument = prepared['document']
 
     logger.debug(insertDocument)
     collection = database.get_collection('module_' + moduleName)
     result = await collection.insert_one(insertDocument)
+    count_cache.record_inserted(collection.name)
 
     return {'message': 'New ' + moduleName + ' record created.', 'id': str(result.inserted_id)}
 
 
-async def add_attachment(moduleName: str, recordId: str, fileId: str, fileName: str):
-    collection = database.get_collection('module_' + moduleName)
+async def insert_module_records_chunk(collection, chunk: list, recordResults: list) -> int:
+    try:
+        result = await collection.insert_many([document for _, document in chunk], ordered=False)
+        insertedCount = len(result.inserted_ids)
+        failedPositions = {}
+
+    except BulkWriteError as e:
+        insertedCount = e.details['nInserted']
+        failedPositions = {}
+        for writeError in e.details['writeErrors']:
+            failedPositions[writeError['index']] = writeError['errmsg']
+
+    # insert_many assigns _id on the client, so ids are known for every row
+    for position, (index, document) in enumerate(chunk):
+        if position in failedPositions:
+            recordResults[index] = {'index': index, 'type': 'error',
+                                    'message': failedPositions[position]}
+        else:
+            recordResults[index] = {'index': index, 'id': str(document['_id'])}
 
-    updatedDoc = await collection.update_one({'_id': ObjectId(recordId)},
-                                             {'$push': {'attachments': {'file_id': fileId, 'file_name': fileName}},
-                                              '$set': {'modified_by': 'system_update', 'modified_at': datetime.datetime.now()}})
+    return insertedCount
 
-    if updatedDoc:
-        return {'message': str(updatedDoc.modified_count) + ' ' + moduleName + ' record has been updated.', 'updatedDocumentCount': updatedDoc.modified_count}
 
-    return {'type': 'error', 'message': 'Attachment could not be added to ' + moduleName + ' record.'}
+async def create_module_records_in_bulk(moduleName: str, requestDataList: list,
+                                        chunkSize: int = bulkInsertChunkSize) -> dict:
+    try:
+        moduleSchema = await get_module_schema(moduleName)
+
+        if moduleSchema is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        if chunkSize < 1 or chunkSize > bulkInsertMaxChunkSize:
+            return {
+                'type': 'error',
+                'message': 'Chunk size has to be between 1 and ' + str(bulkInsertMaxChunkSize) + '.'
+            }
+
+        collection = database.get_collection('module_' + moduleName)
+        recordResults = [None] * len(requestDataList)
+        insertedCount = 0
+        chunk = []
+
+        for index, requestData in enumerate(requestDataList):
+            try:
+                prepared = prepare_module_record(moduleName, moduleSchema, requestData)
+            except Exception as e:
+                prepared = {'type': 'error', 'message': str(type(e).__name__) + ': ' + str(e)}
+
+            if 'type' in prepared:
+                recordResults[index] = {'index': index, 'type': 'error', 'message': prepared['message']}
+                continue
 
+            chunk.append((index, prepared['document']))
+            if len(chunk) == chunkSize:
+                insertedCount += await insert_module_records_chunk(collection, chunk, recordResults)
+                chunk = []
 
-async def convert_field_value_for_get(moduleField: dict, record: dict) -> any:
-    fieldValue = record[moduleField['field_name']]
+        if len(chunk) > 0:
+            insertedCount += await insert_module_records_chunk(collection, chunk, recordResults)
 
-    if moduleField['bson_type'] == 'decimal':
-        fieldValue = str(fieldValue)
+        count_cache.record_inserted(collection.name, insertedCount)
+
+        return {
+            'records': recordResults,
+            'insertedCount': insertedCount,
+            'errorCount': len(requestDataList) - insertedCount,
+            'message': str(insertedCount) + ' of ' + str(len(requestDataList)) + ' ' + moduleName + ' records created.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
 
-    elif moduleField['bson_type'] == 'date':
-        fieldValue = fieldValue.isoformat()
 
-    elif moduleField['bson_type'] == 'binData':
-        fieldValue = base64.b64encode(fieldValue)
+async def add_attachment(moduleName: str, recordId: str, fileId: str, fileName: str):
+    collection = database.get_collection('module_' + moduleName)
 
-    elif moduleField['bson_type'] == 'object':
-        objectRecord = fieldValue
+    updatedDoc = await collection.update_one({'_id': ObjectId(recordId)},
+                                             {'$push': {'attachments': {'file_id': fileId, 'file_name': fileName}},
+                                              '$set': {'modified_by': 'system_update', 'modified_at': datetime.datetime.now()}})
 
-        # Special case to handle in Activity Module
-        if 'module_fields_required' in moduleField:
-            if moduleField['field_name'] == 'record':
-                for objectField in moduleField['field_object_attribute']:
-                    if objectField['field_name'] not in moduleField['module_fields_required'][record['related_to']['module_name']]:
-                        continue
-                    fieldValue[objectField['field_name']] = await convert_field_value_for_get(
-                        objectField, objectRecord)
+    if updatedDoc:
+        count_cache.invalidate_filtered_counts(collection.name)
+        return {'message': str(updatedDoc.modified_count) + ' ' + moduleName + ' record has been updated.', 'updatedDocumentCount': updatedDoc.modified_count}
 
-            elif moduleField['field_name'] == 'contact_lead':
-                for objectField in moduleField['field_object_attribute']:
-                    if objectField['field_name'] not in moduleField['module_fields_required'][record['contact_lead_type']]:
-                        continue
-                    fieldValue[objectField['field_name']] = await convert_field_value_for_get(
-                        objectField, objectRecord)
+    return {'type': 'error', 'message': 'Attachment could not be added to ' + moduleName + ' record.'}
 
-        # Normal case
-        else:
-            for objectField in moduleField['field_object_attribute']:
-                fieldValue[objectField['field_name']] = await convert_field_value_for_get(
-                    objectField, objectRecord)
 
-    elif moduleField['bson_type'] == 'array':
-        if len(moduleField['field_array_element']) > 1:
-            index = 0
-            while index < len(fieldValue):
-                for objectField in moduleField['field_array_element']:
-                    fieldValue[index][objectField['field_name']] = await convert_field_value_for_get(objectField, fieldValue[index])
-                index += 1
+# Records in the recycle bin are invisible to reads and updates
+def get_live_record_filter(recordId: str) -> dict:
+    recordFilter = recycle_bin.get_live_record_query()
+    recordFilter['_id'] = ObjectId(recordId)
 
-    return fieldValue
+    return recordFilter
 
 
-async def get_record(moduleName: str, recordId: str):
+async def get_record(moduleName: str, recordId: str, fields: list = None, expand: bool = False,
+                     currentUser: dict = {}):
     try:
-        if moduleName not in moduleUniqueFields:
+        moduleSchema = await get_module_schema(moduleName)
+
+        if moduleSchema is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
+        projection = None
+        if fields:
+            projection = build_field_projection(moduleName, moduleSchema, fields)
+            if 'type' in projection:
+                return projection
+
         collection = database.get_collection('module_' + moduleName)
 
-        resultDoc = await collection.find_one({'_id': ObjectId(recordId)})
+        resultDoc = await collection.find_one(get_live_record_filter(recordId), projection)
 
         if resultDoc is None:
             return {'type': 'error', 'message': 'No relevant ' + moduleName + ' record found for the provided record Id.'}
 
-        moduleFieldsDoc = await collectionModuleFields.find_one(
-            {'type': 'module', 'module_name': moduleName},
-            projection={'module_fields': 1, '_id': 0})
-
-        moduleFields = moduleFieldsDoc['module_fields']
-
         if moduleName == 'Activity':
-            if resultDoc['activity_type'] == 'Task':
-                moduleFields = moduleFields[1]['activity_fields']['task_fields']
-            elif resultDoc['activity_type'] == 'Event':
-                moduleFields = moduleFields[1]['activity_fields']['event_fields']
-            else:
-                moduleFields = moduleFields[1]['activity_fields']['call_fields']
+            moduleCodec = get_module_codec(
+                moduleSchema, resultDoc['activity_type'], projection)
+        else:
+            moduleCodec = get_module_codec(moduleSchema, fieldProjection=projection)
 
-        for moduleField in moduleFields:
-            resultDoc[moduleField['field_name']] = await convert_field_value_for_get(moduleField, resultDoc)
+        field_codec.decode_record(moduleCodec, resultDoc)
 
-        resultDoc['_id'] = str(resultDoc['_id'])
+        if expand:
+            await lookup.expand_records(moduleName, [resultDoc], currentUser['profile'])
 
         logger.debug(resultDoc)
 
@@ -313,80 +458,161 @@ async def get_record(moduleName: str, recordId: str):
         }
 
 
+def build_records_query(moduleName: str, search: str, searchMode: str, recordIds: list) -> dict:
+    query = recycle_bin.get_live_record_query()
+
+    if recordIds and len(recordIds) > 0:
+        listRecordId = [ObjectId(recordId) for recordId in recordIds]
+        query['_id'] = {'$in': listRecordId}
+
+    searchFields = moduleSchemas[moduleName]['search_fields']
+
+    # Numeric searches stay on the regex path, the text index only covers strings.
+    # Without declared searchable fields there is no text index to use.
+    textSearch = len(search) > 0 and searchMode == 'text' \
+        and len(moduleSchemas[moduleName]['text_search_fields']) > 0 \
+        and not search.replace('.', '', 1).isdigit()
+
+    if textSearch:
+        query['$text'] = {'$search': search}
+
+    elif len(search) > 0:
+        query['$or'] = []
+        for stringField in searchFields:
+            query['$or'].append(
+                {stringField: {'$regex': '^' + search, '$options': 'i'}})
+
+        if search.isdigit():
+            for intField in moduleBsonTypeFields[moduleName]['int']:
+                query['$or'].append(
+                    {intField: {'$eq': int(search)}})
+
+        if search.replace('.', '', 1).isdigit():
+            for intField in moduleBsonTypeFields[moduleName]['decimal']:
+                query['$or'].append(
+                    {intField: {'$eq': Decimal128(search)}})
+
+        # No field is searchable, so the search matches no record
+        if len(query['$or']) == 0:
+            query['$or'].append({'_id': {'$exists': False}})
+
+    return {'query': query, 'textSearch': textSearch}
+
+
+def build_sort_fields(sortBy: list, sortOrder: str) -> list:
+    sortFields = []
+
+    if sortBy and len(sortBy) > 0:
+        i = 0
+        while i < len(sortBy):
+            if i == 0:
+                sortFields.append(
+                    (sortBy[i], -1 if sortOrder == 'desc' else 1))
+            else:
+                sortFields.append((sortBy[i], 1))
+            i += 1
+
+    return sortFields
+
+
 async def get_records_list_with_options(moduleName: str, start: int, length: int,
                                         sortBy: list, sortOrder: str, search: str,
-                                        recordIds: list, currentUser: dict = {}):
+                                        recordIds: list, currentUser: dict = {},
+                                        paginationMode: str = 'offset', cursor: str = None,
+                                        approximateCount: bool = False, searchMode: str = 'regex',
+                                        fields: list = None, expand: bool = False):
     try:
         collection = database.get_collection('module_' + moduleName)
-        moduleFieldsDoc = await collectionModuleFields.find_one(
-            {'type': 'module', 'module_name': moduleName},
-            projection={'module_fields': 1, '_id': 0})
+        moduleSchema = await get_module_schema(moduleName)
 
-        if moduleFieldsDoc is None:
+        if moduleSchema is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
-        query = {}
-        results = {'records': []}
-        sortFields = []
+        if paginationMode not in pagination.paginationModes:
+            return {
+                'type': 'error',
+                'message': 'Pagination mode has to be one of ' + str(sorted(pagination.paginationModes)) + '.'
+            }
 
-        if recordIds and len(recordIds) > 0:
-            listRecordId = [ObjectId(recordId) for recordId in recordIds]
-            query['_id'] = {'$in': listRecordId}
+        if searchMode not in searchModes:
+            return {
+                'type': 'error',
+                'message': 'Search mode has to be one of ' + str(sorted(searchModes)) + '.'
+            }
 
-        if len(search) > 0:
-            query['$or'] = []
-            for stringField in moduleBsonTypeFields[moduleName]['string']:
-                query['$or'].append(
-                    {stringField: {'$regex': '^' + search, '$options': 'i'}})
-
-            if search.isdigit():
-                for intField in moduleBsonTypeFields[moduleName]['int']:
-                    query['$or'].append(
-                        {intField: {'$eq': int(search)}})
-
-            if search.replace('.', '', 1).isdigit():
-                for intField in moduleBsonTypeFields[moduleName]['decimal']:
-                    query['$or'].append(
-                        {intField: {'$eq': Decimal128(search)}})
-
-        if sortBy and len(sortBy) > 0:
-            i = 0
-            while i < len(sortBy):
-                if i == 0:
-                    sortFields.append(
-                        (sortBy[i], -1 if sortOrder == 'desc' else 1))
-                else:
-                    sortFields.append((sortBy[i], 1))
-                i += 1
+        results = {'records': []}
+
+        recordsQuery = build_records_query(moduleName, search, searchMode, recordIds)
+        query = recordsQuery['query']
+        textSearch = recordsQuery['textSearch']
+        sortFields = build_sort_fields(sortBy, sortOrder)
+
+        if paginationMode == 'cursor':
+            # Keyset pagination: seek past the last sort key instead of skipping
+            sortFields = pagination.add_tie_breaker(sortFields)
+
+        projection = None
+        if fields:
+            projection = build_field_projection(moduleName, moduleSchema, fields, sortFields)
+            if 'type' in projection:
+                return projection
+
+        # Rank by relevance first, keyset pages cannot seek on the score
+        scoreSort = textSearch and paginationMode != 'cursor'
+        if scoreSort:
+            if projection is None:
+                projection = {}
+            projection['score'] = {'$meta': 'textScore'}
+            sortFields.insert(0, ('score', {'$meta': 'textScore'}))
 
         # logger.debug(query)
-        recordCount = await collection.count_documents(query)
-        records = collection.find(query).skip(start).limit(
-            length).sort(sortFields)
+        recordCount = await count_cache.get_count(collection, query, approximateCount)
+
+        if paginationMode == 'cursor':
+            if cursor:
+                try:
+                    query = pagination.add_keyset_query(
+                        query, sortFields, cursor)
+                except ValueError as e:
+                    return {'type': 'error', 'message': str(e)}
+
+            records = collection.find(query, projection).limit(length).sort(sortFields)
+        else:
+            records = collection.find(query, projection).skip(start).limit(
+                length).sort(sortFields)
+
+        recordList = await records.to_list(length)
+
+        if scoreSort:
+            for record in recordList:
+                record.pop('score', None)
+
+        if paginationMode == 'cursor':
+            results['next_cursor'] = None
+            if len(recordList) == length:
+                results['next_cursor'] = pagination.encode_cursor(
+                    sortFields, recordList[-1])
 
         if moduleName == 'Activity':
-            for record in await records.to_list(length):
-                if record['activity_type'] == 'Task':
-                    moduleFields = moduleFieldsDoc['module_fields'][1]['activity_fields']['task_fields']
-                elif record['activity_type'] == 'Event':
-                    moduleFields = moduleFieldsDoc['module_fields'][1]['activity_fields']['event_fields']
-                else:
-                    moduleFields = moduleFieldsDoc['module_fields'][1]['activity_fields']['call_fields']
-
-                for moduleField in moduleFields:
-                    record[moduleField['field_name']] = await convert_field_value_for_get(moduleField, record)
-                record['_id'] = str(record['_id'])
-                results['records'].append(record)
+            activityCodecs = {}
+            for record in recordList:
+                if record['activity_type'] not in activityCodecs:
+                    activityCodecs[record['activity_type']] = get_module_codec(
+                        moduleSchema, record['activity_type'], projection)
+                results['records'].append(
+                    field_codec.decode_record(activityCodecs[record['activity_type']], record))
 
         else:
-            for record in await records.to_list(length):
-                for moduleField in moduleFieldsDoc['module_fields']:
-                    record[moduleField['field_name']] = await convert_field_value_for_get(moduleField, record)
-                record['_id'] = str(record['_id'])
-                results['records'].append(record)
+            moduleCodec = get_module_codec(moduleSchema, fieldProjection=projection)
+            for record in recordList:
+                results['records'].append(
+                    field_codec.decode_record(moduleCodec, record))
+
+        if expand:
+            await lookup.expand_records(moduleName, results['records'], currentUser['profile'])
 
         # logger.debug(results)
 
@@ -395,8 +621,9 @@ async def get_records_list_with_options(moduleName: str, start: int, length: int
         else:
             results['message'] = 'No record found.'
 
-        results['recordsFiltered'] = recordCount
-        results['recordsTotal'] = recordCount
+        results['recordsFiltered'] = recordCount['count']
+        results['recordsTotal'] = recordCount['count']
+        results['recordsApproximate'] = recordCount['approximate']
 
         return results
 
@@ -410,15 +637,87 @@ async def get_records_list_with_options(moduleName: str, start: int, length: int
         }
 
 
-async def get_records_list_with_less_options(moduleName: str, start: int, length: int, search: str) -> dict:
+async def export_records(moduleName: str, exportFormat: str, sortBy: list, sortOrder: str,
+                         search: str, recordIds: list, searchMode: str = 'regex',
+                         activityTypes: list = None) -> dict:
+    try:
+        moduleSchema = await get_module_schema(moduleName)
+
+        if moduleSchema is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        if exportFormat not in record_export.exportMediaTypes:
+            return {
+                'type': 'error',
+                'message': 'Export format has to be one of ' + str(sorted(record_export.exportMediaTypes)) + '.'
+            }
+
+        if searchMode not in searchModes:
+            return {
+                'type': 'error',
+                'message': 'Search mode has to be one of ' + str(sorted(searchModes)) + '.'
+            }
+
+        collection = database.get_collection('module_' + moduleName)
+        query = build_records_query(moduleName, search, searchMode, recordIds)['query']
+
+        if not sortBy:
+            sortBy = moduleSchema['unique_fields']
+        sortFields = pagination.add_tie_breaker(build_sort_fields(sortBy, sortOrder))
+
+        if moduleName == 'Activity':
+            if activityTypes is not None:
+                query['activity_type'] = {'$in': activityTypes}
+
+            def decodeRecord(record: dict) -> dict:
+                return field_codec.decode_record(
+                    get_module_codec(moduleSchema, record['activity_type']), record)
+        else:
+            moduleCodec = get_module_codec(moduleSchema)
+
+            def decodeRecord(record: dict) -> dict:
+                return field_codec.decode_record(moduleCodec, record)
+
+        records = collection.find(query, batch_size=record_export.exportBatchSize).sort(sortFields)
+
+        return {
+            'content': record_export.stream_records(
+                records, decodeRecord, exportFormat,
+                record_export.get_export_columns(moduleName, moduleSchema)),
+            'media_type': record_export.exportMediaTypes[exportFormat],
+            'file_name': moduleName + '.' + exportFormat
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def get_records_list_with_less_options(moduleName: str, start: int, length: int, search: str,
+                                             paginationMode: str = 'offset', cursor: str = None,
+                                             approximateCount: bool = False, searchMode: str = 'regex',
+                                             fields: list = None, expand: bool = False,
+                                             currentUser: dict = {}) -> dict:
     try:
-        if moduleName not in moduleUniqueFields:
+        moduleSchema = await get_module_schema(moduleName)
+
+        if moduleSchema is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
-        return await get_records_list_with_options(moduleName, start, length, moduleUniqueFields[moduleName], 'asc', search, [])
+        return await get_records_list_with_options(moduleName, start, length, moduleSchema['unique_fields'], 'asc', search, [],
+                                                   paginationMode=paginationMode, cursor=cursor,
+                                                   approximateCount=approximateCount, searchMode=searchMode,
+                                                   fields=fields, expand=expand, currentUser=currentUser)
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
         return {
@@ -432,7 +731,7 @@ async def get_records_list_with_less_options(moduleName: str, start: int, length
 async def update_stage_history_for_deal(recordId: str, updateData: dict):
     collection = database.get_collection('module_Deal')
     dealData = await collection.find_one(
-        {'_id': ObjectId(recordId)},
+        get_live_record_filter(recordId),
         projection={
             'stage_history': 1,
             'stage': 1,
@@ -478,42 +777,99 @@ async def update_stage_history_for_deal(recordId: str, updateData: dict):
     updateData['stage_history'] = stageHistory
 
 
+# Data, audit fields and the version bump go out in one update_one without a
+# transaction. A record without a version field counts as version 0.
+async def update_record_in_single_write(moduleName: str, collection, recordId: str, updateDocument: dict,
+                                        modifiedBy: str, modifiedAt: datetime.datetime,
+                                        version: int = None, activityType: str = None) -> dict:
+    updateFilter = get_live_record_filter(recordId)
+
+    if version is not None:
+        updateFilter['version'] = {'$in': [0, None]} if version == 0 else version
+
+    if activityType is not None:
+        updateFilter['activity_type'] = activityType
+
+    updateDocument['modified_by'] = modifiedBy
+    updateDocument['modified_at'] = modifiedAt
+
+    resultDoc = await collection.find_one_and_update(
+        updateFilter,
+        {'$set': updateDocument, '$inc': {'version': 1}},
+        projection={'version': 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+    if resultDoc is None:
+        # Only the failure path pays for a second read to tell the cases apart
+        currentDoc = await collection.find_one(
+            get_live_record_filter(recordId), projection={'version': 1, 'activity_type': 1})
+
+        if currentDoc is None:
+            return {'type': 'error', 'message': 'No matching ' + moduleName + ' record found to be updated.'}
+
+        if activityType is not None and currentDoc['activity_type'] != activityType:
+            return {'type': 'error', 'message': 'Activity type of the ' + moduleName + ' record does not match.'}
+
+        return {
+            'type': 'conflict',
+            'version': currentDoc['version'] if 'version' in currentDoc else 0,
+            'message': moduleName + ' record has been modified by someone else.'
+        }
+
+    count_cache.invalidate_filtered_counts(collection.name)
+
+    return {'message': '1 ' + moduleName + ' record updated.', 'version': resultDoc['version']}
+
+
 async def update_record(moduleName: str, recordId: str, requestData: dict) -> dict:
     try:
         logger.debug('in put.')
+        version = requestData['version'] if 'version' in requestData else None
+        updateMode = requestData['update_mode'] if 'update_mode' in requestData \
+            else ('single' if version is not None else 'transaction')
         requestData = requestData['updated_record']
         modifiedBy = 'system_update'
         modifiedAt = datetime.datetime.now()
         updateDocument = {}
-        moduleFieldsDoc = await collectionModuleFields.find_one({'type': 'module', 'module_name': moduleName}, projection={'module_fields': 1, '_id': 0})
+        activityType = None
+        moduleSchema = await get_module_schema(moduleName)
 
-        if moduleFieldsDoc is None:
+        if moduleSchema is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
-        moduleFields = moduleFieldsDoc['module_fields']
+        if updateMode not in updateModes:
+            return {
+                'type': 'error',
+                'message': 'Update mode has to be one of ' + str(sorted(updateModes)) + '.'
+            }
 
         if moduleName == 'Activity':
-            collection = database.get_collection('module_' + moduleName)
-            activityDoc = await collection.find_one(
-                {'_id': ObjectId(recordId)},
-                projection={
-                    'activity_type': 1
-                }
-            )
-
-            if activityDoc is None:
-                return {'type': 'error', 'message': 'No matching ' + moduleName + ' record found to be updated.'}
-            if activityDoc['activity_type'] == 'Task':
-                moduleFields = moduleFieldsDoc['module_fields'][1]['activity_fields']['task_fields']
-            elif activityDoc['activity_type'] == 'Event':
-                moduleFields = moduleFieldsDoc['module_fields'][1]['activity_fields']['event_fields']
+            # A single round trip update trusts the activity type sent by the client,
+            # the update filter makes sure it matches the stored one
+            if updateMode == 'single' and 'activity_type' in requestData:
+                activityType = requestData['activity_type']
             else:
-                moduleFields = moduleFieldsDoc['module_fields'][1]['activity_fields']['call_fields']
+                collection = database.get_collection('module_' + moduleName)
+                activityDoc = await collection.find_one(
+                    get_live_record_filter(recordId),
+                    projection={
+                        'activity_type': 1
+                    }
+                )
 
-        for moduleField in moduleFields:
+                if activityDoc is None:
+                    return {'type': 'error', 'message': 'No matching ' + moduleName + ' record found to be updated.'}
+                activityType = activityDoc['activity_type']
+
+            moduleCodec = get_module_codec(moduleSchema, activityType)
+        else:
+            moduleCodec = get_module_codec(moduleSchema)
+
+        for moduleField, fieldEncoder in moduleCodec['encoders']:
             if moduleField['field_name'] == 'modified_by':
                 updateDocument['modified_by'] = modifiedBy
                 continue
@@ -526,10 +882,9 @@ async def update_record(moduleName: str, recordId: str, requestData: dict) -> di
                     or moduleField['field_name'] in {'created_by', 'created_at'}:
                 continue
 
-            updateDocument[moduleField['field_name']
-                           ] = await get_field_value(moduleField, requestData)
+            updateDocument[moduleField['field_name']] = fieldEncoder(requestData)
 
-        if moduleName == 'Deal':
+        if moduleName == 'Deal' and 'stage' in updateDocument:
             result = await update_stage_history_for_deal(recordId, updateDocument)
             if result:
                 return result
@@ -545,10 +900,15 @@ async def update_record(moduleName: str, recordId: str, requestData: dict) -> di
                 'message': 'At least one field required to update ' + moduleName + ' record.'
             }
 
+        if updateMode == 'single':
+            return await update_record_in_single_write(
+                moduleName, collection, recordId, updateDocument, modifiedBy, modifiedAt,
+                version, activityType)
+
         async with await mongoClient.start_session() as transactionSession:
             async with transactionSession.start_transaction():
                 result = await collection.update_one(
-                    {'_id': ObjectId(recordId)},
+                    get_live_record_filter(recordId),
                     {'$set': updateDocument},
                     session=transactionSession
                 )
@@ -556,16 +916,21 @@ async def update_record(moduleName: str, recordId: str, requestData: dict) -> di
                 if result.modified_count == 1:
                     result = await collection.update_one(
                         {'_id': ObjectId(recordId)},
-                        {'$set': {
-                            'modified_by': modifiedBy,
-                            'modified_at': modifiedAt
-                        }},
+                        {
+                            '$set': {
+                                'modified_by': modifiedBy,
+                                'modified_at': modifiedAt
+                            },
+                            '$inc': {'version': 1}
+                        },
                         session=transactionSession
                     )
 
         if result.matched_count == 0:
             return {'type': 'error', 'message': 'No matching ' + moduleName + ' record found to be updated.'}
 
+        count_cache.invalidate_filtered_counts(collection.name)
+
         return {'message': str(result.modified_count) + ' ' + moduleName + ' record updated.'}
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
@@ -575,28 +940,125 @@ async def update_record(moduleName: str, recordId: str, requestData: dict) -> di
                 'message': 'An error has occured.'}
 
 
-async def delete_record(moduleName: str, recordId: str) -> dict:
+# Filter shared by the mass update and bulk delete endpoints, an empty
+# filter has to be asked for explicitly with all_records
+def build_filter_query(moduleName: str, moduleSchema: dict, requestData: dict, activityTypes: list = None) -> dict:
+    search = requestData['search'] if 'search' in requestData else ''
+    searchMode = requestData['search_mode'] if 'search_mode' in requestData else 'regex'
+    recordIds = requestData['record_id'] if 'record_id' in requestData else []
+    allRecords = 'all_records' in requestData and requestData['all_records'] is True
+
+    if searchMode not in searchModes:
+        return {
+            'type': 'error',
+            'message': 'Search mode has to be one of ' + str(sorted(searchModes)) + '.'
+        }
+
+    if len(search) == 0 and len(recordIds) == 0 and not allRecords:
+        return {
+            'type': 'error',
+            'message': 'A search, record_id or all_records is required to change ' + moduleName + ' records.'
+        }
+
+    query = build_records_query(moduleName, search, searchMode, recordIds)['query']
+
+    if moduleName == 'Activity' and 'activity_type' in requestData:
+        if requestData['activity_type'] not in moduleSchema['activity_codecs']:
+            return {'type': 'error', 'message': 'Activity type is not valid.'}
+
+        if activityTypes is not None and requestData['activity_type'] not in activityTypes:
+            return {'type': 'error', 'message': 'Access not allowed for ' + requestData['activity_type'] + '.'}
+
+        query['activity_type'] = requestData['activity_type']
+
+    # Without a type the change reaches only the types the profile is allowed
+    elif moduleName == 'Activity' and activityTypes is not None:
+        query['activity_type'] = {'$in': activityTypes}
+
+    return {'query': query}
+
+
+def build_mass_update_patch(moduleName: str, moduleSchema: dict, moduleCodec: dict, patchData: dict) -> dict:
+    patchDocument = {}
+    fieldEncoders = {}
+
+    for moduleField, fieldEncoder in moduleCodec['encoders']:
+        fieldEncoders[moduleField['field_name']] = fieldEncoder
+
+    for fieldName in patchData:
+        if fieldName not in fieldEncoders:
+            return {'type': 'error', 'message': fieldName + ' is not a field of ' + moduleName + '.'}
+
+        if fieldName in {'created_by', 'created_at', 'modified_by', 'modified_at'}:
+            return {'type': 'error', 'message': fieldName + ' can not be updated.'}
+
+        # Every matched record would end up with the same unique key
+        if fieldName in moduleSchema['unique_fields']:
+            return {'type': 'error', 'message': 'Unique field ' + fieldName + ' can not be mass updated.'}
+
+        # Stage history is derived per record, it has to go through update_record
+        if moduleName == 'Deal' and fieldName == 'stage':
+            return {'type': 'error', 'message': 'stage of Deal records can not be mass updated.'}
+
+        patchDocument[fieldName] = fieldEncoders[fieldName](patchData)
+
+    return {'document': patchDocument}
+
+
+async def mass_update_records(moduleName: str, requestData: dict, activityTypes: list = None,
+                              reportProgress=None) -> dict:
     try:
-        if moduleName not in moduleUniqueFields:
+        moduleSchema = await get_module_schema(moduleName)
+
+        if moduleSchema is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
-        collection = database.get_collection('module_' + moduleName)
+        patchData = requestData['updated_fields']
 
-        resultDoc = await collection.find_one_and_delete({'_id': ObjectId(recordId)})
+        if not patchData:
+            return {
+                'type': 'error',
+                'message': 'At least one field required to update ' + moduleName + ' records.'
+            }
 
-        if resultDoc is None:
-            return {'type': 'error', 'message': 'No relevant ' + moduleName + ' record found for the provided record Id to be deleted.'}
+        if moduleName == 'Activity' and 'activity_type' not in requestData:
+            return {'type': 'error', 'message': 'Activity type is not valid.'}
 
-        for attachmentFile in resultDoc['attachments']:
-            await attachment.delete_attachment(attachmentFile['file_id'])
+        filterQuery = build_filter_query(moduleName, moduleSchema, requestData, activityTypes)
+        if 'type' in filterQuery:
+            return filterQuery
 
-        # logger.debug(resultDoc)
+        query = filterQuery['query']
 
-        return {'message': 'A ' + moduleName + ' record deleted successfully.'}
+        if moduleName == 'Activity':
+            moduleCodec = get_module_codec(moduleSchema, requestData['activity_type'])
+        else:
+            moduleCodec = get_module_codec(moduleSchema)
+
+        # The patch is validated and encoded once for all matched records
+        patch = build_mass_update_patch(moduleName, moduleSchema, moduleCodec, patchData)
+        if 'type' in patch:
+            return patch
+
+        updateDocument = patch['document']
+        updateDocument['modified_by'] = 'system_update'
+        updateDocument['modified_at'] = datetime.datetime.now()
+
+        collection = database.get_collection('module_' + moduleName)
+        result = await update_records_in_batches(
+            collection, query, {'$set': updateDocument, '$inc': {'version': 1}}, reportProgress)
+
+        if result['modifiedCount'] > 0:
+            count_cache.invalidate_filtered_counts(collection.name)
 
+        return {
+            'matchedCount': result['matchedCount'],
+            'modifiedCount': result['modifiedCount'],
+            'message': str(result['modifiedCount']) + ' ' + moduleName + ' records updated.'
+        }
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
         return {'type': 'exception',
@@ -605,40 +1067,89 @@ async def delete_record(moduleName: str, recordId: str) -> dict:
                 'message': 'An error has occured.'}
 
 
-async def delete_attchment_from_api(moduleName: str, recordId: str, fileId: str) -> dict:
-    collection = database.get_collection('module_' + moduleName)
+# Matched records are updated in _id order a chunk at a time, so a job can
+# report how far it got
+async def update_records_in_batches(collection, query: dict, update: dict, reportProgress=None) -> dict:
+    result = {'matchedCount': 0, 'modifiedCount': 0}
+    lastId = None
 
-    resultDoc = await collection.update_one({'_id': ObjectId(recordId)}, {
-        '$pull': {'attachments': {'file_id': fileId}}})
+    while True:
+        batchQuery = query if lastId is None else {'$and': [query, {'_id': {'$gt': lastId}}]}
+        records = await collection.find(batchQuery, projection={'_id': 1}).sort([('_id', 1)]) \
+            .limit(bulkDeleteChunkSize).to_list(bulkDeleteChunkSize)
 
-    if resultDoc is None or resultDoc.modified_count == 0:
-        return {'type': 'error', 'message': 'the reference of given file not found/deleted in the provided ' + moduleName + ' record.'}
+        if len(records) == 0:
+            return result
 
-    return {'message': 'The given file removed from the provided ' + moduleName + ' record.'}
+        recordIds = [record['_id'] for record in records]
+        updateResult = await collection.update_many({'$and': [query, {'_id': {'$in': recordIds}}]}, update)
 
+        lastId = recordIds[-1]
+        result['matchedCount'] += updateResult.matched_count
+        result['modifiedCount'] += updateResult.modified_count
 
-async def add_relationship(moduleName: str, recordId: str, requestData: dict) -> dict:
+        if reportProgress is not None:
+            await reportProgress(dict(result))
+
+
+# A soft delete only sets deleted_at, the recycle bin purge does the heavy cleanup later
+def build_soft_delete_update() -> dict:
+    deletedAt = datetime.datetime.now()
+    return {
+        '$set': {'deleted_at': deletedAt, 'modified_by': 'system_update', 'modified_at': deletedAt},
+        '$inc': {'version': 1}
+    }
+
+
+async def soft_delete_records(collection, query: dict, reportProgress=None) -> int:
+    result = await update_records_in_batches(collection, query, build_soft_delete_update(), reportProgress)
+
+    return result['modifiedCount']
+
+
+async def delete_record(moduleName: str, recordId: str, deleteMode: str = 'soft') -> dict:
     try:
-        if moduleName not in moduleUniqueFields:
+        if await get_module_schema(moduleName) is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
-        logger.debug(moduleFieldTypes[moduleName])
-        if requestData['field_name'] not in moduleFieldTypes[moduleName]:
-            return {'type': 'error', 'message': requestData['field_name'] + ' is not present in ' + moduleName + '.'}
+        if deleteMode not in deleteModes:
+            return {
+                'type': 'error',
+                'message': 'Delete mode has to be one of ' + str(sorted(deleteModes)) + '.'
+            }
 
         collection = database.get_collection('module_' + moduleName)
 
-        updatedDoc = await collection.update_one({'_id': ObjectId(recordId)},
-                                                 {'$push': {requestData['field_name']: requestData['related_record_id']},
-                                                  '$set': {'modified_by': 'system_update', 'modified_at': datetime.datetime.now()}})
+        if deleteMode == 'soft':
+            # One record needs no batches, a single update does it
+            updateResult = await collection.update_one(get_live_record_filter(recordId), build_soft_delete_update())
+            if updateResult.modified_count == 0:
+                return {'type': 'error', 'message': 'No relevant ' + moduleName + ' record found for the provided record Id to be deleted.'}
 
-        if updatedDoc and updatedDoc.modified_count == 1:
-            return {'message': str(updatedDoc.modified_count) + ' ' + moduleName + ' record has been updated.'}
+            count_cache.record_deleted(collection.name)
+            return {'message': 'A ' + moduleName + ' record moved to the recycle bin.'}
+
+        # Records already in the recycle bin can be deleted permanently as well
+        resultDoc = await collection.find_one_and_delete({'_id': ObjectId(recordId)})
+
+        if resultDoc is None:
+            return {'type': 'error', 'message': 'No relevant ' + moduleName + ' record found for the provided record Id to be deleted.'}
+
+        if 'deleted_at' not in resultDoc:
+            count_cache.record_deleted(collection.name)
+        await change_feed.record_tombstones(moduleName, [resultDoc])
+        await relationship.remove_record_relationships(moduleName, [recordId])
+
+        await attachment.queue_attachment_cleanup(
+            [attachmentFile['file_id'] for attachmentFile in resultDoc['attachments']])
+
+        # logger.debug(resultDoc)
+
+        return {'message': 'A ' + moduleName + ' record deleted successfully.'}
 
-        return {'type': 'error', 'message': 'A ' + requestData['field_name'] + ' record could not be added to ' + moduleName + ' record.'}
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
         return {'type': 'exception',
@@ -647,29 +1158,117 @@ async def add_relationship(moduleName: str, recordId: str, requestData: dict) ->
                 'message': 'An error has occured.'}
 
 
-async def delete_relationship(moduleName: str, recordId: str, requestData: dict) -> dict:
+async def delete_records_chunk(moduleName: str, collection, records: list, fileIds: list) -> int:
+    recordIds = [record['_id'] for record in records]
+    result = await collection.delete_many({'_id': {'$in': recordIds}})
+    await change_feed.record_tombstones(moduleName, records)
+    await relationship.remove_record_relationships(moduleName, recordIds)
+    await attachment.queue_attachment_cleanup(fileIds)
+
+    return result.deleted_count
+
+
+async def delete_records_in_bulk(moduleName: str, requestData: dict, activityTypes: list = None,
+                                 reportProgress=None) -> dict:
     try:
-        if moduleName not in moduleUniqueFields:
+        moduleSchema = await get_module_schema(moduleName)
+
+        if moduleSchema is None:
             return {
                 'type': 'error',
                 'message': 'Module ' + moduleName + ' is not present in the system.'
             }
 
-        if requestData['field_name'] not in moduleFieldTypes[moduleName]:
-            return {'type': 'error', 'message': requestData['field_name'] + ' is not present in ' + moduleName + '.'}
+        deleteMode = requestData['delete_mode'] if 'delete_mode' in requestData else 'soft'
+        if deleteMode not in deleteModes:
+            return {
+                'type': 'error',
+                'message': 'Delete mode has to be one of ' + str(sorted(deleteModes)) + '.'
+            }
+
+        filterQuery = build_filter_query(moduleName, moduleSchema, requestData, activityTypes)
+        if 'type' in filterQuery:
+            return filterQuery
 
         collection = database.get_collection('module_' + moduleName)
 
-        resultDoc = await collection.update_one({'_id': ObjectId(recordId)}, {
-            '$pull': {requestData['field_name']: requestData['related_record_id']}})
+        if deleteMode == 'soft':
+            deletedCount = await soft_delete_records(collection, filterQuery['query'], reportProgress)
+            count_cache.record_deleted(collection.name, deletedCount)
 
-        if resultDoc is None or resultDoc.modified_count == 0:
-            return {'type': 'error', 'message': 'the reference of given ' + requestData['field_name'] + ' record not found/deleted in the provided ' + moduleName + ' record.'}
+            return {
+                'deletedCount': deletedCount,
+                'message': str(deletedCount) + ' ' + moduleName + ' records moved to the recycle bin.'
+            }
+
+        deletedCount = 0
+        records = []
+        fileIds = []
 
-        return {'message': 'The given ' + requestData['field_name'] + ' record removed from the provided ' + moduleName + ' record.'}
+        projection = {'attachments.file_id': 1}
+        if moduleName == 'Activity':
+            projection['activity_type'] = 1
+
+        # Attachments are collected before the records go, their files are
+        # removed later by the attachment cleanup
+        async for record in collection.find(filterQuery['query'], projection=projection,
+                                            batch_size=bulkDeleteChunkSize):
+            if 'attachments' in record:
+                fileIds.extend([attachmentFile['file_id'] for attachmentFile in record.pop('attachments')])
+            records.append(record)
+
+            if len(records) == bulkDeleteChunkSize:
+                deletedCount += await delete_records_chunk(moduleName, collection, records, fileIds)
+                records = []
+                fileIds = []
+                if reportProgress is not None:
+                    await reportProgress({'deletedCount': deletedCount})
+
+        if len(records) > 0:
+            deletedCount += await delete_records_chunk(moduleName, collection, records, fileIds)
+            if reportProgress is not None:
+                await reportProgress({'deletedCount': deletedCount})
+
+        count_cache.record_deleted(collection.name, deletedCount)
+
+        return {
+            'deletedCount': deletedCount,
+            'message': str(deletedCount) + ' ' + moduleName + ' records deleted.'
+        }
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
         return {'type': 'exception',
                 'errorType': str(type(e).__name__),
                 'errorMessage': str(e),
                 'message': 'An error has occured.'}
+
+
+async def delete_attchment_from_api(moduleName: str, recordId: str, fileId: str) -> dict:
+    collection = database.get_collection('module_' + moduleName)
+
+    resultDoc = await collection.update_one({'_id': ObjectId(recordId)}, {
+        '$pull': {'attachments': {'file_id': fileId}}})
+
+    if resultDoc is None or resultDoc.modified_count == 0:
+        return {'type': 'error', 'message': 'the reference of given file not found/deleted in the provided ' + moduleName + ' record.'}
+
+    count_cache.invalidate_filtered_counts(collection.name)
+
+    return {'message': 'The given file removed from the provided ' + moduleName + ' record.'}
+
+
+def get_related_record_ids(requestData: dict) -> list:
+    if 'related_record_ids' in requestData:
+        return requestData['related_record_ids']
+
+    return [requestData['related_record_id']]
+
+
+async def add_relationship(moduleName: str, recordId: str, requestData: dict) -> dict:
+    return await relationship.add_relationships(
+        moduleName, recordId, requestData['field_name'], get_related_record_ids(requestData))
+
+
+async def delete_relationship(moduleName: str, recordId: str, requestData: dict) -> dict:
+    return await relationship.remove_relationships(
+        moduleName, recordId, requestData['field_name'], get_related_record_ids(requestData))
@@ -0,0 +1,93 @@
+import base64
+from bson import json_util
+
+paginationModes = {'offset', 'cursor'}
+
+
+def get_sort_value(record: dict, fieldName: str) -> any:
+    value = record
+    for fieldPart in fieldName.split('.'):
+        if not isinstance(value, dict) or fieldPart not in value:
+            return None
+        value = value[fieldPart]
+
+    return value
+
+
+def add_tie_breaker(sortFields: list) -> list:
+    keysetSortFields = [sortField for sortField in sortFields if sortField[0] != '_id']
+    keysetSortFields.append(
+        ('_id', keysetSortFields[0][1] if len(keysetSortFields) > 0 else 1))
+
+    return keysetSortFields
+
+
+def encode_cursor(sortFields: list, record: dict) -> str:
+    cursorData = {
+        'sort': [[fieldName, order] for fieldName, order in sortFields],
+        'values': [get_sort_value(record, fieldName) for fieldName, _ in sortFields]
+    }
+
+    return base64.urlsafe_b64encode(json_util.dumps(cursorData).encode()).decode()
+
+
+def decode_cursor(cursor: str, sortFields: list) -> list:
+    try:
+        cursorData = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('The cursor provided is not valid.')
+
+    if cursorData['sort'] != [[fieldName, order] for fieldName, order in sortFields]:
+        raise ValueError('The cursor provided does not match the sort order.')
+
+    return cursorData['values']
+
+
+# Null and missing values sort before everything else, and $gt/$lt never
+# match across them, so they are handled on their own
+def build_after_clause(fieldName: str, order: int, value: any) -> dict:
+    if value is None:
+        # Ascending, every non-null value comes next. Descending, nothing does.
+        return {fieldName: {'$ne': None}} if order == 1 else None
+
+    if order == 1:
+        return {fieldName: {'$gt': value}}
+
+    # _id is never null, it keeps the plain range the index seeks on
+    if fieldName == '_id':
+        return {fieldName: {'$lt': value}}
+
+    return {'$or': [{fieldName: {'$lt': value}}, {fieldName: None}]}
+
+
+# Matches documents strictly after the cursor position in the sort order, e.g.
+# (a > x) OR (a == x AND _id > y) for a single sort field plus the _id tie-breaker
+def build_keyset_query(sortFields: list, values: list) -> dict:
+    orClauses = []
+
+    for i, (fieldName, order) in enumerate(sortFields):
+        afterClause = build_after_clause(fieldName, order, values[i])
+        if afterClause is None:
+            continue
+
+        clause = {}
+        for j in range(i):
+            clause[sortFields[j][0]] = values[j]
+        clause.update(afterClause)
+        orClauses.append(clause)
+
+    if len(orClauses) == 0:
+        # Only reachable without an _id tie-breaker, nothing sorts after the cursor
+        return {'_id': {'$exists': False}}
+
+    return {'$or': orClauses}
+
+
+def add_keyset_query(query: dict, sortFields: list, cursor: str) -> dict:
+    keysetQuery = build_keyset_query(
+        sortFields, decode_cursor(cursor, sortFields))
+
+    if not query:
+        return keysetQuery
+
+    return {'$and': [query, keysetQuery]}
@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from ..core.config import logger, dictProfiles, permissionMatrix
+from . import local_data
+
+# Task, Event and Call permissions all apply to records of the Activity module
+activityModules = frozenset({'Task', 'Event', 'Call'})
+# Other processes may change profiles, so the matrix is reloaded after this
+permissionMatrixTtlSeconds = 60
+# The pre-defined profile allowed to administer module schemas and whole collections
+administratorProfileName = 'Administrator'
+
+
+def compile_profile(profileDoc: dict) -> dict:
+    moduleOperations = {}
+    for profileModule in profileDoc['modules'] if 'modules' in profileDoc else []:
+        moduleOperations[profileModule['module_name']] = frozenset(profileModule['operations'])
+
+    return {
+        'modules': moduleOperations,
+        'import_records': frozenset(profileDoc['import_records'] if 'import_records' in profileDoc else []),
+        'export_records': frozenset(profileDoc['export_records'] if 'export_records' in profileDoc else [])
+    }
+
+
+# Built off to the side and swapped in with one assignment, a check never
+# sees a half built matrix
+def compile_permission_matrix():
+    permissionMatrix['profiles'] = {profileName: compile_profile(profileDoc)
+                                    for profileName, profileDoc in dictProfiles.items()}
+    permissionMatrix['compiled_at'] = time.monotonic()
+    permissionMatrix['reloading'] = False
+    logger.debug('Permission matrix compiled for ' + str(len(permissionMatrix['profiles'])) + ' profiles.')
+
+
+async def reload_permission_matrix():
+    try:
+        await local_data.load_profiles()
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        permissionMatrix['reloading'] = False
+
+
+def get_compiled_profile(profileName: str) -> dict:
+    # Checks keep using the current matrix while a reload runs
+    if time.monotonic() - permissionMatrix['compiled_at'] >= permissionMatrixTtlSeconds \
+            and not permissionMatrix['reloading']:
+        permissionMatrix['reloading'] = True
+        asyncio.ensure_future(reload_permission_matrix())
+
+    return permissionMatrix['profiles'].get(profileName)
+
+
+def get_allowed_modules(profileName: str, operation: str) -> set:
+    compiledProfile = get_compiled_profile(profileName)
+    if compiledProfile is None:
+        return set()
+
+    return {moduleName for moduleName, operations in compiledProfile['modules'].items()
+            if operation in operations}
+
+
+# For Activity the answer is the activity types allowed, an empty list means none
+def get_allowed_activity_types(profileName: str, operation: str) -> list:
+    return sorted(get_allowed_modules(profileName, operation) & activityModules)
+
+
+def is_administrator(profileName: str) -> bool:
+    return profileName == administratorProfileName and get_compiled_profile(profileName) is not None
+
+
+def is_operation_allowed(profileName: str, moduleName: str, operation: str) -> bool:
+    compiledProfile = get_compiled_profile(profileName)
+    if compiledProfile is None:
+        return False
+
+    if moduleName == 'Activity':
+        return len(get_allowed_activity_types(profileName, operation)) > 0
+
+    return moduleName in compiledProfile['modules'] and operation in compiledProfile['modules'][moduleName]
+
+
+# dataRecords is either 'import_records' or 'export_records'
+def get_allowed_data_records(profileName: str, dataRecords: str) -> frozenset:
+    compiledProfile = get_compiled_profile(profileName)
+    if compiledProfile is None:
+        return frozenset()
+
+    return compiledProfile[dataRecords]
+
+
+def get_data_records_activity_types(profileName: str, dataRecords: str) -> list:
+    return sorted(get_allowed_data_records(profileName, dataRecords) & activityModules)
+
+
+def is_data_records_allowed(profileName: str, moduleName: str, dataRecords: str) -> bool:
+    if moduleName == 'Activity':
+        return len(get_data_records_activity_types(profileName, dataRecords)) > 0
+
+    return moduleName in get_allowed_data_records(profileName, dataRecords)
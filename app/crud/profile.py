@@ -4,6 +4,7 @@ import datetime
 from ..db import setup_collection
 from ..core.config import (
     logger, collectionModuleFields, collectionProfile, collectionUser)
+from . import count_cache, local_data
 
 dictModuleOperations = dict()
 setModuleImportRecords = set()
@@ -494,6 +495,8 @@ async def create_profile(requestData: dict) -> dict:
         profileData['modified_at'] = datetime.datetime.now()
 
         result = await collectionProfile.insert_one(profileData)
+        count_cache.record_inserted(collectionProfile.name)
+        await local_data.load_profiles()
 
         return {'message': 'New profile record created.', 'id': str(result.inserted_id)}
     except Exception as e:
@@ -513,7 +516,7 @@ async def get_profiles_list_with_options(start: int, length: int, search: str) -
         if len(search) > 0:
             query['profile_name'] = {'$regex': '^' + search, '$options': 'i'}
 
-        recordCount = await collectionProfile.count_documents(query)
+        recordCount = (await count_cache.get_count(collectionProfile, query))['count']
         profiles = collectionProfile.find(query, projection={
                                           'profile_name': 1, '_id': 0}).skip(
                                               start).limit(length).sort(sortFields)
@@ -554,7 +557,7 @@ async def get_profiles_list_for_datatables(start: int, length: int, sortBy: str,
                 }
             )
 
-        recordCount = await collectionProfile.count_documents(query)
+        recordCount = (await count_cache.get_count(collectionProfile, query))['count']
         records = collectionProfile.find(
             query,
             projection={
@@ -782,6 +785,9 @@ async def update_profile(recordId: str, requestData: dict) -> dict:
             {'_id': ObjectId(recordId)},
             {'$set': profileData}
         )
+        count_cache.invalidate_filtered_counts(collectionProfile.name)
+        await local_data.load_profiles()
+
         return {'message': str(result.modified_count) + ' profile record updated.'}
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
@@ -822,39 +828,3 @@ async def get_users_list_by_profile(profileName: str) -> dict:
                 'errorType': str(type(e).__name__),
                 'errorMessage': str(e),
                 'message': 'An error has occured.'}
-
-
-async def get_count_by_profile_module_operation(profileName: str, moduleName: str, operation: str, activityList: list = []) -> int:
-    if moduleName == 'Activity':
-        profileCount = await collectionProfile.count_documents(
-            {
-                'profile_name': profileName,
-                'modules.module_name': {'$in': ['Task', 'Event', 'Call']},
-                'modules.operations': operation
-            }
-        )
-
-        if profileCount:
-            profileDoc = await collectionProfile.find_one(
-                {
-                    'profile_name': profileName,
-                    'modules.module_name': {'$in': ['Task', 'Event', 'Call']},
-                    'modules.operations': operation
-                },
-                projection={'modules': 1,
-                            'operations': 1}
-            )
-
-            for module in profileDoc['modules']:
-                if module['module_name'] in {'Task', 'Event', 'Call'} \
-                        and operation in module['operations']:
-                    activityList.append(module['module_name'])
-        return profileCount
-
-    return await collectionProfile.count_documents(
-        {
-            'profile_name': profileName,
-            'modules.module_name': moduleName,
-            'modules.operations': operation
-        }
-    )
@@ -0,0 +1,85 @@
+import csv
+import io
+import json
+
+exportMediaTypes = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+exportBatchSize = 500
+
+
+def get_export_columns(moduleName: str, moduleSchema: dict) -> list:
+    columns = ['_id']
+
+    if moduleName == 'Activity':
+        columns.append('activity_type')
+        for activityFields in moduleSchema['activity_fields'].values():
+            for activityField in activityFields:
+                if activityField['field_name'] not in columns:
+                    columns.append(activityField['field_name'])
+    else:
+        for moduleField in moduleSchema['module_fields']:
+            columns.append(moduleField['field_name'])
+
+    return columns
+
+
+def convert_export_value(value: any) -> any:
+    if isinstance(value, bytes):
+        return value.decode()
+
+    return str(value)
+
+
+def format_csv_value(value: any) -> any:
+    if value is None:
+        return ''
+
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=convert_export_value)
+
+    if isinstance(value, bytes):
+        return value.decode()
+
+    return value
+
+
+def format_csv_rows(columns: list, records: list) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for record in records:
+        writer.writerow([format_csv_value(record[column]) if column in record else ''
+                         for column in columns])
+
+    return buffer.getvalue()
+
+
+def format_ndjson_rows(records: list) -> str:
+    return ''.join([json.dumps(record, default=convert_export_value) + '\n'
+                    for record in records])
+
+
+# Only one batch of decoded records is held at a time, so memory stays flat
+# no matter how many records the cursor returns
+async def stream_records(records, decodeRecord, exportFormat: str, columns: list):
+    if exportFormat == 'csv':
+        yield format_csv_rows(columns, [dict(zip(columns, columns))])
+
+    batch = []
+    async for record in records:
+        batch.append(decodeRecord(record))
+
+        if len(batch) == exportBatchSize:
+            if exportFormat == 'csv':
+                yield format_csv_rows(columns, batch)
+            else:
+                yield format_ndjson_rows(batch)
+            batch = []
+
+    if len(batch) > 0:
+        if exportFormat == 'csv':
+            yield format_csv_rows(columns, batch)
+        else:
+            yield format_ndjson_rows(batch)
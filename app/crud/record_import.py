@@ -0,0 +1,273 @@
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import datetime
+import tempfile
+import json
+import csv
+import os
+
+from ..core.config import logger, database, collectionImportJob
+from . import module, count_cache, recycle_bin
+
+importBatchSize = 1000
+importUploadChunkSize = 1024 * 1024
+importMaxStoredErrors = 100
+importInsertOnlyFields = {'created_by', 'created_at'}
+
+
+def compile_csv_parser(moduleField: dict):
+    bsonType = moduleField['bson_type']
+
+    if bsonType == 'int':
+        return int
+
+    if bsonType == 'bool':
+        return lambda value: value.strip().lower() in {'true', '1', 'yes'}
+
+    # Nested values are written as JSON by the export, read them back the same way
+    if bsonType == 'object' or bsonType == 'array':
+        return json.loads
+
+    return lambda value: value
+
+
+def compile_csv_parsers(moduleName: str, moduleSchema: dict) -> dict:
+    csvParsers = {}
+
+    if moduleName == 'Activity':
+        csvParsers['activity_type'] = lambda value: value
+        for activityFields in moduleSchema['activity_fields'].values():
+            for activityField in activityFields:
+                csvParsers[activityField['field_name']] = compile_csv_parser(activityField)
+    else:
+        for moduleField in moduleSchema['module_fields']:
+            csvParsers[moduleField['field_name']] = compile_csv_parser(moduleField)
+
+    return csvParsers
+
+
+def parse_csv_row(header: list, row: list, columnMap: dict, csvParsers: dict) -> dict:
+    requestData = {}
+
+    for column, value in zip(header, row):
+        fieldName = columnMap[column] if column in columnMap else column
+
+        # Empty cells fall back to the field defaults
+        if fieldName not in csvParsers or value == '':
+            continue
+
+        requestData[fieldName] = csvParsers[fieldName](value)
+
+    return requestData
+
+
+def build_import_operation(document: dict, uniqueFields: list):
+    if len(uniqueFields) == 0:
+        return InsertOne(document)
+
+    # A record in the recycle bin is not updated, the row makes a new one
+    uniqueFilter = recycle_bin.get_live_record_query()
+    for uniqueField in uniqueFields:
+        uniqueFilter[uniqueField] = document[uniqueField]
+
+    setFields = {}
+    setOnInsertFields = {}
+    for fieldName, fieldValue in document.items():
+        if fieldName in importInsertOnlyFields:
+            setOnInsertFields[fieldName] = fieldValue
+        else:
+            setFields[fieldName] = fieldValue
+
+    return UpdateOne(uniqueFilter, {'$set': setFields, '$setOnInsert': setOnInsertFields}, upsert=True)
+
+
+def add_import_error(progress: dict, rowNumber: int, message: str):
+    progress['failed'] += 1
+
+    if len(progress['errors']) < importMaxStoredErrors:
+        progress['errors'].append({'row': rowNumber, 'message': message})
+
+
+async def write_import_batch(collection, batch: list, progress: dict):
+    try:
+        result = await collection.bulk_write([operation for _, operation in batch], ordered=False)
+        insertedCount = result.inserted_count + result.upserted_count
+        updatedCount = result.matched_count
+
+    except BulkWriteError as e:
+        insertedCount = e.details['nInserted'] + e.details['nUpserted']
+        updatedCount = e.details['nMatched']
+        for writeError in e.details['writeErrors']:
+            add_import_error(progress, batch[writeError['index']][0], writeError['errmsg'])
+
+    progress['inserted'] += insertedCount
+    progress['updated'] += updatedCount
+
+    count_cache.record_inserted(collection.name, insertedCount)
+    if updatedCount > 0:
+        count_cache.invalidate_filtered_counts(collection.name)
+
+
+async def update_import_job(jobId: ObjectId, updateData: dict):
+    await collectionImportJob.update_one({'_id': jobId}, {'$set': updateData})
+
+
+async def save_import_file(uploadFile) -> str:
+    importFile = tempfile.NamedTemporaryFile(
+        mode='wb', prefix='import_', suffix='.csv', delete=False)
+
+    with importFile:
+        chunk = await uploadFile.read(importUploadChunkSize)
+        while chunk:
+            importFile.write(chunk)
+            chunk = await uploadFile.read(importUploadChunkSize)
+
+    return importFile.name
+
+
+async def create_import_job(moduleName: str, uploadFile, columnMap: dict, currentUser: dict) -> dict:
+    try:
+        moduleSchema = await module.get_module_schema(moduleName)
+
+        if moduleSchema is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        filePath = await save_import_file(uploadFile)
+
+        jobData = {
+            'module_name': moduleName,
+            'file_name': uploadFile.filename,
+            'column_map': columnMap,
+            'status': 'queued',
+            'processed': 0,
+            'inserted': 0,
+            'updated': 0,
+            'failed': 0,
+            'errors': [],
+            'created_by': currentUser['email'],
+            'created_at': datetime.datetime.now()
+        }
+        result = await collectionImportJob.insert_one(jobData)
+
+        return {
+            'id': str(result.inserted_id),
+            'file_path': filePath,
+            'message': moduleName + ' import has been queued.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+# Runs on the job queue. The file is read row by row and written in
+# batches, so only one batch of documents is held in memory at a time.
+async def report_import_progress(progress: dict, reportProgress):
+    if reportProgress is not None:
+        await reportProgress({'processed': progress['processed'], 'inserted': progress['inserted'],
+                              'updated': progress['updated'], 'failed': progress['failed']})
+
+
+async def run_import_job(jobId: str, moduleName: str, filePath: str, columnMap: dict,
+                         activityTypes: list = None, reportProgress=None):
+    jobId = ObjectId(jobId)
+    progress = {'processed': 0, 'inserted': 0, 'updated': 0, 'failed': 0, 'errors': []}
+
+    try:
+        moduleSchema = await module.get_module_schema(moduleName)
+        collection = database.get_collection('module_' + moduleName)
+        csvParsers = compile_csv_parsers(moduleName, moduleSchema)
+        uniqueFields = moduleSchema['unique_fields']
+
+        await update_import_job(jobId, {'status': 'running', 'started_at': datetime.datetime.now()})
+
+        with open(filePath, newline='', encoding='utf-8-sig') as importFile:
+            csvReader = csv.reader(importFile)
+            header = next(csvReader, None)
+
+            if header is None:
+                raise ValueError('The uploaded file is empty.')
+
+            batch = []
+            rowNumber = 1
+            for row in csvReader:
+                rowNumber += 1
+                progress['processed'] += 1
+
+                try:
+                    requestData = parse_csv_row(header, row, columnMap, csvParsers)
+
+                    if activityTypes is not None and 'activity_type' in requestData \
+                            and requestData['activity_type'] not in activityTypes:
+                        prepared = {'type': 'error',
+                                    'message': 'Import not allowed for ' + requestData['activity_type'] + '.'}
+                    else:
+                        prepared = module.prepare_module_record(moduleName, moduleSchema, requestData)
+                except Exception as e:
+                    prepared = {'type': 'error', 'message': str(type(e).__name__) + ': ' + str(e)}
+
+                if 'type' in prepared:
+                    add_import_error(progress, rowNumber, prepared['message'])
+                    continue
+
+                batch.append((rowNumber, build_import_operation(prepared['document'], uniqueFields)))
+
+                if len(batch) == importBatchSize:
+                    await write_import_batch(collection, batch, progress)
+                    await update_import_job(jobId, progress)
+                    await report_import_progress(progress, reportProgress)
+                    batch = []
+
+            if len(batch) > 0:
+                await write_import_batch(collection, batch, progress)
+                await report_import_progress(progress, reportProgress)
+
+        progress['status'] = 'completed'
+        progress['finished_at'] = datetime.datetime.now()
+        await update_import_job(jobId, progress)
+
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        progress['status'] = 'failed'
+        progress['message'] = str(type(e).__name__) + ': ' + str(e)
+        progress['finished_at'] = datetime.datetime.now()
+        await update_import_job(jobId, progress)
+
+    finally:
+        # A retried job finds the file already removed by the attempt before
+        if os.path.exists(filePath):
+            os.remove(filePath)
+
+
+async def get_import_job(moduleName: str, jobId: str) -> dict:
+    try:
+        jobDoc = await collectionImportJob.find_one(
+            {'_id': ObjectId(jobId), 'module_name': moduleName},
+            projection={'column_map': 0})
+
+        if jobDoc is None:
+            return {'type': 'error', 'message': 'No ' + moduleName + ' import found for the provided job Id.'}
+
+        jobDoc['_id'] = str(jobDoc['_id'])
+        for dateField in ['created_at', 'started_at', 'finished_at']:
+            if dateField in jobDoc:
+                jobDoc[dateField] = jobDoc[dateField].isoformat()
+
+        return {'job': jobDoc, 'message': moduleName + ' import status retrieved successfully.'}
+
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
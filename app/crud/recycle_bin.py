@@ -0,0 +1,195 @@
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import asyncio
+import datetime
+
+from ..core.config import logger, database, moduleSchemas
+from . import module, field_codec, count_cache, job_queue
+
+# Soft deleted records carry deleted_at until the purge removes them for good
+liveRecordQuery = {'deleted_at': {'$exists': False}}
+deletedRecordQuery = {'deleted_at': {'$exists': True}}
+recycleBinPageLimit = 1000
+recycleBinRetentionDays = 30
+recycleBinPurgeBatchSize = 1000
+recycleBinPurgeIntervalSeconds = 60 * 60
+recycleBinPurgeState = {'running': False}
+
+
+def get_live_record_query() -> dict:
+    return dict(liveRecordQuery)
+
+
+async def get_recycle_bin(moduleName: str, start: int, length: int, activityTypes: list = None) -> dict:
+    try:
+        moduleSchema = await module.get_module_schema(moduleName)
+
+        if moduleSchema is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        if length < 1 or length > recycleBinPageLimit:
+            return {
+                'type': 'error',
+                'message': 'Length has to be between 1 and ' + str(recycleBinPageLimit) + '.'
+            }
+
+        query = dict(deletedRecordQuery)
+        if moduleName == 'Activity' and activityTypes is not None:
+            query['activity_type'] = {'$in': activityTypes}
+
+        # Both read the deleted_at partial index, live records are not in it
+        collection = database.get_collection('module_' + moduleName)
+        records = await collection.find(query).sort([('deleted_at', -1), ('_id', -1)]) \
+            .skip(start).limit(length).to_list(length)
+        recordsTotal = await collection.count_documents(query)
+
+        for record in records:
+            activityType = record['activity_type'] if moduleName == 'Activity' else None
+            field_codec.decode_record(module.get_module_codec(moduleSchema, activityType), record)
+            record['deleted_at'] = record['deleted_at'].isoformat()
+
+        return {
+            'records': records,
+            'recordsTotal': recordsTotal,
+            'message': 'Deleted records retrieved successfully.' if len(records) > 0 else 'No record found.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def restore_records(moduleName: str, requestData: dict, activityTypes: list = None) -> dict:
+    try:
+        if await module.get_module_schema(moduleName) is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + moduleName + ' is not present in the system.'
+            }
+
+        recordIds = requestData['record_id'] if 'record_id' in requestData else []
+        if len(recordIds) == 0 or len(recordIds) > recycleBinPageLimit:
+            return {
+                'type': 'error',
+                'message': 'Between 1 and ' + str(recycleBinPageLimit) + ' records can be restored at once.'
+            }
+
+        modifiedAt = datetime.datetime.now()
+        operations = []
+        for recordId in recordIds:
+            query = dict(deletedRecordQuery)
+            query['_id'] = ObjectId(recordId)
+            if moduleName == 'Activity' and activityTypes is not None:
+                query['activity_type'] = {'$in': activityTypes}
+
+            operations.append(UpdateOne(query, {
+                '$unset': {'deleted_at': ''},
+                '$set': {'modified_by': 'system_update', 'modified_at': modifiedAt},
+                '$inc': {'version': 1}
+            }))
+
+        # A record whose unique values were taken by a live record since it
+        # was deleted stays in the recycle bin, the others are restored
+        collection = database.get_collection('module_' + moduleName)
+        conflictIds = []
+        try:
+            result = await collection.bulk_write(operations, ordered=False)
+            restoredCount = result.modified_count
+        except BulkWriteError as e:
+            for writeError in e.details['writeErrors']:
+                if writeError['code'] != 11000:
+                    raise
+                conflictIds.append(recordIds[writeError['index']])
+            restoredCount = e.details['nModified']
+
+        count_cache.record_inserted(collection.name, restoredCount)
+
+        message = str(restoredCount) + ' ' + moduleName + ' records restored.'
+        if len(conflictIds) > 0:
+            message += ' ' + str(len(conflictIds)) + ' records clash with the unique fields of live records.'
+
+        return {
+            'restoredCount': restoredCount,
+            'conflictIds': conflictIds,
+            'message': message
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
+
+
+async def purge_module_records(moduleName: str, purgeBefore: datetime.datetime) -> int:
+    collection = database.get_collection('module_' + moduleName)
+    projection = {'attachments.file_id': 1, 'deleted_at': 1}
+    if moduleName == 'Activity':
+        projection['activity_type'] = 1
+
+    purgedCount = 0
+    while True:
+        records = await collection.find({'deleted_at': {'$lte': purgeBefore}}, projection=projection) \
+            .limit(recycleBinPurgeBatchSize).to_list(recycleBinPurgeBatchSize)
+
+        if len(records) == 0:
+            return purgedCount
+
+        fileIds = []
+        for record in records:
+            if 'attachments' in record:
+                fileIds.extend([attachmentFile['file_id'] for attachmentFile in record.pop('attachments')])
+
+        # Relationships, tombstones and the attachment queue go with the records
+        purgedCount += await module.delete_records_chunk(moduleName, collection, records, fileIds)
+
+
+async def purge_recycle_bin() -> dict:
+    purgeBefore = datetime.datetime.now() - datetime.timedelta(days=recycleBinRetentionDays)
+    results = {}
+
+    for moduleName in list(moduleSchemas):
+        purgedCount = await purge_module_records(moduleName, purgeBefore)
+        if purgedCount > 0:
+            results[moduleName] = purgedCount
+            logger.debug(str(purgedCount) + ' ' + moduleName + ' records purged from the recycle bin.')
+
+    return results
+
+
+def get_next_purge_at() -> datetime.datetime:
+    now = datetime.datetime.now()
+    intervalStart = int(now.timestamp()) // recycleBinPurgeIntervalSeconds * recycleBinPurgeIntervalSeconds
+    return datetime.datetime.fromtimestamp(intervalStart + recycleBinPurgeIntervalSeconds)
+
+
+# Every process asks for the purge at the same interval boundary, the singleton
+# job leaves one of them queued and a single worker runs it
+async def run_recycle_bin_purge():
+    try:
+        while True:
+            result = await job_queue.enqueue_job('module.recycle_bin_purge', {}, singleton=True,
+                                                 runAt=get_next_purge_at())
+            if 'type' in result:
+                logger.error('recycle bin purge could not be queued: ' + result['message'])
+
+            await asyncio.sleep(recycleBinPurgeIntervalSeconds)
+
+    finally:
+        recycleBinPurgeState['running'] = False
+
+
+def start_recycle_bin_purge():
+    if not recycleBinPurgeState['running']:
+        recycleBinPurgeState['running'] = True
+        asyncio.ensure_future(run_recycle_bin_purge())
@@ -0,0 +1,285 @@
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+import datetime
+
+from ..core.config import logger, database, collectionRelationship
+from . import module, job_queue, recycle_bin
+
+relationshipBatchLimit = 1000
+relationshipPageLimit = 1000
+# Embedded links are arrays of plain record ids
+relationshipIdTypes = {'string', 'objectId'}
+
+
+async def validate_relationship(moduleName: str, fieldName: str, relatedRecordIds: list) -> dict:
+    moduleSchema = await module.get_module_schema(moduleName)
+
+    if moduleSchema is None:
+        return {
+            'type': 'error',
+            'message': 'Module ' + moduleName + ' is not present in the system.'
+        }
+
+    if fieldName not in module.get_module_field_names(moduleName, moduleSchema):
+        return {'type': 'error', 'message': fieldName + ' is not present in ' + moduleName + '.'}
+
+    # Arrays of objects, such as attachments, and plain fields are not links
+    if fieldName not in get_relationship_field_names(moduleName, moduleSchema):
+        return {'type': 'error', 'message': fieldName + ' of ' + moduleName + ' is not a list of record ids.'}
+
+    if relatedRecordIds is not None \
+            and (len(relatedRecordIds) == 0 or len(relatedRecordIds) > relationshipBatchLimit):
+        return {
+            'type': 'error',
+            'message': 'Between 1 and ' + str(relationshipBatchLimit) + ' related records can be changed at once.'
+        }
+
+    return {}
+
+
+def get_relationship_field_names(moduleName: str, moduleSchema: dict) -> set:
+    # Cached on the schema, a schema reload swaps in fresh dicts
+    if 'relationship_fields' not in moduleSchema:
+        if moduleName == 'Activity':
+            moduleFields = []
+            for activityFields in moduleSchema['activity_fields'].values():
+                moduleFields.extend(activityFields)
+        else:
+            moduleFields = moduleSchema['module_fields']
+
+        moduleSchema['relationship_fields'] = {
+            moduleField['field_name'] for moduleField in moduleFields
+            if moduleField['bson_type'] == 'array' and len(moduleField['field_array_element']) == 1
+            and moduleField['field_array_element'][0]['bson_type'] in relationshipIdTypes}
+
+    return moduleSchema['relationship_fields']
+
+
+async def validate_relationship_migration(moduleName: str, fieldName: str) -> dict:
+    return await validate_relationship(moduleName, fieldName, None)
+
+
+async def touch_record(moduleName: str, recordId: str) -> bool:
+    collection = database.get_collection('module_' + moduleName)
+    recordFilter = recycle_bin.get_live_record_query()
+    recordFilter['_id'] = ObjectId(recordId)
+    updatedDoc = await collection.update_one(
+        recordFilter,
+        {'$set': {'modified_by': 'system_update', 'modified_at': datetime.datetime.now()}})
+
+    return updatedDoc.matched_count == 1
+
+
+async def add_relationships(moduleName: str, recordId: str, fieldName: str, relatedRecordIds: list) -> dict:
+    try:
+        result = await validate_relationship(moduleName, fieldName, relatedRecordIds)
+        if 'type' in result:
+            return result
+
+        if not await touch_record(moduleName, recordId):
+            return {'type': 'error', 'message': 'No matching ' + moduleName + ' record found for the relationship.'}
+
+        createdAt = datetime.datetime.now()
+        edges = [{
+            'from_module': moduleName,
+            'from_id': recordId,
+            'field_name': fieldName,
+            'to_id': relatedRecordId,
+            'created_at': createdAt
+        } for relatedRecordId in relatedRecordIds]
+
+        # Links that already exist hit the unique index and are skipped
+        try:
+            insertResult = await collectionRelationship.insert_many(edges, ordered=False)
+            addedCount = len(insertResult.inserted_ids)
+        except BulkWriteError as e:
+            for writeError in e.details['writeErrors']:
+                if writeError['code'] != 11000:
+                    raise
+            addedCount = e.details['nInserted']
+
+        return {
+            'addedCount': addedCount,
+            'message': str(addedCount) + ' ' + fieldName + ' records added to the ' + moduleName + ' record.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+async def remove_relationships(moduleName: str, recordId: str, fieldName: str, relatedRecordIds: list) -> dict:
+    try:
+        result = await validate_relationship(moduleName, fieldName, relatedRecordIds)
+        if 'type' in result:
+            return result
+
+        deleteResult = await collectionRelationship.delete_many({
+            'from_module': moduleName,
+            'from_id': recordId,
+            'field_name': fieldName,
+            'to_id': {'$in': relatedRecordIds}
+        })
+
+        if deleteResult.deleted_count > 0:
+            await touch_record(moduleName, recordId)
+
+        return {
+            'removedCount': deleteResult.deleted_count,
+            'message': str(deleteResult.deleted_count) + ' ' + fieldName + ' records removed from the ' + moduleName + ' record.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+async def get_relationship_page(query: dict, idField: str, start: int, length: int) -> dict:
+    if length < 1 or length > relationshipPageLimit:
+        return {
+            'type': 'error',
+            'message': 'Length has to be between 1 and ' + str(relationshipPageLimit) + '.'
+        }
+
+    edges = collectionRelationship.find(query, projection={idField: 1, 'field_name': 1, '_id': 0}) \
+        .sort([(idField, 1)]).skip(start).limit(length)
+
+    records = await edges.to_list(length)
+    recordsTotal = await collectionRelationship.count_documents(query)
+
+    return {
+        'records': records,
+        'recordsTotal': recordsTotal,
+        'message': 'Related records retrieved successfully.' if len(records) > 0 else 'No record found.'
+    }
+
+
+async def get_related_records(moduleName: str, recordId: str, fieldName: str, start: int, length: int) -> dict:
+    try:
+        result = await validate_relationship(moduleName, fieldName, None)
+        if 'type' in result:
+            return result
+
+        return await get_relationship_page(
+            {'from_module': moduleName, 'from_id': recordId, 'field_name': fieldName},
+            'to_id', start, length)
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+# Reverse lookup, e.g. the Accounts that link a given Contact
+async def get_referencing_records(fromModuleName: str, recordId: str, fieldName: str,
+                                  start: int, length: int) -> dict:
+    try:
+        query = {'to_id': recordId, 'from_module': fromModuleName}
+
+        if fieldName:
+            result = await validate_relationship(fromModuleName, fieldName, None)
+            if 'type' in result:
+                return result
+            query['field_name'] = fieldName
+
+        elif await module.get_module_schema(fromModuleName) is None:
+            return {
+                'type': 'error',
+                'message': 'Module ' + fromModuleName + ' is not present in the system.'
+            }
+
+        return await get_relationship_page(query, 'from_id', start, length)
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+async def queue_relationship_migration(moduleName: str, fieldName: str, createdBy: str) -> dict:
+    try:
+        result = await validate_relationship_migration(moduleName, fieldName)
+        if 'type' in result:
+            return result
+
+        return await job_queue.enqueue_job(
+            'module.relationship_migration', {'module_name': moduleName, 'field_name': fieldName}, createdBy)
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+# Runs on the job queue. Moves ids kept in the record array field into the
+# edge collection and empties the array, one batch of records at a time
+async def migrate_embedded_relationships(moduleName: str, fieldName: str, reportProgress=None) -> dict:
+    try:
+        result = await validate_relationship_migration(moduleName, fieldName)
+        if 'type' in result:
+            return result
+
+        collection = database.get_collection('module_' + moduleName)
+        migratedCount = 0
+        recordCount = 0
+        createdAt = datetime.datetime.now()
+
+        while True:
+            records = await collection.find(
+                {fieldName + '.0': {'$exists': True}},
+                projection={fieldName: 1}).to_list(relationshipBatchLimit)
+
+            if len(records) == 0:
+                break
+
+            edges = []
+            for record in records:
+                for relatedRecordId in record[fieldName]:
+                    edges.append({
+                        'from_module': moduleName,
+                        'from_id': str(record['_id']),
+                        'field_name': fieldName,
+                        'to_id': str(relatedRecordId),
+                        'created_at': createdAt
+                    })
+
+            if len(edges) > 0:
+                try:
+                    await collectionRelationship.insert_many(edges, ordered=False)
+                except BulkWriteError as e:
+                    for writeError in e.details['writeErrors']:
+                        if writeError['code'] != 11000:
+                            raise
+
+            await collection.update_many(
+                {'_id': {'$in': [record['_id'] for record in records]}}, {'$set': {fieldName: []}})
+            migratedCount += len(edges)
+            recordCount += len(records)
+
+            if reportProgress is not None:
+                await reportProgress({'records_done': recordCount, 'relationships_migrated': migratedCount})
+
+        return {
+            'migratedCount': migratedCount,
+            'message': str(migratedCount) + ' ' + fieldName + ' relationships of ' + moduleName + ' migrated.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
+
+
+async def remove_record_relationships(moduleName: str, recordIds: list):
+    recordIds = [str(recordId) for recordId in recordIds]
+
+    await collectionRelationship.delete_many({'from_module': moduleName, 'from_id': {'$in': recordIds}})
+    await collectionRelationship.delete_many({'to_id': {'$in': recordIds}})
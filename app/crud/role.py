@@ -1,16 +1,75 @@
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 
 from ..db import setup_collection
 from ..core.config import (logger, mongoClient,
                            collectionRole, collectionUser,
                            collectionGroup,
                            collectionSharingRule)
+from . import count_cache
 
 
 async def create_role_collection():
     await setup_collection.create_collection('role')
     await create_ceo_role()
     await create_manager_role()
+    await collectionRole.create_index('ancestors', background=True)
+    await rebuild_role_ancestors()
+
+
+# Every role keeps the names of the roles above it, from the CEO down to the
+# role it reports to. A subtree is then a single {'ancestors': name} query.
+def build_role_ancestors(roles: list) -> dict:
+    reportsTo = {role['role_name']: role['reports_to'] for role in roles}
+    roleAncestors = {}
+
+    for roleName in reportsTo:
+        ancestors = []
+        parentName = reportsTo[roleName]
+        while parentName and parentName in reportsTo and parentName not in ancestors:
+            ancestors.insert(0, parentName)
+            parentName = reportsTo[parentName]
+        roleAncestors[roleName] = ancestors
+
+    return roleAncestors
+
+
+# Fills in the ancestors of roles created before they were stored, and
+# repairs any that drifted
+async def rebuild_role_ancestors():
+    roles = await collectionRole.find(
+        {}, projection={'role_name': 1, 'reports_to': 1, 'ancestors': 1}).to_list(None)
+    roleAncestors = build_role_ancestors(roles)
+
+    operations = [UpdateOne({'_id': role['_id']}, {'$set': {'ancestors': roleAncestors[role['role_name']]}})
+                  for role in roles
+                  if 'ancestors' not in role or role['ancestors'] != roleAncestors[role['role_name']]]
+
+    if len(operations) > 0:
+        await collectionRole.bulk_write(operations, ordered=False)
+        logger.debug(str(len(operations)) + ' role ancestor paths rebuilt.')
+
+
+async def get_role_path(roleName: str, session=None) -> list:
+    roleDoc = await collectionRole.find_one(
+        {'role_name': roleName}, projection={'ancestors': 1}, session=session)
+
+    if roleDoc is None:
+        return None
+
+    return roleDoc['ancestors'] + [roleName]
+
+
+# Rewrites the ancestors of every role below roleName, whose old path was
+# oldPath, to start with newPath instead. One update_many with a pipeline.
+async def move_role_subtree(roleName: str, oldPath: list, newPath: list, session=None):
+    await collectionRole.update_many(
+        {'ancestors': roleName},
+        [{'$set': {'ancestors': {'$concatArrays': [
+            newPath,
+            {'$slice': ['$ancestors', len(oldPath), {'$max': [{'$size': '$ancestors'}, 1]}]}
+        ]}}}],
+        session=session)
 
 
 async def create_ceo_role():
@@ -22,6 +81,7 @@ async def create_ceo_role():
     roleData = {}
     roleData['role_name'] = 'CEO'
     roleData['reports_to'] = ''
+    roleData['ancestors'] = []
     roleData['share_data_with_peers'] = False
     roleData['description'] = 'CEO role'
     roleData['associated_users'] = []
@@ -40,6 +100,7 @@ async def create_manager_role():
     roleData = {}
     roleData['role_name'] = 'Manager'
     roleData['reports_to'] = 'CEO'
+    roleData['ancestors'] = ['CEO']
     roleData['share_data_with_peers'] = False
     roleData['description'] = 'Manager role'
     roleData['associated_users'] = []
@@ -53,13 +114,14 @@ async def create_role(requestData: dict) -> dict:
     try:
         requestData = requestData['new_record']
 
-        roleRecordCount = await collectionRole.count_documents({'role_name': requestData['reports_to']})
-        if roleRecordCount == 0:
+        parentPath = await get_role_path(requestData['reports_to'])
+        if parentPath is None:
             return{'type': 'error', 'message': 'The role of report_to is not present in the system.'}
 
         roleData = {}
         roleData['role_name'] = requestData['role_name']
         roleData['reports_to'] = requestData['reports_to']
+        roleData['ancestors'] = parentPath
         roleData['share_data_with_peers'] = requestData['share_data_with_peers'] if 'share_data_with_peers' in requestData else False
         roleData['description'] = requestData['description']
         roleData['associated_users'] = []
@@ -67,6 +129,7 @@ async def create_role(requestData: dict) -> dict:
         logger.debug(roleData)
 
         result = await collectionRole.insert_one(roleData)
+        count_cache.record_inserted(collectionRole.name)
 
         return {'message': 'New role record created', 'id': str(result.inserted_id)}
     except Exception as e:
@@ -77,20 +140,14 @@ async def create_role(requestData: dict) -> dict:
                 'message': 'An error has occured.'}
 
 
-async def get_role_subordinates(roleName: str) -> list:
+def get_role_subordinates(roleName: str, subRolesByParent: dict) -> list:
     resultList = []
-    recordCount = collectionRole.count_documents({'reports_to': roleName})
-    if recordCount == 0:
-        return resultList
 
-    subRoles = collectionRole.find(
-        {'reports_to': roleName}).sort([('role_name', 1)])
-
-    async for subRole in subRoles:
+    for subRole in subRolesByParent[roleName] if roleName in subRolesByParent else []:
         role = {}
         role['role_name'] = subRole['role_name']
         role['_id'] = str(subRole['_id'])
-        role['subordinates'] = await get_role_subordinates(subRole['role_name'])
+        role['subordinates'] = get_role_subordinates(subRole['role_name'], subRolesByParent)
         resultList.append(role)
 
     return resultList
@@ -98,10 +155,16 @@ async def get_role_subordinates(roleName: str) -> list:
 
 async def get_roles_in_tree_structure() -> dict:
     try:
+        # All roles in one query, the tree is put together in memory
+        subRolesByParent = {}
+        async for role in collectionRole.find(
+                {}, projection={'role_name': 1, 'reports_to': 1}).sort([('role_name', 1)]):
+            subRolesByParent.setdefault(role['reports_to'], []).append(role)
+
         structuredRoles = {}
         structuredRoles['role_name'] = 'CEO'
         structuredRoles['_id'] = ''
-        structuredRoles['subordinates'] = await get_role_subordinates('CEO')
+        structuredRoles['subordinates'] = get_role_subordinates('CEO', subRolesByParent)
 
         return {'structured_roles': structuredRoles, 'message': 'roles retrieved successfully.'}
     except Exception as e:
@@ -121,7 +184,7 @@ async def get_roles_list_with_options(start: int, length: int, search: str) -> d
         if len(search) > 0:
             query['role_name'] = {'$regex': '^' + search, '$options': 'i'}
 
-        recordCount = await collectionRole.count_documents(query)
+        recordCount = (await count_cache.get_count(collectionRole, query))['count']
         roles = collectionRole.find(query).skip(
             start).limit(length).sort(sortFields)
 
@@ -205,10 +268,13 @@ async def update_role(recordId: str, requestData: dict) -> dict:
         if existingData is None:
             return {'type': 'error', 'message': 'No matching role record found to be updated.'}
 
-        roleRecordCount = await collectionRole.count_documents({'role_name': requestData['reports_to']})
-        if roleRecordCount == 0:
+        parentPath = await get_role_path(requestData['reports_to'])
+        if parentPath is None:
             return{'type': 'error', 'message': 'The role of report_to is not present in the system.'}
 
+        if existingData['role_name'] in parentPath:
+            return{'type': 'error', 'message': 'A role cannot report to itself or to a role below it.'}
+
         async with await mongoClient.start_session() as transactionSession:
             async with transactionSession.start_transaction():
                 resultDoc = await collectionRole.update_one(
@@ -216,6 +282,7 @@ async def update_role(recordId: str, requestData: dict) -> dict:
                     {'$set': {
                         'role_name': requestData['role_name'],
                         'reports_to': requestData['reports_to'],
+                        'ancestors': parentPath,
                         'share_data_with_peers': requestData['share_data_with_peers'] if 'share_data_with_peers' in requestData else False,
                         'description': requestData['description']
                     }},
@@ -260,6 +327,20 @@ async def update_role(recordId: str, requestData: dict) -> dict:
                     )
                     sharingRuleUpdateCount += resultSharingRuleUpdate.modified_count
 
+                    await collectionRole.update_many(
+                        {'ancestors': existingData['role_name']},
+                        {'$set': {
+                            'ancestors.$': requestData['role_name']}},
+                        session=transactionSession)
+
+                if resultDoc.modified_count == 1 and existingData['ancestors'] != parentPath:
+                    await move_role_subtree(requestData['role_name'], existingData['ancestors'], parentPath,
+                                            session=transactionSession)
+
+        count_cache.invalidate_filtered_counts(collectionRole.name)
+        if nameChanged:
+            count_cache.invalidate_filtered_counts(collectionUser.name)
+
         extraUpdateClause = ''
         if nameChanged:
             extraUpdateClause = ' ' + \
@@ -285,14 +366,17 @@ async def delete_role(roleToDelete: str, roleToTransfer) -> dict:
         if roleToDelete == roleToTransfer:
             return{'type': 'error', 'message': 'Both roles cannot be the same.'}
 
-        roleRecordCount = await collectionRole.count_documents({'role_name': roleToDelete})
-        if roleRecordCount == 0:
+        deletePath = await get_role_path(roleToDelete)
+        if deletePath is None:
             return{'type': 'error', 'message': 'The role to delete is not present in the system.'}
 
-        roleRecordCount = await collectionRole.count_documents({'role_name': roleToTransfer})
-        if roleRecordCount == 0:
+        transferPath = await get_role_path(roleToTransfer)
+        if transferPath is None:
             return{'type': 'error', 'message': 'The role to transfer is not present in the system.'}
 
+        if roleToDelete in transferPath:
+            return{'type': 'error', 'message': 'The role to transfer cannot be below the role to delete.'}
+
         sharingRuleUpdateCount = 0
 
         async with await mongoClient.start_session() as transactionSession:
@@ -311,6 +395,8 @@ async def delete_role(roleToDelete: str, roleToTransfer) -> dict:
                     }},
                     session=transactionSession
                 )
+                # The deleted role drops out of the paths below it
+                await move_role_subtree(roleToDelete, deletePath, transferPath, session=transactionSession)
                 resultDoc = await collectionRole.delete_one(
                     {'role_name': roleToDelete},
                     session=transactionSession
@@ -344,6 +430,9 @@ async def delete_role(roleToDelete: str, roleToTransfer) -> dict:
         if resultDoc.deleted_count == 0:
             return{'type': 'error', 'message': 'No relevant role record found to be deleted.'}
 
+        count_cache.record_deleted(collectionRole.name)
+        count_cache.invalidate_filtered_counts(collectionUser.name)
+
         return {'message': str(userResultDoc.modified_count) + ' users updated. ' +
                 str(resultReportTo.modified_count) + ' roles with reports_to updated. ' +
                 str(resultGroupUpdate.modified_count) + ' groups updated. ' +
@@ -357,17 +446,21 @@ async def delete_role(roleToDelete: str, roleToTransfer) -> dict:
                 'message': 'An error has occured.'}
 
 
-async def add_users_to_set_with_subordinate_roles(roleName: str, userIdSet: set):
-    subordinateRoles = await collectionRole.find({'reports_to': roleName})
-
-    async for role in subordinateRoles:
-        roleUsers = await collectionUser.find({'role': role['role_name']},
-                                              projection={'_id': 1})
+# One round trip: the role itself and every role below it, each with the
+# ids of its users
+async def get_subtree_roles_with_users(roleName: str) -> list:
+    pipeline = [
+        {'$match': {'$or': [{'role_name': roleName}, {'ancestors': roleName}]}},
+        {'$lookup': {
+            'from': collectionUser.name,
+            'localField': 'role_name',
+            'foreignField': 'role',
+            'as': 'users'
+        }},
+        {'$project': {'role_name': 1, 'share_data_with_peers': 1, 'users._id': 1}}
+    ]
 
-        async for user in roleUsers:
-            userIdSet.add(str(user['_id']))
-
-        await add_users_to_set_with_subordinate_roles(role['role_name'], userIdSet)
+    return await collectionRole.aggregate(pipeline).to_list(None)
 
 
 async def get_users_with_subordinate_roles(roleName: str, userId: str) -> list:
@@ -376,18 +469,36 @@ async def get_users_with_subordinate_roles(roleName: str, userId: str) -> list:
 
     userIdSet = set()
     userIdSet.add(userId)
-    currentRole = await collectionRole.find_one({'role_name': roleName})
 
-    if currentRole is None:
-        return list(userIdSet)
+    for role in await get_subtree_roles_with_users(roleName):
+        # Users of the role itself are only visible when it shares with peers
+        if role['role_name'] == roleName and not role['share_data_with_peers']:
+            continue
 
-    if currentRole['share_data_with_peers']:
-        peerUsers = await collectionUser.find({'role': roleName},
-                                              projection={'_id': 1})
+        for user in role['users']:
+            userIdSet.add(str(user['_id']))
 
-        async for peer in peerUsers:
-            userIdSet.add(str(peer['_id']))
+    return list(userIdSet)
 
-    await add_users_to_set_with_subordinate_roles(roleName, userIdSet)
 
-    return list(userIdSet)
+async def get_subordinates(roleName: str) -> dict:
+    try:
+        roles = await get_subtree_roles_with_users(roleName)
+
+        if not any(role['role_name'] == roleName for role in roles):
+            return {'type': 'error', 'message': 'The role is not present in the system.'}
+
+        subordinateRoles = sorted([role['role_name'] for role in roles if role['role_name'] != roleName])
+        userIds = [str(user['_id']) for role in roles if role['role_name'] != roleName for user in role['users']]
+
+        return {
+            'roles': subordinateRoles,
+            'users': userIds,
+            'message': 'Subordinates retrieved successfully.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {'type': 'exception',
+                'errorType': str(type(e).__name__),
+                'errorMessage': str(e),
+                'message': 'An error has occured.'}
@@ -0,0 +1,134 @@
+import asyncio
+
+from ..core.config import logger, database
+from . import module, permission, field_codec
+
+searchModuleLimit = 5
+searchMaxModuleLimit = 50
+searchResultLimit = 20
+searchMaxResultLimit = 200
+searchTimeoutMs = 1000
+searchMinTimeoutMs = 50
+searchMaxTimeoutMs = 10000
+# Prefix regex finds a record while its name is still being typed, $text only
+# matches whole words and has to be asked for
+searchDefaultMode = 'regex'
+
+
+async def search_module(moduleName: str, search: str, searchMode: str, limit: int, timeoutMs: int,
+                        activityTypes: list = None) -> list:
+    moduleSchema = await module.get_module_schema(moduleName)
+    if moduleSchema is None:
+        return []
+
+    recordsQuery = module.build_records_query(moduleName, search, searchMode, [])
+    query = recordsQuery['query']
+
+    projection = {fieldName: 1 for fieldName in moduleSchema['unique_fields']}
+    if moduleName == 'Activity':
+        projection['activity_type'] = 1
+        query['activity_type'] = {'$in': activityTypes}
+
+    sortFields = []
+    if recordsQuery['textSearch']:
+        projection['score'] = {'$meta': 'textScore'}
+        sortFields.append(('score', {'$meta': 'textScore'}))
+    sortFields.append(('_id', 1))
+
+    # max_time_ms stops the server side of a module that runs out of time
+    collection = database.get_collection('module_' + moduleName)
+    records = await collection.find(query, projection, max_time_ms=timeoutMs) \
+        .sort(sortFields).limit(limit).to_list(limit)
+
+    # Text scores depend on each collection's own term statistics, so they are
+    # only compared within the module: the rank, and the score relative to its best
+    results = []
+    topScore = None
+    for moduleRank, record in enumerate(records, 1):
+        # Regex matches have no relevance score
+        score = record.pop('score', 0)
+        if topScore is None:
+            topScore = score
+        activityType = record['activity_type'] if moduleName == 'Activity' else None
+        field_codec.decode_record(module.get_module_codec(moduleSchema, activityType, projection), record)
+        results.append({'module_name': moduleName, 'module_rank': moduleRank,
+                        'score': score / topScore if topScore else 0, 'record': record})
+
+    return results
+
+
+async def search_all_modules(search: str, currentUser: dict, moduleLimit: int = searchModuleLimit,
+                             resultLimit: int = searchResultLimit, timeoutMs: int = searchTimeoutMs,
+                             searchMode: str = searchDefaultMode) -> dict:
+    try:
+        search = search.strip()
+        if len(search) == 0:
+            return {'type': 'error', 'message': 'A search text is required.'}
+
+        if searchMode not in module.searchModes:
+            return {
+                'type': 'error',
+                'message': 'Search mode has to be one of ' + str(sorted(module.searchModes)) + '.'
+            }
+
+        if moduleLimit < 1 or moduleLimit > searchMaxModuleLimit:
+            return {
+                'type': 'error',
+                'message': 'Limit has to be between 1 and ' + str(searchMaxModuleLimit) + '.'
+            }
+
+        if resultLimit < 1 or resultLimit > searchMaxResultLimit:
+            return {
+                'type': 'error',
+                'message': 'Total has to be between 1 and ' + str(searchMaxResultLimit) + '.'
+            }
+
+        if timeoutMs < searchMinTimeoutMs or timeoutMs > searchMaxTimeoutMs:
+            return {
+                'type': 'error',
+                'message': 'Timeout has to be between ' + str(searchMinTimeoutMs) + ' and ' +
+                str(searchMaxTimeoutMs) + ' ms.'
+            }
+
+        moduleNames = sorted(permission.get_allowed_modules(currentUser['profile'], 'view')
+                             - permission.activityModules)
+        activityTypes = permission.get_allowed_activity_types(currentUser['profile'], 'view')
+        if len(activityTypes) > 0:
+            moduleNames.append('Activity')
+
+        # Each module gets its own timeout, a slow module only drops its own results
+        results = await asyncio.gather(
+            *[asyncio.wait_for(
+                search_module(moduleName, search, searchMode, moduleLimit, timeoutMs, activityTypes),
+                timeout=timeoutMs / 1000) for moduleName in moduleNames],
+            return_exceptions=True)
+
+        records = []
+        modules = {}
+        for moduleName, result in zip(moduleNames, results):
+            if isinstance(result, asyncio.TimeoutError):
+                modules[moduleName] = {'status': 'timeout'}
+            elif isinstance(result, Exception):
+                logger.error(str(type(result).__name__) + ': ' + str(result))
+                modules[moduleName] = {'status': 'error'}
+            else:
+                modules[moduleName] = {'status': 'ok', 'count': len(result)}
+                records.extend(result)
+
+        # Every module's best matches first, then their second best and so on
+        records.sort(key=lambda result: (result['module_rank'], -result['score']))
+        records = records[:resultLimit]
+
+        return {
+            'records': records,
+            'modules': modules,
+            'message': 'Records retrieved successfully.' if len(records) > 0 else 'No record found.'
+        }
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        return {
+            'type': 'exception',
+            'errorType': str(type(e).__name__),
+            'errorMessage': str(e),
+            'message': 'An error has occured.'
+        }
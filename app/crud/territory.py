@@ -1,9 +1,15 @@
 from bson.objectid import ObjectId
 from bson.decimal128 import Decimal128
+import time
 
 from ..db import setup_collection
-from ..core.config import logger, collectionTerritory, collectionModuleAccount, moduleBsonFieldTypes, mongoClient, collectionUser
+from ..core.config import (logger, collectionTerritory, collectionModuleAccount, moduleBsonFieldTypes, mongoClient,
+                           collectionUser, territoryTreeCache)
 from .local_data import load_module_bson_field_types
+from . import count_cache
+
+# Writes from other processes only bump their own version
+territoryTreeTtlSeconds = 60
 
 
 async def create_territory_collection():
@@ -72,6 +78,8 @@ async def create_territory(requestData: dict) -> dict:
             return {'type': 'error', 'message': 'Criteria order not in valid format for the territory.'}
 
         result = await collectionTerritory.insert_one(territoryData)
+        count_cache.record_inserted(collectionTerritory.name)
+        bump_territory_tree_version()
 
         return {'message': 'New territory record created.', 'id': str(result.inserted_id)}
     except Exception as e:
@@ -100,40 +108,68 @@ async def create_root_territory(territoryName: str):
     territoryData['account_rules'] = []
 
     result = await collectionTerritory.insert_one(territoryData)
+    bump_territory_tree_version()
     logger.debug('New root territory record created with id: ' +
                  str(result.inserted_id))
 
 
-async def get_territory_children(parentTerritory: str) -> list:
+def bump_territory_tree_version():
+    territoryTreeCache['version'] += 1
+
+
+def get_territory_children(parentTerritory: str, childrenByParent: dict, visited: set) -> list:
     resultList = []
-    recordCount = await collectionTerritory.count_documents(
-        {'parent_territory': parentTerritory})
-    if recordCount == 0:
-        return resultList
 
-    children = collectionTerritory.find(
-        {'parent_territory': parentTerritory}).sort([('territory_name', 1)])
+    for child in childrenByParent[parentTerritory] if parentTerritory in childrenByParent else []:
+        # A territory moved under its own subtree would loop forever
+        if child['territory_name'] in visited:
+            continue
+        visited.add(child['territory_name'])
 
-    async for child in children:
         territory = {}
         territory['territory_name'] = child['territory_name']
         territory['_id'] = str(child['_id'])
-        territory['children'] = await get_territory_children(child['territory_name'])
+        territory['children'] = get_territory_children(child['territory_name'], childrenByParent, visited)
         resultList.append(territory)
 
     return resultList
 
 
-async def get_territories_in_tree_structure() -> dict:
-    try:
-        rootTerritory = await collectionTerritory.find_one({'root_territory': True})
+async def build_territory_tree() -> dict:
+    rootTerritory = None
+    childrenByParent = {}
+
+    async for territory in collectionTerritory.find(
+            {}, projection={'territory_name': 1, 'parent_territory': 1, 'root_territory': 1}) \
+            .sort([('territory_name', 1)]):
+        if 'root_territory' in territory and territory['root_territory']:
+            rootTerritory = territory
+        elif 'parent_territory' in territory:
+            childrenByParent.setdefault(territory['parent_territory'], []).append(territory)
 
-        structuredTerritories = {}
-        structuredTerritories['territory_name'] = rootTerritory['territory_name']
-        structuredTerritories['_id'] = ''
-        structuredTerritories['children'] = await get_territory_children(rootTerritory['territory_name'])
+    structuredTerritories = {}
+    structuredTerritories['territory_name'] = rootTerritory['territory_name']
+    structuredTerritories['_id'] = ''
+    structuredTerritories['children'] = get_territory_children(
+        rootTerritory['territory_name'], childrenByParent, {rootTerritory['territory_name']})
 
-        return {'structured_territories': structuredTerritories, 'message': 'territories retrieved successfully.'}
+    return structuredTerritories
+
+
+async def get_territories_in_tree_structure() -> dict:
+    try:
+        if territoryTreeCache['tree_version'] != territoryTreeCache['version'] \
+                or time.monotonic() - territoryTreeCache['built_at'] > territoryTreeTtlSeconds:
+            # A write during the scan bumps the version again and the next call rebuilds
+            treeVersion = territoryTreeCache['version']
+            builtAt = time.monotonic()
+            structuredTerritories = await build_territory_tree()
+
+            territoryTreeCache['tree'] = structuredTerritories
+            territoryTreeCache['tree_version'] = treeVersion
+            territoryTreeCache['built_at'] = builtAt
+
+        return {'structured_territories': territoryTreeCache['tree'], 'message': 'territories retrieved successfully.'}
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
         return {'type': 'exception',
@@ -151,7 +187,7 @@ async def get_territories_list_with_options(start: int, length: int, search: str
         if len(search) > 0:
             query['territory_name'] = {'$regex': '^' + search, '$options': 'i'}
 
-        recordCount = await collectionTerritory.count_documents(query)
+        recordCount = (await count_cache.get_count(collectionTerritory, query))['count']
         territories = collectionTerritory.find(query, projection={'territory_name': 1, '_id': 0}).skip(
             start).limit(length).sort(sortFields)
 
@@ -263,6 +299,11 @@ async def update_territory(recordId: str, requestData: dict) -> dict:
                             'territories.$': requestData['territory_name']}},
                         session=transactionSession)
 
+        count_cache.invalidate_filtered_counts(collectionTerritory.name)
+        bump_territory_tree_version()
+        if resultUserDoc is not None:
+            count_cache.invalidate_filtered_counts(collectionUser.name)
+
         userUpdateClause = ''
         if resultUserDoc is not None:
             userUpdateClause = ' ' + \
@@ -624,6 +665,10 @@ async def delete_territory(territoryToDelete: str, territoryToTransfer: str) ->
                 resultDoc = await collectionTerritory.delete_one(
                     {'territory_name': territoryToDelete}, session=transactionSession)
 
+        count_cache.record_deleted(collectionTerritory.name, resultDoc.deleted_count)
+        count_cache.invalidate_filtered_counts(collectionUser.name)
+        bump_territory_tree_version()
+
         updateStatement = ''
         if recordChildCount:
             updateStatement = ' Parent of ' + \
@@ -1,9 +1,19 @@
 import datetime
+import time
 from bson.objectid import ObjectId
 
 from ..db import setup_collection
-from ..core.config import logger, collectionModuleFields, collectionUser, collectionBsonTypeFields
+from ..core.config import logger, collectionModuleFields, collectionUser, collectionBsonTypeFields, currentUserCache
 from ..core import security
+from . import count_cache
+
+# Per process, so other processes see a change once the entry expires
+currentUserCacheTtlSeconds = 30
+currentUserCacheSize = 10000
+# What request handling needs from the user, the password hash stays out
+currentUserProjection = {
+    'email': 1, 'first_name': 1, 'last_name': 1, 'role': 1, 'profile': 1, 'territories': 1, 'status': 1
+}
 
 
 async def create_user_collection():
@@ -41,6 +51,7 @@ async def create_user(requestData: dict, currentUser: dict = None) -> dict:
         # logger.debug(userData)
 
         result = await collectionUser.insert_one(userData)
+        count_cache.record_inserted(collectionUser.name)
 
         return {'message': 'New user record created.', 'id': str(result.inserted_id)}
     except Exception as e:
@@ -114,6 +125,9 @@ async def update_user(recordId: str, requestData: dict) -> dict:
         if result.matched_count == 0:
             return {'type': 'error', 'message': 'No matching user record found to be updated.'}
 
+        count_cache.invalidate_filtered_counts(collectionUser.name)
+        invalidate_current_user(recordId)
+
         return {'message': str(result.modified_count) + ' user record updated.'}
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
@@ -150,6 +164,8 @@ async def change_user_status(recordId: str, status: str) -> dict:
             {'$set': {'status': status}})
 
         if updatedDoc and updatedDoc.modified_count == 1:
+            count_cache.invalidate_filtered_counts(collectionUser.name)
+            invalidate_current_user(recordId)
             return {'message': str(updatedDoc.modified_count) + ' user record has been updated.'}
 
         return {'type': 'error', 'message': 'No user record updated.'}
@@ -169,6 +185,9 @@ async def delete_user(recordId: str) -> dict:
             return {'type': 'error',
                     'message': 'No relevant user record found for the provided record Id to be deleted.'}
 
+        count_cache.record_deleted(collectionUser.name)
+        invalidate_current_user(recordId)
+
         return {'message': 'A user record deleted successfully.'}
     except Exception as e:
         logger.error(str(type(e).__name__) + ': ' + str(e))
@@ -178,7 +197,8 @@ async def delete_user(recordId: str) -> dict:
                 'message': 'An error has occured.'}
 
 
-async def get_users_with_options(start: int, length: int, sortBy: list, sortOrder: str, search: str, statusList: list) -> dict:
+async def get_users_with_options(start: int, length: int, sortBy: list, sortOrder: str, search: str, statusList: list,
+                                 approximateCount: bool = False) -> dict:
     try:
         query = {}
         results = {'records': []}
@@ -206,7 +226,7 @@ async def get_users_with_options(start: int, length: int, sortBy: list, sortOrde
                 i += 1
 
         logger.debug(query)
-        recordCount = await collectionUser.count_documents(query)
+        recordCount = await count_cache.get_count(collectionUser, query, approximateCount)
         records = collectionUser.find(query, projection={'password': 0}).skip(
             start).limit(length).sort(sortFields)
 
@@ -223,8 +243,9 @@ async def get_users_with_options(start: int, length: int, sortBy: list, sortOrde
         else:
             results['message'] = 'No record found.'
 
-        results['recordsFiltered'] = recordCount
-        results['recordsTotal'] = recordCount
+        results['recordsFiltered'] = recordCount['count']
+        results['recordsTotal'] = recordCount['count']
+        results['recordsApproximate'] = recordCount['approximate']
 
         return results
 
@@ -258,7 +279,7 @@ async def save_new_password(email: str, password: str) -> dict:
         return {'type': 'error', 'message': 'The password for the given user is already set.'}
 
     result = await collectionUser.update_one(
-        {'email': email}, {'$set': {'password': security.get_password_hash(password)}})
+        {'email': email}, {'$set': {'password': await security.get_password_hash(password)}})
 
     if result and result.modified_count == 1:
         return {'message': str(result.modified_count) + ' user record has been updated.'}
@@ -277,13 +298,47 @@ async def get_user_by_email(email: str) -> any:
     return userDoc
 
 
+async def get_current_user_view(email: str) -> dict:
+    cachedUser = currentUserCache.get(email)
+    if cachedUser is not None and time.monotonic() - cachedUser['cached_at'] < currentUserCacheTtlSeconds:
+        return cachedUser['user']
+
+    userDoc = await collectionUser.find_one({'email': email}, projection=currentUserProjection)
+
+    if userDoc is None:
+        currentUserCache.pop(email, None)
+        return None
+
+    userDoc['_id'] = str(userDoc['_id'])
+
+    if len(currentUserCache) >= currentUserCacheSize:
+        now = time.monotonic()
+        for cachedEmail in [cachedEmail for cachedEmail, cachedEntry in currentUserCache.items()
+                            if now - cachedEntry['cached_at'] >= currentUserCacheTtlSeconds]:
+            currentUserCache.pop(cachedEmail)
+
+        if len(currentUserCache) >= currentUserCacheSize:
+            currentUserCache.clear()
+
+    currentUserCache[email] = {'user': userDoc, 'cached_at': time.monotonic()}
+
+    return userDoc
+
+
+# Keyed by email but changed by id, and an update may change the email
+def invalidate_current_user(recordId: str):
+    for email in [email for email, cachedEntry in currentUserCache.items()
+                  if cachedEntry['user']['_id'] == recordId]:
+        currentUserCache.pop(email)
+
+
 async def authenticate_user(email: str, password: str) -> dict:
     userDoc = await get_user_by_email(email)
 
     if userDoc is None:
         return None
 
-    if not security.verify_password(password, userDoc['password']):
+    if not await security.verify_password(password, userDoc['password']):
         return None
 
     return userDoc
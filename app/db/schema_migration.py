@@ -0,0 +1,341 @@
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+import asyncio
+import datetime
+
+from ..core.config import logger, database, collectionModuleFields, collectionSchemaMigration, collectionJob
+from ..crud import field_codec
+from . import setup_collection
+
+migrationBackfillBatchSize = 1000
+# Held by the queued or running migration, its unique index lets only one exist
+migrationActiveKey = 'schema_migration'
+# Processes compare this against the version their registry was loaded at
+schemaVersionQuery = {'type': 'schema_version'}
+# A running migration renews its lease, one whose runner died is stale after this
+migrationLeaseSeconds = 60
+
+
+async def get_schema_version() -> int:
+    versionDoc = await collectionModuleFields.find_one(schemaVersionQuery, projection={'version': 1})
+    return versionDoc['version'] if versionDoc is not None else 0
+
+
+async def bump_schema_version():
+    await collectionModuleFields.update_one(schemaVersionQuery, {'$inc': {'version': 1}}, upsert=True)
+
+
+async def get_live_validator(collectionName: str) -> dict:
+    collectionInfos = await database.list_collections(filter={'name': collectionName})
+
+    async for collectionInfo in collectionInfos:
+        if 'options' in collectionInfo and 'validator' in collectionInfo['options']:
+            return collectionInfo['options']['validator']
+        return {}
+
+    return None
+
+
+def diff_validator(liveValidator: dict, validator: dict) -> dict:
+    liveSchema = liveValidator['$jsonSchema'] if '$jsonSchema' in liveValidator else {}
+    liveProperties = liveSchema['properties'] if 'properties' in liveSchema else {}
+    properties = validator['$jsonSchema']['properties']
+
+    validatorDiff = {
+        'added': [fieldName for fieldName in properties if fieldName not in liveProperties],
+        'removed': [fieldName for fieldName in liveProperties if fieldName not in properties],
+        'modified': [fieldName for fieldName in properties
+                     if fieldName in liveProperties and liveProperties[fieldName] != properties[fieldName]]
+    }
+
+    liveRequired = set(liveSchema['required']) if 'required' in liveSchema else set()
+    required = set(validator['$jsonSchema']['required']) if 'required' in validator['$jsonSchema'] else set()
+    validatorDiff['required'] = sorted(required - liveRequired)
+    validatorDiff['not_required'] = sorted(liveRequired - required)
+
+    validatorDiff['changed'] = any([validatorDiff['added'], validatorDiff['removed'], validatorDiff['modified'],
+                                    validatorDiff['required'], validatorDiff['not_required']])
+
+    return validatorDiff
+
+
+async def diff_module(moduleDocument: dict) -> dict:
+    collectionName = 'module_' + moduleDocument['module_name']
+    moduleFields = setup_collection.get_collection_module_fields(moduleDocument)
+    liveValidator = await get_live_validator(collectionName)
+
+    moduleDiff = {'module_name': moduleDocument['module_name']}
+
+    if liveValidator is None:
+        moduleDiff['collection_missing'] = True
+        moduleDiff['changed'] = True
+        return moduleDiff
+
+    validator = await setup_collection.build_validator(collectionName, moduleFields)
+    indexPlan = await setup_collection.plan_collection_indexes(
+        collectionName, moduleFields, moduleDocument['unique_fields'])
+
+    moduleDiff['collection_missing'] = False
+    moduleDiff['validator'] = diff_validator(liveValidator, validator)
+    moduleDiff['indexes'] = {
+        'create': list(indexPlan['create']),
+        'drop': indexPlan['drop'],
+        'text': indexPlan['text']
+    }
+    moduleDiff['changed'] = moduleDiff['validator']['changed'] or len(indexPlan['create']) > 0 \
+        or len(indexPlan['drop']) > 0 or indexPlan['text']
+
+    return moduleDiff
+
+
+async def get_module_documents(moduleNames: list = None) -> list:
+    query = {'type': 'module'}
+    if moduleNames:
+        query['module_name'] = {'$in': moduleNames}
+
+    return await collectionModuleFields.find(query).to_list(None)
+
+
+async def diff_modules(moduleNames: list = None) -> list:
+    return [await diff_module(moduleDocument) for moduleDocument in await get_module_documents(moduleNames)]
+
+
+# The value a create would store when the request leaves the field out
+def get_field_default(moduleField: dict) -> any:
+    try:
+        return field_codec.compile_encoder(moduleField)({})
+    except (KeyError, ValueError):
+        return {}
+
+
+def get_backfill_fields(moduleDocument: dict, addedFieldNames: list) -> list:
+    if moduleDocument['module_name'] == 'Activity':
+        activityFields = moduleDocument['module_fields'][1]['activity_fields']
+        fieldGroups = [({'activity_type': 'Task'}, activityFields['task_fields']),
+                       ({'activity_type': 'Event'}, activityFields['event_fields']),
+                       ({'activity_type': 'Call'}, activityFields['call_fields'])]
+    else:
+        fieldGroups = [({}, moduleDocument['module_fields'])]
+
+    backfillFields = []
+    for query, moduleFields in fieldGroups:
+        for moduleField in moduleFields:
+            if moduleField['field_name'] in addedFieldNames:
+                backfillFields.append((query, moduleField['field_name'], get_field_default(moduleField)))
+
+    return backfillFields
+
+
+# Walks the collection in _id order so every batch resumes where the last
+# one stopped instead of scanning for the missing field again
+async def backfill_field(collection, query: dict, fieldName: str, defaultValue: any, reportBatch):
+    lastId = None
+    filledCount = 0
+
+    while True:
+        batchQuery = dict(query)
+        batchQuery[fieldName] = {'$exists': False}
+        if lastId is not None:
+            batchQuery['_id'] = {'$gt': lastId}
+
+        records = await collection.find(batchQuery, projection={'_id': 1}) \
+            .sort([('_id', 1)]).limit(migrationBackfillBatchSize).to_list(migrationBackfillBatchSize)
+
+        if len(records) == 0:
+            return filledCount
+
+        recordIds = [record['_id'] for record in records]
+        updateResult = await collection.update_many(
+            {'_id': {'$in': recordIds}, fieldName: {'$exists': False}}, {'$set': {fieldName: defaultValue}})
+
+        lastId = recordIds[-1]
+        filledCount += updateResult.modified_count
+        await reportBatch(filledCount)
+
+
+async def update_module_progress(migrationId: ObjectId, moduleName: str, progress: dict):
+    await collectionSchemaMigration.update_one(
+        {'_id': migrationId}, {'$set': {'modules.' + moduleName: progress}})
+
+
+# collMod only swaps the validator metadata, existing documents are not
+# rescanned, so this stays cheap on large collections. Index builds run one
+# at a time and progress is written after every step.
+async def migrate_module(migrationId: ObjectId, moduleDocument: dict, reportProgress=None):
+    moduleName = moduleDocument['module_name']
+    collectionName = 'module_' + moduleName
+    collection = database.get_collection(collectionName)
+    moduleFields = setup_collection.get_collection_module_fields(moduleDocument)
+
+    moduleDiff = await diff_module(moduleDocument)
+    progress = {'status': 'running', 'steps_done': 0, 'diff': moduleDiff}
+
+    async def step_done(stepName: str):
+        progress['steps_done'] += 1
+        progress['current_step'] = stepName
+        await update_module_progress(migrationId, moduleName, progress)
+        if reportProgress is not None:
+            await reportProgress(moduleName, progress)
+
+    if not moduleDiff['changed']:
+        progress['status'] = 'unchanged'
+        progress['steps_total'] = 0
+        await update_module_progress(migrationId, moduleName, progress)
+        return
+
+    if moduleDiff['collection_missing']:
+        progress['steps_total'] = 1
+        await setup_collection.create_collection_with_fields(
+            collectionName, moduleFields, moduleDocument['unique_fields'])
+        await step_done('create collection')
+
+    else:
+        indexPlan = await setup_collection.plan_collection_indexes(
+            collectionName, moduleFields, moduleDocument['unique_fields'])
+        backfillFields = get_backfill_fields(moduleDocument, moduleDiff['validator']['added'])
+        progress['steps_total'] = (1 if moduleDiff['validator']['changed'] else 0) + len(backfillFields) + \
+            len(indexPlan['drop']) + len(indexPlan['create']) + (1 if indexPlan['text'] else 0)
+
+        await setup_collection.create_unique_index(collectionName, moduleDocument['unique_fields'])
+
+        # Old records get the new fields before the validator requires them,
+        # and the decoders find every field they expect
+        for query, fieldName, defaultValue in backfillFields:
+            async def report_batch(filledCount: int):
+                progress['current_step'] = 'backfill ' + fieldName + ' (' + str(filledCount) + ' records)'
+                await update_module_progress(migrationId, moduleName, progress)
+                if reportProgress is not None:
+                    await reportProgress(moduleName, progress)
+
+            filledCount = await backfill_field(collection, query, fieldName, defaultValue, report_batch)
+            await step_done('backfill ' + fieldName + ' (' + str(filledCount) + ' records)')
+
+        if moduleDiff['validator']['changed']:
+            validator = await setup_collection.build_validator(collectionName, moduleFields)
+            await database.command({'collMod': collectionName, 'validator': validator})
+            await step_done('update validator')
+
+        for indexName, indexKeys in indexPlan['create'].items():
+            await collection.create_index(indexKeys, name=indexName, background=True)
+            await step_done('create index ' + indexName)
+
+        for indexName in indexPlan['drop']:
+            await collection.drop_index(indexName)
+            await step_done('drop index ' + indexName)
+
+        if indexPlan['text']:
+            await setup_collection.create_text_index(
+                collectionName, moduleFields, moduleDocument['unique_fields'])
+            await step_done('rebuild text index')
+
+    progress['status'] = 'completed'
+    await update_module_progress(migrationId, moduleName, progress)
+
+
+async def fail_stale_migration(migrationDoc: dict, message: str):
+    await collectionSchemaMigration.update_one(
+        {'_id': migrationDoc['_id'], 'status': migrationDoc['status']},
+        {'$set': {'status': 'failed', 'message': message, 'finished_at': datetime.datetime.now()},
+         '$unset': {'active_key': ''}})
+
+
+async def is_migration_stale(migrationDoc: dict) -> bool:
+    if migrationDoc['status'] == 'running':
+        return 'lease_until' in migrationDoc and migrationDoc['lease_until'] < datetime.datetime.now()
+
+    # Queued: stale once its job will never run it
+    if 'job_id' not in migrationDoc:
+        return False
+
+    jobDoc = await collectionJob.find_one({'_id': migrationDoc['job_id']}, projection={'status': 1})
+    return jobDoc is None or jobDoc['status'] not in {'queued', 'running'}
+
+
+async def get_active_migration() -> dict:
+    async for migrationDoc in collectionSchemaMigration.find({'status': {'$in': ['queued', 'running']}}):
+        if not await is_migration_stale(migrationDoc):
+            return migrationDoc
+
+        await fail_stale_migration(migrationDoc, 'The schema migration stopped without finishing.')
+
+    return None
+
+
+async def set_migration_job(migrationId: ObjectId, jobId: str):
+    await collectionSchemaMigration.update_one({'_id': migrationId}, {'$set': {'job_id': ObjectId(jobId)}})
+
+
+async def renew_migration_lease(migrationId: ObjectId):
+    while True:
+        await asyncio.sleep(migrationLeaseSeconds / 3)
+        await collectionSchemaMigration.update_one(
+            {'_id': migrationId, 'status': 'running'},
+            {'$set': {'lease_until': datetime.datetime.now() + datetime.timedelta(seconds=migrationLeaseSeconds)}})
+
+
+# None when another migration is queued or running, two requests at the same
+# moment collide on the active_key index
+async def create_migration(moduleNames: list = None, createdBy: str = 'system_default') -> ObjectId:
+    try:
+        result = await collectionSchemaMigration.insert_one({
+            'module_names': moduleNames,
+            'status': 'queued',
+            'active_key': migrationActiveKey,
+            'modules': {},
+            'created_by': createdBy,
+            'created_at': datetime.datetime.now()
+        })
+    except DuplicateKeyError:
+        return None
+
+    return result.inserted_id
+
+
+async def run_migration(migrationId: ObjectId, moduleNames: list = None, reportProgress=None):
+    leaseRenewal = None
+    try:
+        startedAt = datetime.datetime.now()
+        await collectionSchemaMigration.update_one(
+            {'_id': migrationId}, {'$set': {
+                'status': 'running',
+                'started_at': startedAt,
+                'lease_until': startedAt + datetime.timedelta(seconds=migrationLeaseSeconds)
+            }})
+        leaseRenewal = asyncio.ensure_future(renew_migration_lease(migrationId))
+
+        for moduleDocument in await get_module_documents(moduleNames):
+            await migrate_module(migrationId, moduleDocument, reportProgress)
+
+        await collectionSchemaMigration.update_one(
+            {'_id': migrationId}, {'$set': {'status': 'completed', 'finished_at': datetime.datetime.now()},
+                                   '$unset': {'active_key': ''}})
+        await bump_schema_version()
+
+    except Exception as e:
+        logger.error(str(type(e).__name__) + ': ' + str(e))
+        await collectionSchemaMigration.update_one(
+            {'_id': migrationId}, {'$set': {
+                'status': 'failed',
+                'message': str(type(e).__name__) + ': ' + str(e),
+                'finished_at': datetime.datetime.now()
+            }, '$unset': {'active_key': ''}})
+
+    finally:
+        if leaseRenewal is not None:
+            leaseRenewal.cancel()
+
+
+async def get_migration(migrationId: str) -> dict:
+    migrationDoc = await collectionSchemaMigration.find_one({'_id': ObjectId(migrationId)})
+
+    if migrationDoc is None:
+        return None
+
+    migrationDoc['_id'] = str(migrationDoc['_id'])
+    if 'job_id' in migrationDoc:
+        migrationDoc['job_id'] = str(migrationDoc['job_id'])
+    for dateField in ['created_at', 'started_at', 'finished_at', 'lease_until']:
+        if dateField in migrationDoc:
+            migrationDoc[dateField] = migrationDoc[dateField].isoformat()
+
+    return migrationDoc
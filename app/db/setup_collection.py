@@ -1,21 +1,113 @@
-from ..core.config import logger, database, collectionModuleFields
+from ..core.config import (logger, database, collectionModuleFields, collectionRelationship,
+                           collectionTombstone, collectionJob, collectionSchemaMigration)
+
+textIndexName = 'text_search'
+textIndexUniqueFieldWeight = 10
+indexPolicyFlags = {'searchable', 'sortable', 'filterable', 'none'}
+# Fields without an index_policy get no secondary index and stay out of the
+# text index, the unique index still covers the unique fields
+undeclaredIndexPolicy = frozenset()
+# Regex search needs no index, fields without an index_policy stay searchable with it
+regexSearchPolicy = frozenset({'searchable'})
+# The change feed reads modified_at in order, with _id breaking ties
+changeFeedIndexName = 'modified_at_1__id_1'
+# Only soft deleted records are in it, so live writes never touch it
+recycleBinIndexName = 'deleted_at_recycle_bin'
+tombstoneRetentionDays = 30
+
+
+def get_text_index_fields(collectionFields: list, undeclaredPolicy: frozenset = undeclaredIndexPolicy) -> list:
+    textFields = []
 
+    for collectionField in collectionFields:
+        fieldName = collectionField['field_name']
 
-async def create_collection_indexes(collectionName: str, collectionFields: list, collectionFieldsUnique: list):
+        if fieldName in textFields or 'searchable' not in get_index_policy(collectionField, undeclaredPolicy):
+            continue
+
+        if collectionField['bson_type'] == 'string':
+            textFields.append(fieldName)
+
+        elif collectionField['bson_type'] == 'object' or collectionField['bson_type'] == 'array':
+            objectFields = []
+            if collectionField['bson_type'] == 'object':
+                objectFields = collectionField['field_object_attribute']
+            else:
+                objectFields = collectionField['field_array_element']
+
+            for objectField in objectFields:
+                if objectField['field_name'][-3:] != '_id' and objectField['bson_type'] == 'string' \
+                        and fieldName + '.' + objectField['field_name'] not in textFields:
+                    textFields.append(fieldName + '.' + objectField['field_name'])
+
+    return textFields
+
+
+def get_text_index_weights(collectionFields: list, collectionFieldsUnique: list) -> dict:
+    textFields = get_text_index_fields(collectionFields)
+
+    # Unique fields (names, numbers) rank above free text fields
+    weights = {}
+    for textField in textFields:
+        weights[textField] = textIndexUniqueFieldWeight if textField in collectionFieldsUnique else 1
+
+    return weights
+
+
+def is_text_index_current(existingIndexes: dict, weights: dict) -> bool:
+    if textIndexName not in existingIndexes:
+        return len(weights) == 0
+
+    return dict(existingIndexes[textIndexName]['weights']) == weights
+
+
+async def create_text_index(collectionName: str, collectionFields: list, collectionFieldsUnique: list):
     collection = database.get_collection(collectionName)
-    # logger.debug(collectionFieldsUnique)
-    uniqueFields = []
-    for collectionField in collectionFieldsUnique:
-        uniqueFields.append((collectionField, 1))
+    weights = get_text_index_weights(collectionFields, collectionFieldsUnique)
+    textFields = list(weights)
+
+    if len(textFields) == 0:
+        existingIndexes = await collection.index_information()
+        if textIndexName in existingIndexes:
+            await collection.drop_index(textIndexName)
+        return
+
+    existingIndexes = await collection.index_information()
+    if textIndexName in existingIndexes:
+        if is_text_index_current(existingIndexes, weights):
+            return
 
-    # logger.debug(uniqueFields)
-    await collection.create_index(uniqueFields, unique=True, background=True)
+        logger.debug('text index of ' + collectionName + ' is outdated.')
+        await collection.drop_index(textIndexName)
 
-    uniqueIndexes = await collection.index_information()
-    logger.debug(uniqueIndexes)
+    await collection.create_index([(textField, 'text') for textField in textFields],
+                                  name=textIndexName, weights=weights,
+                                  default_language='none', background=True)
+    logger.debug('text index of ' + collectionName + ' created.')
 
-    # textIndexes = []
+
+def get_index_policy(collectionField: dict, undeclaredPolicy: frozenset = undeclaredIndexPolicy) -> set:
+    if 'index_policy' not in collectionField:
+        return set(undeclaredPolicy)
+
+    indexPolicy = collectionField['index_policy']
+    if isinstance(indexPolicy, str):
+        indexPolicy = [indexPolicy]
+
+    indexPolicy = set(indexPolicy)
+    unknownFlags = indexPolicy - indexPolicyFlags
+    if unknownFlags:
+        raise ValueError('Index policy of ' + collectionField['field_name'] +
+                         ' has unknown flags ' + str(sorted(unknownFlags)) + '.')
+
+    return indexPolicy - {'none'}
+
+
+def get_policy_indexes(collectionFields: list, collectionFieldsUnique: list) -> dict:
+    policyIndexes = {}
+    managedIndexes = set()
     indexes = set()
+
     for collectionField in collectionFields:
         fieldName = collectionField['field_name']
 
@@ -24,17 +116,124 @@ async def create_collection_indexes(collectionName: str, collectionFields: list,
         else:
             indexes.add(fieldName)
 
-        if fieldName + '_1' not in uniqueIndexes:
-            if collectionField['bson_type'] == 'object' or \
-                    (collectionField['bson_type'] == 'array' and
-                        len(collectionField['field_array_element']) > 1):
-                await collection.create_index(fieldName + '.$**', background=True)
+        isObject = collectionField['bson_type'] == 'object' or \
+            (collectionField['bson_type'] == 'array' and
+                len(collectionField['field_array_element']) > 1)
+
+        # Every name the engine could have created for the field
+        managedIndexes.update(
+            {fieldName + '_1', fieldName + '_-1', fieldName + '.$**_1',
+             fieldName + '_1__id_1', fieldName + '_-1__id_-1'})
+
+        if fieldName == 'modified_at':
+            managedIndexes.add(changeFeedIndexName)
+            policyIndexes[changeFeedIndexName] = [('modified_at', 1), ('_id', 1)]
+
+        indexPolicy = get_index_policy(collectionField)
+
+        # The unique index already covers filtering on a single unique field
+        if collectionFieldsUnique == [fieldName] and 'sortable' not in indexPolicy:
+            continue
+
+        if isObject:
+            if 'filterable' in indexPolicy:
+                policyIndexes[fieldName + '.$**_1'] = [(fieldName + '.$**', 1)]
+
+        elif 'sortable' in indexPolicy:
+            # Sorted pages break ties on _id, (field, _id) serves both directions
+            # and filters on the field too. The change feed index covers modified_at.
+            if fieldName == 'modified_at':
+                continue
+            order = 1
+            if collectionField['bson_type'] == 'date':
+                order = -1
+            policyIndexes[fieldName + '_' + str(order) + '__id_' + str(order)] = [(fieldName, order), ('_id', order)]
+
+        elif 'filterable' in indexPolicy:
+            order = 1
+            if collectionField['bson_type'] == 'date':
+                order = -1
+            policyIndexes[fieldName + '_' + str(order)] = [(fieldName, order)]
+
+    return {'indexes': policyIndexes, 'managed': managedIndexes}
+
+
+async def plan_collection_indexes(collectionName: str, collectionFields: list, collectionFieldsUnique: list) -> dict:
+    collection = database.get_collection(collectionName)
+    policyIndexes = get_policy_indexes(collectionFields, collectionFieldsUnique)
+    existingIndexes = await collection.index_information()
+    indexPlan = {'create': {}, 'drop': []}
+
+    # Only indexes the policy manages are dropped, other indexes are left alone
+    for indexName in existingIndexes:
+        if indexName in policyIndexes['managed'] and indexName not in policyIndexes['indexes'] \
+                and not existingIndexes[indexName].get('unique', False):
+            indexPlan['drop'].append(indexName)
+
+    for indexName, indexKeys in policyIndexes['indexes'].items():
+        if indexName not in existingIndexes:
+            indexPlan['create'][indexName] = indexKeys
+
+    indexPlan['text'] = False
+    if collectionName.startswith('module_'):
+        weights = get_text_index_weights(collectionFields, collectionFieldsUnique)
+        indexPlan['text'] = not is_text_index_current(existingIndexes, weights)
+
+    return indexPlan
 
-            else:
-                order = 1
-                if collectionField['bson_type'] == 'date':
-                    order = -1
-                await collection.create_index([(fieldName, order)], background=True)
+
+async def create_unique_index(collectionName: str, collectionFieldsUnique: list):
+    if len(collectionFieldsUnique) == 0:
+        return
+
+    collection = database.get_collection(collectionName)
+    # logger.debug(collectionFieldsUnique)
+    uniqueFields = []
+    for collectionField in collectionFieldsUnique:
+        uniqueFields.append((collectionField, 1))
+
+    # Live records have no deleted_at and still clash with each other, records in
+    # the recycle bin each carry their own and give their unique values up
+    # (a partial filter cannot select on a missing field)
+    await collection.create_index(uniqueFields + [('deleted_at', 1)], unique=True, background=True)
+
+    # The index from before the recycle bin is dropped once the new one is built
+    legacyIndexName = '_'.join([uniqueField + '_1' for uniqueField in collectionFieldsUnique])
+    existingIndexes = await collection.index_information()
+    if legacyIndexName in existingIndexes and existingIndexes[legacyIndexName].get('unique', False):
+        await collection.drop_index(legacyIndexName)
+
+
+async def reconcile_collection_indexes(collectionName: str, collectionFields: list, collectionFieldsUnique: list) -> dict:
+    collection = database.get_collection(collectionName)
+    await create_unique_index(collectionName, collectionFieldsUnique)
+
+    indexPlan = await plan_collection_indexes(collectionName, collectionFields, collectionFieldsUnique)
+    result = {'created': [], 'dropped': []}
+
+    # Replacements are built before the indexes they replace are dropped
+    for indexName, indexKeys in indexPlan['create'].items():
+        await collection.create_index(indexKeys, name=indexName, background=True)
+        result['created'].append(indexName)
+
+    for indexName in indexPlan['drop']:
+        await collection.drop_index(indexName)
+        result['dropped'].append(indexName)
+
+    if collectionName.startswith('module_'):
+        await create_text_index(collectionName, collectionFields, collectionFieldsUnique)
+        await collection.create_index(
+            [('deleted_at', -1), ('_id', -1)], name=recycleBinIndexName,
+            partialFilterExpression={'deleted_at': {'$exists': True}}, background=True)
+
+    if result['created'] or result['dropped']:
+        logger.debug('indexes of ' + collectionName + ' reconciled: ' + str(result))
+
+    return result
+
+
+async def create_collection_indexes(collectionName: str, collectionFields: list, collectionFieldsUnique: list):
+    await reconcile_collection_indexes(collectionName, collectionFields, collectionFieldsUnique)
 
 
 async def add_fields(collectionName: str, jsonSchema: dict, jsonProperties: dict, collectionFields: list):
@@ -110,7 +309,7 @@ async def add_fields(collectionName: str, jsonSchema: dict, jsonProperties: dict
                 collectionField['field_name'])
 
 
-async def create_collection_with_fields(collectionName: str, collectionFields: list, collectionFieldsUnique: list):
+async def build_validator(collectionName: str, collectionFields: list) -> dict:
     jsonSchema = {}
     jsonSchema['bsonType'] = 'object'
 
@@ -123,6 +322,12 @@ async def create_collection_with_fields(collectionName: str, collectionFields: l
     validator = {}
     validator['$jsonSchema'] = jsonSchema
 
+    return validator
+
+
+async def create_collection_with_fields(collectionName: str, collectionFields: list, collectionFieldsUnique: list):
+    validator = await build_validator(collectionName, collectionFields)
+
     # Create Collection and Apply Validation
     await database.create_collection(collectionName)
     await database.command({'collMod': collectionName, 'validator': validator})
@@ -152,8 +357,77 @@ async def create_collection(collectionName: str):
         logger.error(str(type(e).__name__) + ': ' + str(e))
 
 
+async def create_relationship_indexes():
+    # Forward: the related records of a record field
+    await collectionRelationship.create_index(
+        [('from_module', 1), ('from_id', 1), ('field_name', 1), ('to_id', 1)],
+        unique=True, background=True)
+    # Reverse: the records of a module linking a given record
+    await collectionRelationship.create_index(
+        [('to_id', 1), ('from_module', 1), ('field_name', 1), ('from_id', 1)],
+        background=True)
+
+
+async def create_tombstone_indexes():
+    await collectionTombstone.create_index(
+        [('module_name', 1), ('deleted_at', 1), ('_id', 1)], background=True)
+    await collectionTombstone.create_index(
+        'deleted_at', expireAfterSeconds=tombstoneRetentionDays * 24 * 60 * 60, background=True)
+
+
+async def create_job_indexes():
+    # Leasing looks for due queued jobs and running jobs with an expired lease
+    await collectionJob.create_index([('status', 1), ('run_at', 1)], background=True)
+    await collectionJob.create_index([('status', 1), ('lease_until', 1)], background=True)
+    await collectionJob.create_index([('created_at', -1)], background=True)
+    # Only queued and running singleton jobs carry the key
+    await collectionJob.create_index(
+        'singleton_key', unique=True, partialFilterExpression={'singleton_key': {'$exists': True}},
+        background=True)
+
+
+async def create_schema_migration_indexes():
+    # Only the queued or running migration carries the key
+    await collectionSchemaMigration.create_index(
+        'active_key', unique=True, partialFilterExpression={'active_key': {'$exists': True}},
+        background=True)
+
+
+def get_collection_module_fields(module_document: dict) -> list:
+    moduleFields = module_document['module_fields']
+
+    if module_document['module_name'] == 'Activity':
+        moduleFields = []
+        moduleFields.append(module_document['module_fields'][0])
+        for tField in module_document['module_fields'][1]['activity_fields']['task_fields']:
+            moduleFields.append(tField)
+        for eField in module_document['module_fields'][1]['activity_fields']['event_fields']:
+            moduleFields.append(eField)
+        for cField in module_document['module_fields'][1]['activity_fields']['call_fields']:
+            moduleFields.append(cField)
+
+    return moduleFields
+
+
+async def reconcile_module_indexes() -> dict:
+    results = {}
+
+    async for module_document in collectionModuleFields.find({'type': 'module'}):
+        results[module_document['module_name']] = await reconcile_collection_indexes(
+            'module_' + module_document['module_name'],
+            get_collection_module_fields(module_document),
+            module_document['unique_fields'])
+
+    return results
+
+
 async def create_module_collections():
     try:
+        await create_relationship_indexes()
+        await create_tombstone_indexes()
+        await create_job_indexes()
+        await create_schema_migration_indexes()
+
         async for module_document in collectionModuleFields.find({'type': 'module'}):
             # if module_document['module_name'] != 'Activity':
             module_document['_id'] = str(module_document['_id'])
@@ -162,25 +436,17 @@ async def create_module_collections():
             logger.debug('checking if ' + moduleName + ' is present.')
             moduleNames = await database.list_collection_names()
             # logger.debug(moduleNames)
+
+            moduleFields = get_collection_module_fields(module_document)
+
             if(moduleName not in moduleNames):
                 logger.debug(moduleName + ' is not present.')
                 logger.debug('creating ' + moduleName + ' collection.')
 
-                moduleFields = module_document['module_fields']
-
-                if moduleName == 'module_Activity':
-                    moduleFields = []
-                    moduleFields.append(module_document['module_fields'][0])
-                    for tField in module_document['module_fields'][1]['activity_fields']['task_fields']:
-                        moduleFields.append(tField)
-                    for eField in module_document['module_fields'][1]['activity_fields']['event_fields']:
-                        moduleFields.append(eField)
-                    for cField in module_document['module_fields'][1]['activity_fields']['call_fields']:
-                        moduleFields.append(cField)
-
                 await create_collection_with_fields(moduleName, moduleFields, module_document['unique_fields'])
 
             else:
+                # Index changes on existing collections go through the reconcile job
                 logger.debug(moduleName + ' is present already.')
 
     except Exception as e:
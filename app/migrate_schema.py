@@ -0,0 +1,49 @@
+import argparse
+import asyncio
+import json
+
+from .db import schema_migration
+from .crud import module
+
+# Diffs module definitions against the live collections and applies the
+# changes. Run from the repository root:
+#     python -m app.migrate_schema --dry-run
+#     python -m app.migrate_schema Account Contact
+
+
+async def print_progress(moduleName: str, progress: dict):
+    print('{}: {}/{} {}'.format(moduleName, progress['steps_done'],
+                                progress['steps_total'], progress['current_step']))
+
+
+async def main(moduleNames: list, dryRun: bool):
+    if dryRun:
+        for moduleDiff in await schema_migration.diff_modules(moduleNames):
+            print(json.dumps(moduleDiff, indent=2))
+        return
+
+    activeMigration = await schema_migration.get_active_migration()
+    if activeMigration is not None:
+        print('Schema migration ' + str(activeMigration['_id']) + ' is still ' + activeMigration['status'] + '.')
+        return
+
+    migrationId = await schema_migration.create_migration(moduleNames, 'migrate_schema')
+    if migrationId is None:
+        print('Another schema migration has just been queued.')
+        return
+    await schema_migration.run_migration(migrationId, moduleNames, print_progress)
+
+    migrationDoc = await schema_migration.get_migration(str(migrationId))
+    print('Schema migration ' + migrationDoc['_id'] + ' ' + migrationDoc['status'] + '.')
+    if migrationDoc['status'] == 'completed':
+        print('Running servers and workers pick up the change within ' +
+              str(module.moduleSchemaVersionTtlSeconds) + ' seconds.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate module collections to their definitions.')
+    parser.add_argument('modules', nargs='*', help='module names, all modules when left out')
+    parser.add_argument('--dry-run', action='store_true', help='only print the differences')
+    arguments = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(arguments.modules or None, arguments.dry_run))
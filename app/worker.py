@@ -0,0 +1,37 @@
+import argparse
+import asyncio
+import signal
+
+from .core.config import logger
+from .crud import local_data, job_queue
+
+# Runs queued jobs outside the API process. Set jobWorkerConcurrency in
+# app.core.config to 0 when only these workers should run jobs. Imports read
+# their upload from the local temp directory, so run it on the API host.
+# Run from the repository root:
+#     python -m app.worker --concurrency 4
+
+
+async def main(concurrency: int):
+    await local_data.load_logger()
+    await local_data.load_local_data()
+
+    stopEvent = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for stopSignal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stopSignal, stopEvent.set)
+
+    job_queue.start_job_workers(concurrency)
+    logger.debug(str(concurrency) + ' job workers started.')
+
+    await stopEvent.wait()
+    await job_queue.stop_job_workers()
+    logger.debug('Job workers stopped.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run queued background jobs.')
+    parser.add_argument('--concurrency', type=int, default=4, help='jobs run at the same time')
+    arguments = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(arguments.concurrency))
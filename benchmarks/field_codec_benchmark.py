@@ -0,0 +1,242 @@
+import asyncio
+import copy
+import datetime
+import time
+import base64
+import os
+import sys
+from bson.decimal128 import Decimal128
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+# Run as a script, python puts benchmarks/ on the path instead of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.crud import field_codec
+
+# Run from the repository root: python -m benchmarks.field_codec_benchmark
+
+ROWS = 100
+ROUNDS = 200
+
+moduleFields = [
+    {'field_name': 'account_name', 'bson_type': 'string', 'field_required': True},
+    {'field_name': 'account_number', 'bson_type': 'int', 'field_required': False},
+    {'field_name': 'annual_revenue', 'bson_type': 'decimal', 'field_required': False},
+    {'field_name': 'rating', 'bson_type': 'string', 'field_required': False},
+    {'field_name': 'phone', 'bson_type': 'string', 'field_required': False},
+    {'field_name': 'website', 'bson_type': 'string', 'field_required': False},
+    {'field_name': 'is_active', 'bson_type': 'bool', 'field_required': False},
+    {'field_name': 'created_at', 'bson_type': 'date', 'field_required': False},
+    {'field_name': 'modified_at', 'bson_type': 'date', 'field_required': False},
+    {'field_name': 'billing_address', 'bson_type': 'object', 'field_required': False,
+     'field_object_attribute': [
+         {'field_name': 'street', 'bson_type': 'string'},
+         {'field_name': 'city', 'bson_type': 'string'},
+         {'field_name': 'postal_code', 'bson_type': 'string'},
+         {'field_name': 'verified_at', 'bson_type': 'date'}]},
+    {'field_name': 'contacts', 'bson_type': 'array', 'field_required': False,
+     'field_array_element': [{'field_name': 'contact_id', 'bson_type': 'string'}]},
+    {'field_name': 'attachments', 'bson_type': 'array', 'field_required': False,
+     'field_array_element': [
+         {'field_name': 'file_id', 'bson_type': 'string'},
+         {'field_name': 'file_name', 'bson_type': 'string'}]},
+    {'field_name': 'budget_lines', 'bson_type': 'array', 'field_required': False,
+     'field_array_element': [
+         {'field_name': 'label', 'bson_type': 'string'},
+         {'field_name': 'amount', 'bson_type': 'decimal'}]},
+    {'field_name': 'logo', 'bson_type': 'binData', 'field_required': False},
+]
+
+requestData = {
+    'account_name': 'Acme',
+    'account_number': 42,
+    'annual_revenue': '1250000.50',
+    'rating': 'Hot',
+    'phone': '555-0100',
+    'website': 'acme.example',
+    'is_active': True,
+    'created_at': '2021-03-01T10:00:00',
+    'modified_at': '2021-03-02T10:00:00',
+    'billing_address': {'street': '1 Main St', 'city': 'Springfield',
+                        'postal_code': '12345', 'verified_at': '2021-01-01T00:00:00'},
+    'contacts': ['a', 'b', 'c'],
+    'attachments': [{'file_id': 'f1', 'file_name': 'a.pdf'}],
+    'budget_lines': [{'label': 'Q1', 'amount': '100.25'}, {'label': 'Q2', 'amount': '200.75'}],
+    'logo': base64.b64encode(b'logo-bytes').decode(),
+}
+
+
+async def legacy_get_field_value(moduleField: dict, requestData: dict) -> any:
+    fieldValue = None
+
+    if moduleField['bson_type'] == 'int':
+        fieldValue = 0
+        if moduleField['field_name'] in requestData:
+            fieldValue = requestData[moduleField['field_name']]
+
+    elif moduleField['bson_type'] == 'bool':
+        fieldValue = False
+        if moduleField['field_name'] in requestData:
+            fieldValue = requestData[moduleField['field_name']]
+
+    elif moduleField['bson_type'] == 'decimal':
+        fieldValue = Decimal128('0')
+        if moduleField['field_name'] in requestData:
+            fieldValue = Decimal128(requestData[moduleField['field_name']])
+
+    elif moduleField['bson_type'] == 'date':
+        fieldValue = datetime.datetime(1, 1, 1)
+        if moduleField['field_name'] in requestData:
+            fieldValue = datetime.datetime.fromisoformat(
+                requestData[moduleField['field_name']])
+
+    elif moduleField['bson_type'] == 'binData':
+        if moduleField['field_name'] in requestData:
+            fieldValue = Binary(base64.b64decode(
+                requestData[moduleField['field_name']]))
+
+    elif moduleField['bson_type'] == 'object':
+        fieldValue = {}
+        objectRequestData = {}
+
+        if moduleField['field_name'] in requestData:
+            objectRequestData = requestData[moduleField['field_name']]
+
+        for objectField in moduleField['field_object_attribute']:
+            fieldValue[objectField['field_name']] = await legacy_get_field_value(
+                objectField, objectRequestData)
+
+    elif moduleField['bson_type'] == 'array':
+        fieldValue = []
+        arrayRequestData = []
+        if moduleField['field_name'] in requestData:
+            arrayRequestData = requestData[moduleField['field_name']]
+        if len(moduleField['field_array_element']) > 1 and len(arrayRequestData) > 0:
+            for elementData in arrayRequestData:
+                objectData = {}
+                for objectField in moduleField['field_array_element']:
+                    objectData[objectField['field_name']] = await legacy_get_field_value(objectField, elementData)
+
+                fieldValue.append(objectData)
+        else:
+            fieldValue = arrayRequestData
+
+    else:
+        fieldValue = ''
+        if moduleField['field_name'] in requestData:
+            fieldValue = requestData[moduleField['field_name']]
+
+    return fieldValue
+
+
+async def legacy_convert_field_value_for_get(moduleField: dict, record: dict) -> any:
+    fieldValue = record[moduleField['field_name']]
+
+    if moduleField['bson_type'] == 'decimal':
+        fieldValue = str(fieldValue)
+
+    elif moduleField['bson_type'] == 'date':
+        fieldValue = fieldValue.isoformat()
+
+    elif moduleField['bson_type'] == 'binData':
+        fieldValue = base64.b64encode(fieldValue)
+
+    elif moduleField['bson_type'] == 'object':
+        objectRecord = fieldValue
+        for objectField in moduleField['field_object_attribute']:
+            fieldValue[objectField['field_name']] = await legacy_convert_field_value_for_get(
+                objectField, objectRecord)
+
+    elif moduleField['bson_type'] == 'array':
+        if len(moduleField['field_array_element']) > 1:
+            index = 0
+            while index < len(fieldValue):
+                for objectField in moduleField['field_array_element']:
+                    fieldValue[index][objectField['field_name']] = await legacy_convert_field_value_for_get(objectField, fieldValue[index])
+                index += 1
+
+    return fieldValue
+
+
+async def legacy_encode_rows(rows: int) -> list:
+    documents = []
+    for _ in range(rows):
+        document = {}
+        for moduleField in moduleFields:
+            document[moduleField['field_name']] = await legacy_get_field_value(moduleField, requestData)
+        documents.append(document)
+    return documents
+
+
+async def legacy_decode_rows(records: list):
+    for record in records:
+        for moduleField in moduleFields:
+            record[moduleField['field_name']] = await legacy_convert_field_value_for_get(moduleField, record)
+        record['_id'] = str(record['_id'])
+
+
+def compiled_encode_rows(codec: dict, rows: int) -> list:
+    documents = []
+    for _ in range(rows):
+        document = {}
+        for moduleField, fieldEncoder in codec['encoders']:
+            document[moduleField['field_name']] = fieldEncoder(requestData)
+        documents.append(document)
+    return documents
+
+
+def compiled_decode_rows(codec: dict, records: list):
+    for record in records:
+        field_codec.decode_record(codec, record)
+
+
+def make_stored_rows(codec: dict) -> list:
+    rows = compiled_encode_rows(codec, ROWS)
+    for row in rows:
+        row['_id'] = ObjectId()
+    return rows
+
+
+def report(label: str, seconds: float):
+    rowsPerSecond = (ROWS * ROUNDS) / seconds
+    print('{:<28} {:>12,.0f} rows/s'.format(label, rowsPerSecond))
+
+
+async def main():
+    codec = field_codec.compile_module_codec(moduleFields)
+
+    # Both paths must produce identical documents before timing them
+    storedRows = make_stored_rows(codec)
+    legacyRows = copy.deepcopy(storedRows)
+    compiledRows = copy.deepcopy(storedRows)
+    await legacy_decode_rows(legacyRows)
+    compiled_decode_rows(codec, compiledRows)
+    assert legacyRows == compiledRows
+    assert await legacy_encode_rows(1) == compiled_encode_rows(codec, 1)
+
+    batches = [copy.deepcopy(storedRows) for _ in range(ROUNDS)]
+    begin = time.perf_counter()
+    for batch in batches:
+        await legacy_decode_rows(batch)
+    report('decode (async recursive)', time.perf_counter() - begin)
+
+    batches = [copy.deepcopy(storedRows) for _ in range(ROUNDS)]
+    begin = time.perf_counter()
+    for batch in batches:
+        compiled_decode_rows(codec, batch)
+    report('decode (compiled)', time.perf_counter() - begin)
+
+    begin = time.perf_counter()
+    for _ in range(ROUNDS):
+        await legacy_encode_rows(ROWS)
+    report('encode (async recursive)', time.perf_counter() - begin)
+
+    begin = time.perf_counter()
+    for _ in range(ROUNDS):
+        compiled_encode_rows(codec, ROWS)
+    report('encode (compiled)', time.perf_counter() - begin)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
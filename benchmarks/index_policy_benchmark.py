@@ -0,0 +1,150 @@
+import asyncio
+import copy
+import datetime
+import random
+import time
+import os
+import sys
+from bson.decimal128 import Decimal128
+
+# Run as a script, python puts benchmarks/ on the path instead of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.config import database
+from app.db import setup_collection
+
+# Needs the MongoDB instance from app.core.config. Creates and drops a scratch
+# collection. Run from the repository root:
+#     python -m benchmarks.index_policy_benchmark
+
+DOCUMENTS = 20000
+INSERT_CHUNK = 1000
+PAGE_LENGTH = 25
+REPEATS = 5
+COLLECTION_NAME = 'module_benchmark_index_policy'
+
+collection = database.get_collection(COLLECTION_NAME)
+uniqueFields = ['account_name']
+
+moduleFields = [
+    {'field_name': 'account_name', 'bson_type': 'string'},
+    {'field_name': 'account_number', 'bson_type': 'int'},
+    {'field_name': 'annual_revenue', 'bson_type': 'decimal'},
+    {'field_name': 'rating', 'bson_type': 'string'},
+    {'field_name': 'industry', 'bson_type': 'string'},
+    {'field_name': 'phone', 'bson_type': 'string'},
+    {'field_name': 'fax', 'bson_type': 'string'},
+    {'field_name': 'website', 'bson_type': 'string'},
+    {'field_name': 'description', 'bson_type': 'string'},
+    {'field_name': 'created_at', 'bson_type': 'date'},
+    {'field_name': 'modified_at', 'bson_type': 'date'},
+    {'field_name': 'billing_address', 'bson_type': 'object',
+     'field_object_attribute': [
+         {'field_name': 'street', 'bson_type': 'string'},
+         {'field_name': 'city', 'bson_type': 'string'},
+         {'field_name': 'postal_code', 'bson_type': 'string'}]},
+    {'field_name': 'shipping_address', 'bson_type': 'object',
+     'field_object_attribute': [
+         {'field_name': 'street', 'bson_type': 'string'},
+         {'field_name': 'city', 'bson_type': 'string'},
+         {'field_name': 'postal_code', 'bson_type': 'string'}]},
+]
+
+# What a grid that sorts by date, filters by rating and searches names needs
+declaredPolicy = {
+    'account_name': ['searchable', 'sortable'],
+    'rating': 'filterable',
+    'industry': 'filterable',
+    'created_at': 'sortable',
+}
+
+
+def with_policy(defaultPolicy: str = None, policies: dict = {}) -> list:
+    fields = copy.deepcopy(moduleFields)
+    for field in fields:
+        if field['field_name'] in policies:
+            field['index_policy'] = policies[field['field_name']]
+        elif defaultPolicy is not None:
+            field['index_policy'] = defaultPolicy
+    return fields
+
+
+policies = [
+    ('everything', with_policy(['searchable', 'filterable', 'sortable'])),
+    ('undeclared', with_policy()),
+    ('declared', with_policy('none', declaredPolicy)),
+    ('none', with_policy('none')),
+]
+
+
+def make_document(i: int) -> dict:
+    now = datetime.datetime.now()
+    return {
+        'account_name': 'Account ' + str(i).zfill(8),
+        'account_number': i,
+        'annual_revenue': Decimal128(str(random.randint(0, 10 ** 7))),
+        'rating': random.choice(['Hot', 'Warm', 'Cold']),
+        'industry': random.choice(['Banking', 'Retail', 'Energy', 'Media']),
+        'phone': '555-' + str(i % 10000).zfill(4),
+        'fax': '',
+        'website': 'account' + str(i) + '.example',
+        'description': 'Customer account number ' + str(i),
+        'created_at': now - datetime.timedelta(minutes=i),
+        'modified_at': now,
+        'billing_address': {'street': str(i) + ' Main St', 'city': 'Springfield', 'postal_code': '12345'},
+        'shipping_address': {'street': str(i) + ' Dock Rd', 'city': 'Shelbyville', 'postal_code': '54321'},
+    }
+
+
+async def insert_documents() -> float:
+    begin = time.perf_counter()
+    for chunkStart in range(0, DOCUMENTS, INSERT_CHUNK):
+        await collection.insert_many(
+            [make_document(i) for i in range(chunkStart, min(chunkStart + INSERT_CHUNK, DOCUMENTS))],
+            ordered=False)
+    return DOCUMENTS / (time.perf_counter() - begin)
+
+
+async def sorted_page():
+    await collection.find({}).sort([('created_at', -1)]).skip(1000).limit(PAGE_LENGTH).to_list(PAGE_LENGTH)
+
+
+async def filtered_page():
+    await collection.find({'rating': 'Hot'}).sort([('created_at', -1)]).limit(PAGE_LENGTH).to_list(PAGE_LENGTH)
+
+
+async def prefix_search():
+    await collection.find({'account_name': {'$regex': '^Account 0001'}}).limit(PAGE_LENGTH).to_list(PAGE_LENGTH)
+
+
+async def time_call(call) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        begin = time.perf_counter()
+        await call()
+        timings.append(time.perf_counter() - begin)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+
+async def main():
+    print('{:<20} {:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'policy', 'indexes', 'inserts/s', 'sorted (ms)', 'filter (ms)', 'search (ms)'))
+
+    for policyName, fields in policies:
+        await collection.drop()
+        await setup_collection.reconcile_collection_indexes(COLLECTION_NAME, fields, uniqueFields)
+        indexCount = len(await collection.index_information())
+
+        insertsPerSecond = await insert_documents()
+        sortedMs = await time_call(sorted_page)
+        filterMs = await time_call(filtered_page)
+        searchMs = await time_call(prefix_search)
+
+        print('{:<20} {:>8} {:>12,.0f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+            policyName, indexCount, insertsPerSecond, sortedMs, filterMs, searchMs))
+
+    await collection.drop()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,79 @@
+import asyncio
+import time
+import os
+import sys
+
+# Run as a script, python puts benchmarks/ on the path instead of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core import security
+
+# Measures how a burst of logins delays unrelated requests on the same worker.
+# An unrelated request is stood in for by a probe that yields to the event
+# loop every few milliseconds; its extra delay is the stall any other endpoint
+# would see. Needs no database. Run from the repository root:
+#     python -m benchmarks.login_storm_benchmark
+
+LOGINS = 200
+LOGIN_CONCURRENCY = 50
+PROBE_INTERVAL = 0.005
+PASSWORD = 'correct horse battery staple'
+
+hashedPassword = security.pwdContext.hash(PASSWORD)
+
+
+async def blocking_verify(password: str, hashed: str) -> bool:
+    return security.pwdContext.verify(password, hashed)
+
+
+async def login_storm(verify) -> float:
+    semaphore = asyncio.Semaphore(LOGIN_CONCURRENCY)
+
+    async def login():
+        async with semaphore:
+            assert await verify(PASSWORD, hashedPassword)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[login() for _ in range(LOGINS)])
+    return LOGINS / (time.perf_counter() - begin)
+
+
+async def probe(latencies: list, stop: asyncio.Event):
+    while not stop.is_set():
+        begin = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        latencies.append((time.perf_counter() - begin - PROBE_INTERVAL) * 1000)
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(mode: str, verify):
+    latencies = []
+    stop = asyncio.Event()
+    probeTask = asyncio.ensure_future(probe(latencies, stop))
+
+    loginsPerSecond = await login_storm(verify)
+    stop.set()
+    await probeTask
+
+    print('{:<12} {:>10,.0f} {:>10} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+        mode, loginsPerSecond, len(latencies), percentile(latencies, 0.5),
+        percentile(latencies, 0.99), max(latencies)))
+
+
+async def main():
+    print('{} logins, {} at a time, {} hash threads'.format(
+        LOGINS, LOGIN_CONCURRENCY, security.passwordHashConcurrency))
+    print('{:<12} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'mode', 'logins/s', 'probes', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+
+    await run('blocking', blocking_verify)
+    await run('off-loop', security.verify_password)
+    print(security.get_password_hash_metrics())
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,91 @@
+import asyncio
+import random
+import time
+import os
+import sys
+
+# Run as a script, python puts benchmarks/ on the path instead of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.config import database
+from app.crud import pagination
+from app.db import setup_collection
+
+# Needs the MongoDB instance from app.core.config. Creates and drops a scratch
+# collection. Run from the repository root:
+#     python -m benchmarks.pagination_benchmark
+
+PAGE_LENGTH = 25
+PAGES = [1, 1000, 10000]
+REPEATS = 5
+INSERT_CHUNK = 5000
+
+collection = database.get_collection('benchmark_pagination')
+sortFields = pagination.add_tie_breaker([('account_name', 1)])
+
+moduleFields = [
+    {'field_name': 'account_name', 'bson_type': 'string', 'index_policy': ['searchable', 'sortable']},
+    {'field_name': 'rating', 'bson_type': 'string', 'index_policy': 'filterable'},
+]
+
+
+async def load_documents(count: int):
+    await collection.drop()
+    # The same indexes the index policy gives a module collection
+    policyIndexes = setup_collection.get_policy_indexes(moduleFields, [])
+    for indexName, indexKeys in policyIndexes['indexes'].items():
+        await collection.create_index(indexKeys, name=indexName)
+
+    inserted = 0
+    while inserted < count:
+        chunk = min(INSERT_CHUNK, count - inserted)
+        await collection.insert_many(
+            [{'account_name': 'Account ' + str(random.randint(0, count // 10)).zfill(8),
+              'rating': 'Warm'} for _ in range(chunk)],
+            ordered=False)
+        inserted += chunk
+
+
+async def offset_page(page: int) -> list:
+    records = collection.find({}).skip((page - 1) * PAGE_LENGTH).limit(
+        PAGE_LENGTH).sort(sortFields)
+    return await records.to_list(PAGE_LENGTH)
+
+
+async def cursor_page(cursor: str) -> list:
+    query = pagination.add_keyset_query({}, sortFields, cursor) if cursor else {}
+    records = collection.find(query).limit(PAGE_LENGTH).sort(sortFields)
+    return await records.to_list(PAGE_LENGTH)
+
+
+async def time_call(call, *args) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        begin = time.perf_counter()
+        await call(*args)
+        timings.append(time.perf_counter() - begin)
+    return sorted(timings)[len(timings) // 2] * 1000
+
+
+async def main():
+    await load_documents(PAGE_LENGTH * max(PAGES))
+    print('{:>8} {:>14} {:>14}'.format('page', 'offset (ms)', 'cursor (ms)'))
+
+    for page in PAGES:
+        cursor = None
+        if page > 1:
+            # The cursor a client would hold after reading the previous page
+            previousPage = await offset_page(page - 1)
+            cursor = pagination.encode_cursor(sortFields, previousPage[-1])
+
+        assert await offset_page(page) == await cursor_page(cursor)
+
+        offsetMs = await time_call(offset_page, page)
+        cursorMs = await time_call(cursor_page, cursor)
+        print('{:>8} {:>14.2f} {:>14.2f}'.format(page, offsetMs, cursorMs))
+
+    await collection.drop()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,155 @@
+from bson.objectid import ObjectId
+import asyncio
+import datetime
+import pytest
+
+from app.crud import change_feed, field_codec, module
+
+moduleSchema = {'codec': field_codec.compile_module_codec([
+    {'field_name': 'account_name', 'bson_type': 'string'},
+    {'field_name': 'modified_at', 'bson_type': 'date'}])}
+
+
+class FakeCursor:
+    def __init__(self, documents: list):
+        self.documents = documents
+
+    def sort(self, sortFields: list):
+        return self
+
+    def limit(self, length: int):
+        self.documents = self.documents[:length]
+        return self
+
+    async def to_list(self, length: int) -> list:
+        return self.documents
+
+
+class FakeCollection:
+    def __init__(self, documents: list):
+        self.documents = documents
+        self.queries = []
+
+    def find(self, query: dict):
+        self.queries.append(query)
+        return FakeCursor(list(self.documents))
+
+
+class FakeDatabase:
+    def __init__(self, collection: FakeCollection):
+        self.collection = collection
+
+    def get_collection(self, collectionName: str) -> FakeCollection:
+        return self.collection
+
+
+# Stored dates, and the dates in a token, have millisecond precision
+def now_in_ms() -> datetime.datetime:
+    now = datetime.datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    async def get_module_schema(moduleName: str) -> dict:
+        return moduleSchema
+
+    def install(records: list, tombstones: list) -> tuple:
+        recordCollection = FakeCollection(records)
+        tombstoneCollection = FakeCollection(tombstones)
+        monkeypatch.setattr(module, 'get_module_schema', get_module_schema)
+        monkeypatch.setattr(change_feed, 'database', FakeDatabase(recordCollection))
+        monkeypatch.setattr(change_feed, 'collectionTombstone', tombstoneCollection)
+        return recordCollection, tombstoneCollection
+
+    return install
+
+
+def get_changes(since: str = None, resumeToken: str = None, length: int = 10) -> dict:
+    return asyncio.run(change_feed.get_changes('Account', since, resumeToken, length))
+
+
+def test_since_is_inclusive():
+    sinceTime = datetime.datetime(2021, 3, 1, 10, 0)
+
+    assert change_feed.decode_change_position(sinceTime.isoformat(), None) == [sinceTime, ObjectId('0' * 24)]
+
+
+def test_since_with_an_offset_becomes_local_time():
+    sinceTime = datetime.datetime(2021, 3, 1, 10, 0, tzinfo=datetime.timezone.utc)
+
+    assert change_feed.decode_change_position(sinceTime.isoformat(), None)[0] == \
+        sinceTime.astimezone().replace(tzinfo=None)
+
+
+def test_resume_token_wins_over_since():
+    changedAt = datetime.datetime(2021, 3, 1, 10, 0)
+    changeId = ObjectId()
+    resumeToken = change_feed.encode_resume_token(changedAt, changeId)
+
+    assert change_feed.decode_change_position('2000-01-01T00:00:00', resumeToken) == [changedAt, changeId]
+
+
+@pytest.mark.parametrize('since', [None, '', 'yesterday'])
+def test_invalid_since_is_rejected(since: str):
+    with pytest.raises(ValueError):
+        change_feed.decode_change_position(since, None)
+
+
+def test_positions_older_than_the_tombstones_need_a_resync(feed):
+    feed([], [])
+    since = datetime.datetime.now() - datetime.timedelta(days=change_feed.setup_collection.tombstoneRetentionDays + 1)
+
+    assert get_changes(since.isoformat())['type'] == 'error'
+
+
+def test_changes_are_read_up_to_the_settle_point(feed):
+    records, tombstones = feed([], [])
+    before = datetime.datetime.now()
+
+    get_changes((before - datetime.timedelta(hours=1)).isoformat())
+
+    settledAt = records.queries[0]['$and'][1]['modified_at']['$lte']
+    assert settledAt <= before - datetime.timedelta(seconds=change_feed.changeFeedSettleSeconds) + \
+        datetime.timedelta(seconds=1)
+    assert tombstones.queries[0]['$and'][1]['deleted_at']['$lte'] == settledAt
+
+
+def test_empty_poll_moves_the_token_to_the_settle_point(feed):
+    feed([], [])
+    since = datetime.datetime.now() - datetime.timedelta(hours=1)
+
+    result = get_changes(since.isoformat())
+
+    changedAt, changeId = change_feed.decode_change_position(None, result['resumeToken'])
+    assert result['changes'] == []
+    assert since < changedAt <= datetime.datetime.now() - datetime.timedelta(seconds=change_feed.changeFeedSettleSeconds)
+    assert changeId == ObjectId('f' * 24)
+
+
+def test_empty_poll_ahead_of_the_settle_point_keeps_the_token(feed):
+    feed([], [])
+    position = [now_in_ms() + datetime.timedelta(minutes=1), ObjectId()]
+    resumeToken = change_feed.encode_resume_token(*position)
+
+    result = get_changes(resumeToken=resumeToken)
+
+    assert change_feed.decode_change_position(None, result['resumeToken']) == position
+
+
+def test_upserts_and_deletes_come_in_change_order(feed):
+    base = now_in_ms() - datetime.timedelta(minutes=10)
+    records = [
+        {'_id': ObjectId('%024x' % 1), 'account_name': 'Acme', 'modified_at': base},
+        {'_id': ObjectId('%024x' % 3), 'account_name': 'Globex', 'modified_at': base + datetime.timedelta(seconds=2)},
+    ]
+    tombstones = [{'_id': ObjectId('%024x' % 2), 'record_id': 'gone', 'deleted_at': base + datetime.timedelta(seconds=1)}]
+    feed(records, tombstones)
+
+    result = get_changes((base - datetime.timedelta(minutes=1)).isoformat(), length=2)
+
+    assert [(change['operation'], change['record_id']) for change in result['changes']] == \
+        [('upsert', '%024x' % 1), ('delete', 'gone')]
+    assert result['hasMore'] is True
+    assert change_feed.decode_change_position(None, result['resumeToken']) == \
+        [base + datetime.timedelta(seconds=1), ObjectId('%024x' % 2)]
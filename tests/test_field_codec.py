@@ -0,0 +1,126 @@
+from bson.decimal128 import Decimal128
+from bson.binary import Binary
+from bson.objectid import ObjectId
+import datetime
+import decimal
+import random
+
+from app.crud import field_codec
+
+moduleFields = [
+    {'field_name': 'account_name', 'bson_type': 'string'},
+    {'field_name': 'account_number', 'bson_type': 'int'},
+    {'field_name': 'annual_revenue', 'bson_type': 'decimal'},
+    {'field_name': 'is_active', 'bson_type': 'bool'},
+    {'field_name': 'created_at', 'bson_type': 'date'},
+    {'field_name': 'logo', 'bson_type': 'binData'},
+    {'field_name': 'billing_address', 'bson_type': 'object',
+     'field_object_attribute': [
+         {'field_name': 'city', 'bson_type': 'string'},
+         {'field_name': 'verified_at', 'bson_type': 'date'}]},
+    {'field_name': 'contacts', 'bson_type': 'array',
+     'field_array_element': [{'field_name': 'contact_id', 'bson_type': 'string'}]},
+    {'field_name': 'budget_lines', 'bson_type': 'array',
+     'field_array_element': [
+         {'field_name': 'label', 'bson_type': 'string'},
+         {'field_name': 'amount', 'bson_type': 'decimal'}]},
+]
+
+
+def encode(codec: dict, requestData: dict) -> dict:
+    return {moduleField['field_name']: fieldEncoder(requestData)
+            for moduleField, fieldEncoder in codec['encoders']}
+
+
+def test_encoders_fill_defaults_for_missing_fields():
+    document = encode(field_codec.compile_module_codec(moduleFields), {})
+
+    assert document == {
+        'account_name': '',
+        'account_number': 0,
+        'annual_revenue': Decimal128('0'),
+        'is_active': False,
+        'created_at': datetime.datetime(1, 1, 1),
+        'logo': None,
+        'billing_address': {'city': '', 'verified_at': datetime.datetime(1, 1, 1)},
+        'contacts': [],
+        'budget_lines': [],
+    }
+
+
+def test_decode_reverses_encode():
+    codec = field_codec.compile_module_codec(moduleFields)
+    record = encode(codec, {
+        'account_name': 'Acme',
+        'annual_revenue': '1250000.50',
+        'created_at': '2021-03-01T10:00:00',
+        'logo': 'bG9nbw==',
+        'billing_address': {'city': 'Springfield', 'verified_at': '2021-01-01T00:00:00'},
+        'contacts': ['a', 'b'],
+        'budget_lines': [{'label': 'Q1', 'amount': '100.25'}],
+    })
+    record['_id'] = ObjectId('0123456789abcdef01234567')
+
+    field_codec.decode_record(codec, record)
+
+    assert record['annual_revenue'] == '1250000.50'
+    assert record['created_at'] == '2021-03-01T10:00:00'
+    assert record['logo'] == b'bG9nbw=='
+    assert record['billing_address'] == {'city': 'Springfield', 'verified_at': '2021-01-01T00:00:00'}
+    assert record['contacts'] == ['a', 'b']
+    assert record['budget_lines'] == [{'label': 'Q1', 'amount': '100.25'}]
+    assert record['_id'] == '0123456789abcdef01234567'
+
+
+def test_plain_fields_get_no_decoder():
+    codec = field_codec.compile_module_codec(moduleFields)
+
+    assert [fieldName for fieldName, _ in codec['decoders']] == \
+        ['annual_revenue', 'created_at', 'logo', 'billing_address', 'budget_lines']
+    assert codec['record_decoders'] == []
+
+
+def test_restrict_codec_keeps_projected_fields():
+    codec = field_codec.restrict_codec(field_codec.compile_module_codec(moduleFields), {'created_at': 1})
+    record = {'_id': ObjectId(), 'created_at': datetime.datetime(2021, 3, 1)}
+
+    field_codec.decode_record(codec, record)
+
+    assert record['created_at'] == '2021-03-01T00:00:00'
+
+
+def test_required_object_decodes_attributes_of_the_selected_key():
+    codec = field_codec.compile_module_codec([
+        {'field_name': 'related_to', 'bson_type': 'object',
+         'field_object_attribute': [{'field_name': 'module_name', 'bson_type': 'string'}]},
+        {'field_name': 'record', 'bson_type': 'object',
+         'module_fields_required': {'Deal': ['amount'], 'Account': ['since']},
+         'field_object_attribute': [
+             {'field_name': 'amount', 'bson_type': 'decimal'},
+             {'field_name': 'since', 'bson_type': 'date'}]},
+    ])
+    record = {'_id': ObjectId(), 'related_to': {'module_name': 'Deal'},
+              'record': {'amount': Decimal128('10.5'), 'since': datetime.datetime(2021, 1, 1)}}
+
+    field_codec.decode_record(codec, record)
+
+    assert [fieldName for fieldName, _ in codec['record_decoders']] == ['record']
+    assert record['record'] == {'amount': '10.5', 'since': datetime.datetime(2021, 1, 1)}
+
+
+def test_decode_decimal_matches_bson():
+    for value in ['0', '-0', '1.5', '-1250000.50', '1E+10', '0E-10', '0.000', '1.0E+3',
+                  '9999999999999999999999999999999999', 'NaN', '-NaN', 'Infinity', '-Infinity']:
+        assert field_codec.decode_decimal(Decimal128(value)) == str(Decimal128(value))
+
+    randomGenerator = random.Random(7)
+    for _ in range(2000):
+        value = decimal.Decimal(randomGenerator.choice(['', '-']) +
+                                str(randomGenerator.randrange(10 ** randomGenerator.randint(1, 34))) +
+                                'E' + str(randomGenerator.randint(-6176, 6111)))
+        assert field_codec.decode_decimal(Decimal128(value)) == str(Decimal128(value))
+
+
+def test_decode_bin_data_keeps_none():
+    assert field_codec.decode_bin_data(None) is None
+    assert field_codec.decode_bin_data(Binary(b'logo')) == b'bG9nbw=='
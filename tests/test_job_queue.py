@@ -0,0 +1,147 @@
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+import asyncio
+import datetime
+import pytest
+
+from app.crud import job_queue, permission
+
+workerId = 'host:1:0'
+
+
+class FakeUpdateResult:
+    def __init__(self, modifiedCount: int):
+        self.modified_count = modifiedCount
+
+
+class FakeInsertResult:
+    def __init__(self, insertedId: ObjectId):
+        self.inserted_id = insertedId
+
+
+class FakeJobCollection:
+    def __init__(self, activeJob: dict = None):
+        self.activeJob = activeJob
+        self.updates = []
+        self.inserted = []
+
+    async def update_one(self, query: dict, update: dict):
+        self.updates.append((query, update))
+        return FakeUpdateResult(1)
+
+    async def insert_one(self, jobDoc: dict):
+        if self.activeJob is not None and 'singleton_key' in jobDoc:
+            raise DuplicateKeyError('E11000 duplicate key error')
+
+        self.inserted.append(jobDoc)
+        return FakeInsertResult(ObjectId())
+
+    async def find_one(self, query: dict, projection: dict = None):
+        return self.activeJob
+
+    async def find_one_and_update(self, query: dict, update: dict, **kwargs):
+        self.updates.append((query, update))
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    fakeCollection = FakeJobCollection()
+    monkeypatch.setattr(job_queue, 'collectionJob', fakeCollection)
+    return fakeCollection
+
+
+def make_job(attempts: int, maxAttempts: int = 3) -> dict:
+    return {'_id': ObjectId(), 'type': 'module.mass_update', 'payload': {},
+            'attempts': attempts, 'max_attempts': maxAttempts}
+
+
+@pytest.mark.parametrize('attempts', [1, 2])
+def test_failed_attempt_is_queued_again_with_backoff(collection, attempts: int):
+    job = make_job(attempts)
+
+    before = datetime.datetime.now()
+    asyncio.run(job_queue.fail_job_attempt(job, workerId, 'AutoReconnect: lost', True))
+    after = datetime.datetime.now()
+
+    query, update = collection.updates[0]
+    retryDelay = datetime.timedelta(seconds=job_queue.jobRetryDelaySeconds * 2 ** (attempts - 1))
+    assert query == {'_id': job['_id'], 'worker_id': workerId, 'status': 'running'}
+    assert update['$set']['status'] == 'queued'
+    assert update['$set']['lease_until'] is None
+    assert before + retryDelay <= update['$set']['run_at'] <= after + retryDelay
+
+
+def test_last_failed_attempt_fails_the_job(collection):
+    asyncio.run(job_queue.fail_job_attempt(make_job(3), workerId, 'AutoReconnect: lost', True))
+
+    query, update = collection.updates[0]
+    assert update['$set']['status'] == 'failed'
+    assert update['$unset'] == {'singleton_key': ''}
+
+
+def test_errors_are_not_retried(collection):
+    asyncio.run(job_queue.fail_job_attempt(make_job(1), workerId, 'Module is not known.', False))
+
+    assert collection.updates[0][1]['$set']['status'] == 'failed'
+
+
+def test_job_leased_too_often_fails_without_running(collection, monkeypatch):
+    async def run_module_mass_update(payload: dict, reportProgress) -> dict:
+        raise AssertionError('the handler should not run')
+
+    monkeypatch.setitem(job_queue.jobHandlers, 'module.mass_update', run_module_mass_update)
+    asyncio.run(job_queue.run_job(make_job(4), workerId))
+
+    assert collection.updates[0][1]['$set']['status'] == 'failed'
+
+
+def test_handler_exception_is_retried(collection, monkeypatch):
+    async def run_module_mass_update(payload: dict, reportProgress) -> dict:
+        raise ConnectionError('lost')
+
+    monkeypatch.setitem(job_queue.jobHandlers, 'module.mass_update', run_module_mass_update)
+    asyncio.run(job_queue.run_job(make_job(1), workerId))
+
+    assert collection.updates[0][1]['$set']['status'] == 'queued'
+    assert collection.updates[0][1]['$set']['message'] == 'ConnectionError: lost'
+
+
+def test_lease_takes_due_jobs_and_expired_leases(collection):
+    asyncio.run(job_queue.lease_job(workerId))
+
+    query, update = collection.updates[0]
+    assert [list(branch) for branch in query['$or']] == [['status', 'run_at'], ['status', 'lease_until']]
+    assert query['$or'][1]['status'] == 'running'
+    assert update['$inc'] == {'attempts': 1}
+    assert update['$set']['worker_id'] == workerId
+
+
+def test_singleton_job_returns_the_active_one(collection):
+    activeJobId = ObjectId()
+    collection.activeJob = {'_id': activeJobId, 'status': 'running'}
+
+    result = asyncio.run(job_queue.enqueue_job('module.recycle_bin_purge', {}, singleton=True))
+
+    assert result['id'] == str(activeJobId)
+    assert collection.inserted == []
+
+
+def test_unknown_job_type_is_not_queued(collection):
+    result = asyncio.run(job_queue.enqueue_job('module.unknown', {}))
+
+    assert result['type'] == 'error'
+    assert collection.inserted == []
+
+
+@pytest.mark.parametrize('administrator', [True, False])
+def test_cancel_keeps_to_own_jobs_unless_administrator(collection, monkeypatch, administrator: bool):
+    monkeypatch.setattr(permission, 'is_administrator', lambda profileName: administrator)
+    jobId = ObjectId()
+
+    asyncio.run(job_queue.cancel_job(str(jobId), {'email': 'user@example.com', 'profile': 'Standard'}))
+
+    query, update = collection.updates[0]
+    assert query['_id'] == jobId
+    assert query['status'] == 'queued'
+    assert ('created_by' in query) is not administrator
+    assert update['$unset'] == {'singleton_key': ''}
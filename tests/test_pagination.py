@@ -0,0 +1,166 @@
+from bson.objectid import ObjectId
+import datetime
+import pytest
+
+from app.crud import pagination
+
+
+# Enough of the MongoDB query language to run the keyset queries in memory
+def matches(query: dict, document: dict) -> bool:
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(clause, document) for clause in condition):
+                return False
+            continue
+
+        if key == '$and':
+            if not all(matches(clause, document) for clause in condition):
+                return False
+            continue
+
+        value = document.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+
+        for operator, operand in condition.items():
+            if operator == '$gt' and (value is None or not value > operand):
+                return False
+            if operator == '$lt' and (value is None or not value < operand):
+                return False
+            if operator == '$ne' and value == operand:
+                return False
+            if operator == '$exists' and (key in document) != operand:
+                return False
+
+    return True
+
+
+# Null sorts before every value, as in MongoDB
+def sort_key(document: dict, sortFields: list) -> tuple:
+    key = []
+    for fieldName, order in sortFields:
+        value = document.get(fieldName)
+        rank = (0, 0) if value is None else (1, value)
+        key.append(rank if order == 1 else Reverse(rank))
+    return tuple(key)
+
+
+class Reverse:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def walk_pages(documents: list, sortFields: list, pageLength: int) -> list:
+    ordered = sorted(documents, key=lambda document: sort_key(document, sortFields))
+    seen = []
+    cursor = None
+
+    while True:
+        query = {} if cursor is None else pagination.add_keyset_query({}, sortFields, cursor)
+        page = [document for document in ordered if matches(query, document)][:pageLength]
+        if len(page) == 0:
+            return seen
+        seen.extend(page)
+        cursor = pagination.encode_cursor(sortFields, page[-1])
+
+
+def make_documents() -> list:
+    documents = []
+    for i, name in enumerate(['b', None, 'a', 'b', None, 'c', 'a', None, 'b']):
+        document = {'_id': ObjectId('%024x' % (i + 1))}
+        if name is not None or i % 2 == 0:
+            document['account_name'] = name
+        documents.append(document)
+    return documents
+
+
+def test_add_tie_breaker_follows_the_first_sort_order():
+    assert pagination.add_tie_breaker([('account_name', -1)]) == [('account_name', -1), ('_id', -1)]
+    assert pagination.add_tie_breaker([('_id', -1), ('rating', 1)]) == [('rating', 1), ('_id', 1)]
+    assert pagination.add_tie_breaker([]) == [('_id', 1)]
+
+
+def test_cursor_round_trip_keeps_bson_types():
+    sortFields = [('created_at', -1), ('_id', -1)]
+    record = {'_id': ObjectId(), 'created_at': datetime.datetime(2021, 3, 1, 10, 0)}
+
+    values = pagination.decode_cursor(pagination.encode_cursor(sortFields, record), sortFields)
+
+    assert values == [record['created_at'], record['_id']]
+
+
+def test_cursor_reads_nested_and_missing_fields():
+    sortFields = [('billing_address.city', 1), ('_id', 1)]
+    recordId = ObjectId()
+
+    assert pagination.decode_cursor(pagination.encode_cursor(
+        sortFields, {'_id': recordId, 'billing_address': {'city': 'Springfield'}}), sortFields) == \
+        ['Springfield', recordId]
+    assert pagination.decode_cursor(pagination.encode_cursor(
+        sortFields, {'_id': recordId}), sortFields) == [None, recordId]
+
+
+def test_cursor_rejects_other_sort_orders_and_garbage():
+    cursor = pagination.encode_cursor([('account_name', 1), ('_id', 1)], {'_id': ObjectId()})
+
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor, [('account_name', -1), ('_id', -1)])
+
+    with pytest.raises(ValueError):
+        pagination.decode_cursor('not a cursor', [('_id', 1)])
+
+
+def test_keyset_query_for_one_sort_field():
+    recordId = ObjectId()
+
+    assert pagination.build_keyset_query([('account_name', 1), ('_id', 1)], ['Acme', recordId]) == {'$or': [
+        {'account_name': {'$gt': 'Acme'}},
+        {'account_name': 'Acme', '_id': {'$gt': recordId}},
+    ]}
+
+
+def test_keyset_query_after_a_null_value():
+    recordId = ObjectId()
+
+    # Ascending, every non-null value is still ahead
+    assert pagination.build_keyset_query([('account_name', 1), ('_id', 1)], [None, recordId]) == {'$or': [
+        {'account_name': {'$ne': None}},
+        {'account_name': None, '_id': {'$gt': recordId}},
+    ]}
+
+    # Descending, only the nulls with a lower _id are left
+    assert pagination.build_keyset_query([('account_name', -1), ('_id', -1)], [None, recordId]) == {'$or': [
+        {'account_name': None, '_id': {'$lt': recordId}},
+    ]}
+
+
+def test_keyset_query_without_anything_after():
+    assert pagination.build_keyset_query([('account_name', -1)], [None]) == {'_id': {'$exists': False}}
+
+
+@pytest.mark.parametrize('order', [1, -1])
+@pytest.mark.parametrize('pageLength', [1, 2, 4])
+def test_pages_visit_every_document_once_in_order(order: int, pageLength: int):
+    documents = make_documents()
+    sortFields = pagination.add_tie_breaker([('account_name', order)])
+
+    seen = walk_pages(documents, sortFields, pageLength)
+
+    assert [document['_id'] for document in seen] == \
+        [document['_id'] for document in sorted(documents, key=lambda document: sort_key(document, sortFields))]
+
+
+def test_add_keyset_query_keeps_the_filter():
+    sortFields = [('_id', 1)]
+    cursor = pagination.encode_cursor(sortFields, {'_id': ObjectId('%024x' % 1)})
+
+    assert pagination.add_keyset_query({'rating': 'Hot'}, sortFields, cursor) == {'$and': [
+        {'rating': 'Hot'}, {'$or': [{'_id': {'$gt': ObjectId('%024x' % 1)}}]}]}
@@ -0,0 +1,88 @@
+import pytest
+
+from app.crud import permission
+
+profiles = {
+    'Administrator': {
+        'modules': [{'module_name': moduleName, 'operations': ['view', 'create', 'edit', 'delete']}
+                    for moduleName in ['Account', 'Task', 'Event', 'Call']],
+        'import_records': ['Account', 'Task'],
+        'export_records': ['Account', 'Task', 'Call']
+    },
+    'Standard': {
+        'modules': [
+            {'module_name': 'Account', 'operations': ['view', 'edit']},
+            {'module_name': 'Task', 'operations': ['view', 'create']},
+            {'module_name': 'Call', 'operations': ['view']}
+        ],
+        'export_records': ['Account']
+    },
+    'Read Only': {}
+}
+
+
+@pytest.fixture(autouse=True)
+def matrix(monkeypatch):
+    monkeypatch.setattr(permission, 'dictProfiles', profiles)
+    monkeypatch.setattr(permission, 'permissionMatrix', {'profiles': {}, 'compiled_at': 0, 'reloading': False})
+    permission.compile_permission_matrix()
+    return permission.permissionMatrix
+
+
+def test_matrix_holds_every_profile(matrix):
+    assert set(matrix['profiles']) == set(profiles)
+    assert matrix['reloading'] is False
+    assert matrix['profiles']['Standard']['modules']['Account'] == frozenset({'view', 'edit'})
+    assert matrix['profiles']['Read Only'] == {
+        'modules': {}, 'import_records': frozenset(), 'export_records': frozenset()}
+
+
+@pytest.mark.parametrize('profileName, moduleName, operation, allowed', [
+    ('Standard', 'Account', 'edit', True),
+    ('Standard', 'Account', 'delete', False),
+    ('Standard', 'Lead', 'view', False),
+    ('Standard', 'Activity', 'view', True),
+    ('Standard', 'Activity', 'create', True),
+    ('Standard', 'Activity', 'delete', False),
+    ('Read Only', 'Account', 'view', False),
+    ('Unknown', 'Account', 'view', False)
+])
+def test_operation_allowed(profileName: str, moduleName: str, operation: str, allowed: bool):
+    assert permission.is_operation_allowed(profileName, moduleName, operation) is allowed
+
+
+def test_allowed_activity_types():
+    assert permission.get_allowed_activity_types('Standard', 'view') == ['Call', 'Task']
+    assert permission.get_allowed_activity_types('Standard', 'edit') == []
+    assert permission.get_allowed_activity_types('Administrator', 'delete') == ['Call', 'Event', 'Task']
+    assert permission.get_allowed_modules('Unknown', 'view') == set()
+
+
+def test_administrator_needs_the_profile_to_exist(monkeypatch):
+    assert permission.is_administrator('Administrator') is True
+    assert permission.is_administrator('Standard') is False
+
+    monkeypatch.setitem(permission.permissionMatrix, 'profiles', {})
+    assert permission.is_administrator('Administrator') is False
+
+
+@pytest.mark.parametrize('profileName, moduleName, dataRecords, allowed', [
+    ('Administrator', 'Activity', 'import_records', True),
+    ('Standard', 'Account', 'export_records', True),
+    ('Standard', 'Account', 'import_records', False),
+    ('Standard', 'Activity', 'export_records', False),
+    ('Unknown', 'Account', 'export_records', False)
+])
+def test_data_records_allowed(profileName: str, moduleName: str, dataRecords: str, allowed: bool):
+    assert permission.is_data_records_allowed(profileName, moduleName, dataRecords) is allowed
+
+
+def test_stale_matrix_keeps_answering_while_it_reloads(matrix, monkeypatch):
+    reloads = []
+    monkeypatch.setitem(matrix, 'compiled_at', matrix['compiled_at'] - permission.permissionMatrixTtlSeconds)
+    monkeypatch.setattr(permission.asyncio, 'ensure_future', lambda coroutine: reloads.append(coroutine.close()))
+
+    assert permission.is_operation_allowed('Standard', 'Account', 'view') is True
+    assert permission.is_operation_allowed('Standard', 'Account', 'view') is True
+    assert len(reloads) == 1
+    assert matrix['reloading'] is True
@@ -0,0 +1,91 @@
+from bson.objectid import ObjectId
+import asyncio
+import datetime
+
+from app.crud import module
+
+recordId = '0123456789abcdef01234567'
+modifiedAt = datetime.datetime(2021, 3, 1, 10, 0)
+
+
+class FakeCollection:
+    name = 'module_Account'
+
+    def __init__(self, updatedDoc: dict, currentDoc: dict = None):
+        self.updatedDoc = updatedDoc
+        self.currentDoc = currentDoc
+        self.calls = []
+
+    async def find_one_and_update(self, updateFilter: dict, update: dict, **kwargs) -> dict:
+        self.calls.append(('find_one_and_update', updateFilter, update))
+        return self.updatedDoc
+
+    async def find_one(self, recordFilter: dict, **kwargs) -> dict:
+        self.calls.append(('find_one', recordFilter))
+        return self.currentDoc
+
+
+def update(collection: FakeCollection, version: int = None, activityType: str = None) -> dict:
+    return asyncio.run(module.update_record_in_single_write(
+        'Account', collection, recordId, {'rating': 'Hot'}, 'user@example.com', modifiedAt,
+        version, activityType))
+
+
+def test_update_matches_the_version_and_bumps_it():
+    collection = FakeCollection({'_id': ObjectId(recordId), 'version': 4})
+
+    result = update(collection, 3)
+
+    assert result == {'message': '1 Account record updated.', 'version': 4}
+    assert collection.calls == [('find_one_and_update',
+                                 {'deleted_at': {'$exists': False}, '_id': ObjectId(recordId), 'version': 3},
+                                 {'$set': {'rating': 'Hot', 'modified_by': 'user@example.com',
+                                           'modified_at': modifiedAt},
+                                  '$inc': {'version': 1}})]
+
+
+def test_version_zero_matches_records_without_a_version():
+    collection = FakeCollection({'_id': ObjectId(recordId), 'version': 1})
+
+    update(collection, 0)
+
+    assert collection.calls[0][1]['version'] == {'$in': [0, None]}
+
+
+def test_update_without_a_version_is_last_write_wins():
+    collection = FakeCollection({'_id': ObjectId(recordId), 'version': 8})
+
+    update(collection)
+
+    assert 'version' not in collection.calls[0][1]
+
+
+def test_stale_version_is_a_conflict_with_the_current_version():
+    collection = FakeCollection(None, {'_id': ObjectId(recordId), 'version': 5})
+
+    result = update(collection, 3)
+
+    assert result['type'] == 'conflict'
+    assert result['version'] == 5
+
+
+def test_record_without_a_version_conflicts_at_version_zero():
+    result = update(FakeCollection(None, {'_id': ObjectId(recordId)}), 2)
+
+    assert result['type'] == 'conflict'
+    assert result['version'] == 0
+
+
+def test_missing_record_is_an_error_not_a_conflict():
+    result = update(FakeCollection(None, None), 3)
+
+    assert result['type'] == 'error'
+
+
+def test_activity_type_mismatch_is_an_error():
+    collection = FakeCollection(None, {'_id': ObjectId(recordId), 'version': 3, 'activity_type': 'Call'})
+
+    result = update(collection, 3, 'Task')
+
+    assert collection.calls[0][1]['activity_type'] == 'Task'
+    assert result['type'] == 'error'
@@ -0,0 +1,110 @@
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+import asyncio
+import datetime
+import pytest
+
+from app.crud import recycle_bin, record_import, module
+
+recordIds = ['%024x' % i for i in range(1, 4)]
+
+
+class FakeBulkResult:
+    def __init__(self, modifiedCount: int):
+        self.modified_count = modifiedCount
+
+
+class FakeCollection:
+    name = 'module_Account'
+
+    def __init__(self, writeError: dict = None):
+        self.writeError = writeError
+        self.operations = []
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        assert ordered is False
+        self.operations = operations
+        if self.writeError is None:
+            return FakeBulkResult(len(operations))
+
+        raise BulkWriteError({'writeErrors': [self.writeError], 'nModified': len(operations) - 1})
+
+
+class FakeDatabase:
+    def __init__(self, collection: FakeCollection):
+        self.collection = collection
+
+    def get_collection(self, collectionName: str) -> FakeCollection:
+        return self.collection
+
+
+@pytest.fixture
+def restore(monkeypatch):
+    async def get_module_schema(moduleName: str) -> dict:
+        return {}
+
+    def run(collection: FakeCollection, moduleName: str = 'Account', recordIdList: list = recordIds,
+            activityTypes: list = None) -> dict:
+        monkeypatch.setattr(module, 'get_module_schema', get_module_schema)
+        monkeypatch.setattr(recycle_bin, 'database', FakeDatabase(collection))
+        return asyncio.run(recycle_bin.restore_records(moduleName, {'record_id': recordIdList}, activityTypes))
+
+    return run
+
+
+def test_restore_only_touches_deleted_records(restore):
+    collection = FakeCollection()
+
+    result = restore(collection)
+
+    assert result['restoredCount'] == 3
+    assert result['conflictIds'] == []
+    for recordId, operation in zip(recordIds, collection.operations):
+        assert operation._filter == {'deleted_at': {'$exists': True}, '_id': ObjectId(recordId)}
+        assert operation._doc['$unset'] == {'deleted_at': ''}
+
+
+def test_restore_keeps_unique_conflicts_in_the_recycle_bin(restore):
+    result = restore(FakeCollection({'index': 1, 'code': 11000, 'errmsg': 'duplicate key'}))
+
+    assert result['restoredCount'] == 2
+    assert result['conflictIds'] == [recordIds[1]]
+    assert '1 records clash' in result['message']
+
+
+def test_restore_reports_other_write_errors(restore):
+    result = restore(FakeCollection({'index': 0, 'code': 121, 'errmsg': 'validation failed'}))
+
+    assert result['type'] == 'exception'
+
+
+def test_restore_of_activities_keeps_to_the_allowed_types(restore):
+    collection = FakeCollection()
+
+    restore(collection, 'Activity', recordIds[:1], ['Task'])
+
+    assert collection.operations[0]._filter['activity_type'] == {'$in': ['Task']}
+
+
+@pytest.mark.parametrize('recordIdList', [[], ['%024x' % i for i in range(recycle_bin.recycleBinPageLimit + 1)]])
+def test_restore_limits_the_number_of_records(restore, recordIdList: list):
+    result = restore(FakeCollection(), recordIdList=recordIdList)
+
+    assert result['type'] == 'error'
+
+
+def test_purge_runs_at_the_next_interval_boundary():
+    purgeAt = recycle_bin.get_next_purge_at()
+    untilPurge = (purgeAt - datetime.datetime.now()).total_seconds()
+
+    assert int(purgeAt.timestamp()) % recycle_bin.recycleBinPurgeIntervalSeconds == 0
+    assert 0 < untilPurge <= recycle_bin.recycleBinPurgeIntervalSeconds
+
+
+def test_import_upsert_matches_live_records_only():
+    operation = record_import.build_import_operation(
+        {'account_name': 'Acme', 'rating': 'Hot', 'created_by': 'import'}, ['account_name'])
+
+    assert operation._filter == {'deleted_at': {'$exists': False}, 'account_name': 'Acme'}
+    assert operation._doc == {'$set': {'account_name': 'Acme', 'rating': 'Hot'},
+                              '$setOnInsert': {'created_by': 'import'}}